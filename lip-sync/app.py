@@ -24,8 +24,11 @@ import json
 #from gevent import pywsgi
 #from geventwebsocket.handler import WebSocketHandler
 import re
+import time
+import os
 import numpy as np
-from threading import Thread,Event
+from threading import Thread,Event,Lock
+from collections import OrderedDict
 #import multiprocessing
 import torch.multiprocessing as mp
 
@@ -35,8 +38,15 @@ import aiohttp_cors
 from aiortc import RTCPeerConnection, RTCSessionDescription,RTCIceServer,RTCConfiguration
 from aiortc.rtcrtpsender import RTCRtpSender
 from webrtc import HumanPlayer
-from basereal import BaseReal
+from basereal import BaseReal,release_idle_frames
+from videoenc import get_pool,release_idle_packets
+from gpublend import release_blender
+from onnxmodel import backend_model
 from llm import llm_response
+import metrics
+from ttsreal import http_pool_stats
+from ttscache import get_tts_cache
+from sessionpool import SessionPool
 
 import argparse
 import random
@@ -46,6 +56,8 @@ import torch
 from typing import Dict
 from logger import logger
 import gc
+import copy
+import hmac
 
 
 app = Flask(__name__)
@@ -54,6 +66,11 @@ nerfreals:Dict[int, BaseReal] = {} #sessionid:BaseReal
 opt = None
 model = None
 avatar = None
+avatars:OrderedDict = OrderedDict() #avatar_id:avatar, least recently used first
+avatar_lock = Lock()
+session_pool:SessionPool = None
+session_defaults:Dict = {} #avatar_id, REF_FILE, REF_TEXT of new sessions, set by /switch_avatar
+dispatcher_token = os.environ.get('LIVETALKING_DISPATCHER_TOKEN', '') #set by dispatcher.py on its workers
         
 
 #####webrtc###############################
@@ -65,20 +82,54 @@ def randN(N)->int:
     max = pow(10, N)
     return random.randint(min, max - 1)
 
+def load_avatar_cached(avatar_id:str):
+    '''avatar from the lru cache, loaded on a miss with the already loaded models'''
+    #the id comes from request bodies, it has to name a directory right in data/avatars
+    if not isinstance(avatar_id, str) or not re.fullmatch(r'[\w.-]+', avatar_id) or avatar_id in ('.', '..'):
+        raise ValueError(f"invalid avatar_id {avatar_id!r}")
+    with avatar_lock:
+        if avatar_id in avatars:
+            avatars.move_to_end(avatar_id)
+            return avatars[avatar_id]
+        if not os.path.isdir(f"./data/avatars/{avatar_id}"):
+            raise ValueError(f"avatar {avatar_id} does not exist")
+        if opt.model == 'wav2lip':
+            from lipreal import load_avatar
+        elif opt.model == 'musetalk':
+            from musereal import load_avatar
+        elif opt.model == 'ultralight':
+            from lightreal import load_avatar as load_ultralight_avatar
+            load_avatar = lambda avatar_id: load_ultralight_avatar(avatar_id,opt)
+        t = time.perf_counter()
+        avatars[avatar_id] = load_avatar(avatar_id)
+        logger.info('load avatar %s in %.2fs',avatar_id,time.perf_counter()-t)
+        while len(avatars) > max(opt.avatar_cache_size,1):
+            evict_id,evicted = avatars.popitem(last=False)
+            #sessions still rendering the evicted avatar keep their own reference
+            release_blender(evicted)
+            release_idle_frames(evicted)
+            release_idle_packets(evicted)
+            logger.info('evict avatar %s',evict_id)
+        return avatars[avatar_id]
+
 def build_nerfreal(sessionid:int)->BaseReal:
-    opt.sessionid=sessionid
+    #each session has its own opt, a voice switch of one session does not reach the others
+    session_opt = copy.copy(opt)
+    vars(session_opt).update(session_defaults)
+    session_opt.sessionid=sessionid
+    avatar = load_avatar_cached(session_opt.avatar_id)
     if opt.model == 'wav2lip':
         from lipreal import LipReal
-        nerfreal = LipReal(opt,model,avatar)
+        nerfreal = LipReal(session_opt,model,avatar)
     elif opt.model == 'musetalk':
         from musereal import MuseReal
-        nerfreal = MuseReal(opt,model,avatar)
+        nerfreal = MuseReal(session_opt,model,avatar)
     # elif opt.model == 'ernerf':
     #     from nerfreal import NeRFReal
     #     nerfreal = NeRFReal(opt,model,avatar)
     elif opt.model == 'ultralight':
         from lightreal import LightReal
-        nerfreal = LightReal(opt,model,avatar)
+        nerfreal = LightReal(session_opt,model,avatar)
     return nerfreal
 
 @app.route('/offer', methods=['POST'])
@@ -94,10 +145,13 @@ async def offer(request):
                 {"code": -1, "msg": "reach max session"}
             ),
         )
-    sessionid = randN(6) #len(nerfreals)
+    sessionid = params.get('sessionid') #chosen by the dispatcher in front of several workers
+    if not (from_dispatcher(request) and type(sessionid) is int and sessionid > 0) or sessionid in nerfreals:
+        sessionid = randN(6) #len(nerfreals)
     logger.info('sessionid=%d',sessionid)
     nerfreals[sessionid] = None
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
+    build = session_pool.acquire if session_pool is not None else build_nerfreal
+    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build,sessionid)
     nerfreals[sessionid] = nerfreal
     
     ice_server = RTCIceServer(urls='stun:stun.l.google.com:19302')
@@ -111,10 +165,10 @@ async def offer(request):
         if pc.connectionState == "failed":
             await pc.close()
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_session(sessionid)
         if pc.connectionState == "closed":
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_session(sessionid)
             gc.collect()
 
     player = HumanPlayer(nerfreals[sessionid])
@@ -122,7 +176,8 @@ async def offer(request):
     video_sender = pc.addTrack(player.video)
     capabilities = RTCRtpSender.getCapabilities("video")
     preferences = list(filter(lambda x: x.name == "H264", capabilities.codecs))
-    preferences += list(filter(lambda x: x.name == "VP8", capabilities.codecs))
+    if not (opt.idle_packets or opt.video_encoder!='aiortc'): #packets encoded outside aiortc are h264 only
+        preferences += list(filter(lambda x: x.name == "VP8", capabilities.codecs))
     preferences += list(filter(lambda x: x.name == "rtx", capabilities.codecs))
     transceiver = pc.getTransceivers()[1]
     transceiver.setCodecPreferences(preferences)
@@ -141,6 +196,17 @@ async def offer(request):
         ),
     )
 
+def from_dispatcher(request)->bool:
+    '''request of the dispatcher.py that started this worker'''
+    token = request.headers.get('X-Dispatcher-Token', '')
+    return bool(dispatcher_token) and hmac.compare_digest(token.encode(), dispatcher_token.encode())
+
+def close_session(sessionid:int):
+    nerfreal = nerfreals.pop(sessionid, None)
+    metrics.remove_session(sessionid)
+    if nerfreal is not None and session_pool is not None:
+        asyncio.get_event_loop().run_in_executor(None, session_pool.release, nerfreal)
+
 async def human(request):
     try:
         params = await request.json()
@@ -243,15 +309,66 @@ async def record(request):
         params = await request.json()
 
         sessionid = params.get('sessionid',0)
+        path = None
         if params['type']=='start_record':
             # nerfreals[sessionid].put_msg_txt(params['text'])
-            nerfreals[sessionid].start_recording()
+            path = nerfreals[sessionid].start_recording()
         elif params['type']=='end_record':
-            nerfreals[sessionid].stop_recording()
+            #waits for the writer to finish the file
+            path = await asyncio.get_event_loop().run_in_executor(None, nerfreals[sessionid].stop_recording)
         return web.Response(
             content_type="application/json",
             text=json.dumps(
-                {"code": 0, "msg":"ok"}
+                {"code": 0, "msg":"ok", "path": path}
+            ),
+        )
+    except Exception as e:
+        logger.exception('exception:')
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg": str(e)}
+            ),
+        )
+
+async def switch_avatar(request):
+    '''
+    switch the avatar (and optionally ref_file/ref_text) of session sessionid without restarting
+    the server. without sessionid it sets them for new sessions, and with all_sessions also
+    switches every running session
+    '''
+    try:
+        params = await request.json()
+
+        avatar_id = params['avatar_id']
+        new_avatar = await asyncio.get_event_loop().run_in_executor(None, load_avatar_cached, avatar_id)
+        voice = {}
+        if params.get('ref_file'):
+            voice['REF_FILE'] = params['ref_file']
+        if params.get('ref_text'):
+            voice['REF_TEXT'] = params['ref_text']
+        if 'sessionid' in params:
+            if nerfreals.get(params['sessionid']) is None:
+                raise ValueError(f"unknown session {params['sessionid']}")
+            switched = [nerfreals[params['sessionid']]]
+            msg = "ok"
+        else:
+            session_defaults.update(voice, avatar_id=avatar_id)
+            if session_pool is not None:
+                session_pool.refresh()
+            switched = [nerfreal for nerfreal in nerfreals.values() if nerfreal is not None] if params.get('all_sessions') else []
+            msg = f"new sessions use avatar {avatar_id}, {len(switched)} running sessions switched"
+        for nerfreal in switched:
+            if voice:
+                vars(nerfreal.opt).update(voice)
+                #xtts clones the speaker over http, tencent parses the voice type
+                await asyncio.get_event_loop().run_in_executor(None, nerfreal.tts.update_voice)
+            nerfreal.switch_avatar(new_avatar)
+        logger.info('switch avatar %s session %s, %d sessions switched',avatar_id,params.get('sessionid'),len(switched))
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": 0, "msg":msg, "switched": len(switched)}
             ),
         )
     except Exception as e:
@@ -284,7 +401,11 @@ async def health_check(request):
                     "status": "healthy",
                     "service": "webrtc",
                     "sessions": len(nerfreals),
-                    "max_sessions": opt.max_session if opt else 1
+                    "sessionids": list(nerfreals),
+                    "max_sessions": opt.max_session if opt else 1,
+                    "model": opt.model if opt else None,
+                    "transport": opt.transport if opt else None,
+                    "tts": opt.tts if opt else None,
                 }
             ),
             status=200
@@ -299,6 +420,22 @@ async def health_check(request):
             status=500
         )
 
+tts_http_requests = metrics.Gauge('livetalking_tts_http_requests', 'requests sent to tts servers over the shared session')
+tts_http_connections = metrics.Gauge('livetalking_tts_http_connections', 'connections opened to tts servers')
+tts_cache_hits = metrics.Gauge('livetalking_tts_cache_hits', 'messages replayed from the tts cache')
+tts_cache_misses = metrics.Gauge('livetalking_tts_cache_misses', 'messages synthesized, not found in the tts cache')
+
+async def metrics_handler(request):
+    """counters and histograms of all sessions in the Prometheus text format"""
+    metrics.sessions.labels().set(len(nerfreals))
+    requests_sent, connections = http_pool_stats()
+    tts_http_requests.labels().set(requests_sent)
+    tts_http_connections.labels().set(connections)
+    cache = get_tts_cache(opt)
+    if cache is not None:
+        tts_cache_hits.labels().set(cache.hits)
+        tts_cache_misses.labels().set(cache.misses)
+    return web.Response(text=metrics.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
 async def on_shutdown(app):
     # close peer connections
@@ -354,8 +491,26 @@ if __name__ == '__main__':
 
     #musetalk opt
     parser.add_argument('--avatar_id', type=str, default='avator_1', help="define which avatar in data/avatars")
+    parser.add_argument('--avatar_cache_size', type=int, default=4, help="loaded avatars kept for /switch_avatar")
     #parser.add_argument('--bbox_shift', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=16, help="infer batch")
+    parser.add_argument('--max_infer_batch', type=int, default=64, help="max frames per shared musetalk infer batch across sessions")
+    parser.add_argument('--batch_deadline', type=float, default=10, help="max ms a session waits for others to join a shared infer or asr batch")
+    parser.add_argument('--shared_asr', action='store_true', help="batch the hubert asr of all ultralight sessions in one forward")
+
+    parser.add_argument('--gpu_blend', action='store_true', help="resize and blend the mouth region on the gpu")
+    parser.add_argument('--backend', type=str, default='torch', help="wav2lip and ultralight inference backend") #torch onnx
+    parser.add_argument('--onnx_threads', type=int, default=0, help="onnxruntime intra op threads, 0 for its default")
+    parser.add_argument('--onnx_cpus', type=str, default='', help="pin the onnxruntime threads to these cpus, e.g. 0-3")
+    parser.add_argument('--onnx_quantize', action='store_true', help="int8 dynamic quantization of the onnx models")
+    parser.add_argument('--stream_asr', action='store_true', help="incremental asr feature extraction over the sliding window")
+    parser.add_argument('--idle_cache', action='store_true', help="keep yuv420p copies of the idle frames shared by sessions")
+    parser.add_argument('--idle_cache_size', type=int, default=256, help="MB of yuv420p idle frames kept per avatar or custom clip")
+    parser.add_argument('--idle_packets', action='store_true', help="encode the idle loop once per avatar and send it to all idle sessions")
+    parser.add_argument('--video_encoder', type=str, default='aiortc', choices=['aiortc','thread','process'], help="where video is encoded")
+    parser.add_argument('--encoder_workers', type=int, default=2, help="encoder processes for --video_encoder process")
+    parser.add_argument('--video_bitrate', type=int, default=1000000, help="bitrate of the idle packets and own encoders")
+    parser.add_argument('--video_gop', type=int, default=25, help="keyframe interval in frames of the idle packets and own encoders")
 
     parser.add_argument('--customvideo_config', type=str, default='', help="custom action json")
 
@@ -363,6 +518,12 @@ if __name__ == '__main__':
     parser.add_argument('--REF_FILE', type=str, default="en-US-BrianNeural")
     parser.add_argument('--REF_TEXT', type=str, default=None)
     parser.add_argument('--TTS_SERVER', type=str, default='http://127.0.0.1:9880') # http://localhost:9000
+    parser.add_argument('--tts_connect_timeout', type=float, default=3, help="seconds to connect to the tts server")
+    parser.add_argument('--tts_timeout', type=float, default=30, help="seconds the tts server may stay silent within a response")
+    parser.add_argument('--tts_cache_size', type=int, default=64, help="MB of synthesized audio cached in memory for repeated sentences, 0 disables")
+    parser.add_argument('--tts_cache_dir', type=str, default='', help="also cache synthesized audio on disk in this directory")
+    parser.add_argument('--tts_cache_disk_size', type=int, default=1024, help="MB of the disk tts cache")
+    parser.add_argument('--tts_lookahead', type=int, default=0, help="queued sentences synthesized while the current one plays, 0 synthesizes one at a time")
     # parser.add_argument('--CHARACTER', type=str, default='test')
     # parser.add_argument('--EMOTION', type=str, default='default')
 
@@ -372,6 +533,11 @@ if __name__ == '__main__':
     parser.add_argument('--push_url', type=str, default='http://localhost:1985/rtc/v1/whip/?app=live&stream=livestream') #rtmp://localhost/live/livestream
 
     parser.add_argument('--max_session', type=int, default=1)  #multi session count
+    parser.add_argument('--session_pool', action='store_true', help="keep max_session sessions built and warmed for webrtc offers, reused after disconnect")
+    parser.add_argument('--track_queue_size', type=int, default=10, help="video frames buffered per webrtc track, audio gets twice as many 20ms frames")
+    parser.add_argument('--record_dir', type=str, default='data', help="recordings are written to record_dir/record_<sessionid>.mp4")
+    parser.add_argument('--record_queue_size', type=int, default=100, help="audio and video frames queued for the recording writer before dropping")
+    parser.add_argument('--track_lag_policy', type=str, default='block', choices=['block','drop'], help="when a client falls behind: block the render pipeline or drop the oldest frames")
     parser.add_argument('--listenport', type=int, default=8105, help="web listen port")
 
     opt = parser.parse_args()
@@ -381,6 +547,12 @@ if __name__ == '__main__':
     if opt.customvideo_config!='':
         with open(opt.customvideo_config,'r') as file:
             opt.customopt = json.load(file)
+    if opt.idle_packets and opt.video_encoder=='aiortc':
+        #aiortc decides keyframes itself, after the shared idle packets the session's encoder has to restart with one
+        logger.info('--idle_packets needs an own encoder, using --video_encoder thread')
+        opt.video_encoder = 'thread'
+    if opt.video_encoder=='process':
+        get_pool(opt) #workers started before the models load
 
     # if opt.model == 'ernerf':       
     #     from nerfreal import NeRFReal,load_model,load_avatar
@@ -395,21 +567,25 @@ if __name__ == '__main__':
     elif opt.model == 'wav2lip':
         from lipreal import LipReal,load_model,load_avatar,warm_up
         logger.info(opt)
-        model = load_model("./models/wav2lip.pth")
+        model = backend_model(load_model("./models/wav2lip.pth"),"./models/wav2lip.pth",opt)
         avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size,model,256)
+        warm_up(opt.batch_size,model,avatar[3].shape[-1])
     elif opt.model == 'ultralight':
         from lightreal import LightReal,load_model,load_avatar,warm_up
         logger.info(opt)
         model = load_model(opt)
-        avatar = load_avatar(opt.avatar_id)
+        avatar = load_avatar(opt.avatar_id,opt)
         warm_up(opt.batch_size,avatar,160)
+    avatars[opt.avatar_id] = avatar
 
     # if opt.transport=='rtmp':
     #     thread_quit = Event()
     #     nerfreals[0] = build_nerfreal(0)
     #     rendthrd = Thread(target=nerfreals[0].render,args=(thread_quit,))
     #     rendthrd.start()
+    if opt.session_pool and opt.transport=='webrtc':
+        session_pool = SessionPool(build_nerfreal, opt.max_session, session_defaults)
+
     if opt.transport=='virtualcam':
         thread_quit = Event()
         nerfreals[0] = build_nerfreal(0)
@@ -426,7 +602,9 @@ if __name__ == '__main__':
     appasync.router.add_post("/record", record)
     appasync.router.add_post("/interrupt_talk", interrupt_talk)
     appasync.router.add_post("/is_speaking", is_speaking)
+    appasync.router.add_post("/switch_avatar", switch_avatar)
     appasync.router.add_get("/health", health_check)  # 添加健康检查端点
+    appasync.router.add_get("/metrics", metrics_handler)
     appasync.router.add_static('/',path='web')
 
     # Configure default CORS settings.
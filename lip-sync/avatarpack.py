@@ -0,0 +1,194 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Packed avatar format: one file holding the frames, face crops, masks, coordinates
+and latents of an avatar, each array laid out contiguously and page aligned.
+Renderers memory map it, so frames are paged in on demand and shared by every
+process that opens the same avatar.
+
+layout: MAGIC | header length (uint64 le) | json header | aligned array data
+"""
+
+import os
+import glob
+import json
+import pickle
+import argparse
+
+import cv2
+import numpy as np
+
+from logger import logger
+
+PACK_FILE = 'avatar.pack'
+MAGIC = b'LTAVPK01'
+ALIGN = 4096
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+def write_pack(path, arrays, meta=None):
+    """
+    :param arrays: name -> ndarray, or list of ndarrays which is stored dense when all
+        shapes agree and ragged otherwise
+    """
+    entries = {}
+    blobs = []
+    offset = 0
+    for name, value in arrays.items():
+        if isinstance(value, np.ndarray) or len(set(v.shape for v in value)) <= 1:
+            value = np.ascontiguousarray(value if isinstance(value, np.ndarray) or not value else np.stack(value))
+            entries[name] = {'offset': offset, 'dtype': value.dtype.str, 'shape': list(value.shape)}
+            blobs.append((offset, [value]))
+            offset = _align(offset + value.nbytes)
+        else:
+            value = [np.ascontiguousarray(v) for v in value]
+            offsets = []
+            start = offset
+            for v in value:
+                offsets.append(start)
+                start += v.nbytes
+            entries[name] = {'offset': offset, 'dtype': value[0].dtype.str,
+                             'shapes': [list(v.shape) for v in value], 'offsets': offsets}
+            blobs.append((offset, value))
+            offset = _align(start)
+    header = json.dumps({'version': 1, 'meta': meta or {}, 'arrays': entries}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for start, values in blobs:
+            f.seek(data_start + start)
+            for v in values:
+                f.write(v.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+class AvatarPack:
+    """
+    Read side of the packed format. pack[name] returns a memory mapped ndarray for dense
+    entries and a list of memory mapped views for ragged ones; nothing is read until used.
+    The map is copy-on-write so in-place edits of a frame stay private to the process.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not an avatar pack')
+            header_len = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        self.path = path
+        self.meta = header['meta']
+        self.entries = header['arrays']
+        data_start = _align(len(MAGIC) + 8 + header_len)
+        self.data = np.memmap(path, dtype=np.uint8, mode='c', offset=data_start)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        entry = self.entries[name]
+        dtype = np.dtype(entry['dtype'])
+        if 'shape' in entry:
+            return self.__view(entry['offset'], dtype, entry['shape'])
+        return [self.__view(offset, dtype, shape) for offset, shape in zip(entry['offsets'], entry['shapes'])]
+
+    def __view(self, offset, dtype, shape):
+        count = int(np.prod(shape))
+        return self.data[offset:offset + count * dtype.itemsize].view(dtype).reshape(shape)
+
+def _newest_source(avatar_path):
+    """mtime of the newest file or folder of the image folder layout"""
+    newest = 0
+    for entry in os.scandir(avatar_path):
+        if entry.name.startswith(PACK_FILE):
+            continue
+        newest = max(newest, entry.stat().st_mtime)
+        if entry.is_dir():
+            for child in os.scandir(entry.path):
+                newest = max(newest, child.stat().st_mtime)
+    return newest
+
+def open_pack(avatar_path):
+    """
+    the packed avatar in avatar_path, None if the avatar only exists as image folders or
+    they were changed after packing
+    """
+    path = os.path.join(avatar_path, PACK_FILE)
+    if not os.path.isfile(path):
+        return None
+    if _newest_source(avatar_path) > os.path.getmtime(path):
+        logger.warning('%s is older than the avatar folders, not used; repack the avatar', path)
+        return None
+    return AvatarPack(path)
+
+def pack_musetalk(avatar_path, frames, masks, coords, mask_coords, latents):
+    """
+    :param latents: per frame unet input latents, ndarray or tensors [1,8,32,32]
+    """
+    from musetalk.utils.blending import get_blend_weights #builds the face parser, only needed here
+    weights = [get_blend_weights(mask, box, crop_box) for mask, box, crop_box in zip(masks, coords, mask_coords)]
+    latents = np.stack([np.asarray(latent.detach().cpu()) if hasattr(latent, 'detach') else np.asarray(latent)
+                        for latent in latents])
+    write_pack(os.path.join(avatar_path, PACK_FILE), {
+        'frames': list(frames),
+        'coords': np.asarray(coords, dtype=np.int32),
+        'mask_coords': np.asarray(mask_coords, dtype=np.int32),
+        'blend': [weight for weight, _ in weights],
+        'blend_inv': [weight_inv for _, weight_inv in weights],
+        'latents': latents,
+    }, meta={'model': 'musetalk', 'frames': len(frames)})
+
+def pack_facecrop(avatar_path, model, frames, faces, coords):
+    """wav2lip and ultralight avatars: full frames, face crops and their coordinates"""
+    write_pack(os.path.join(avatar_path, PACK_FILE), {
+        'frames': list(frames),
+        'faces': list(faces),
+        'coords': np.asarray(coords, dtype=np.int32),
+    }, meta={'model': model, 'frames': len(frames)})
+
+def _read_imgs(path):
+    img_list = glob.glob(os.path.join(path, '*.[jpJP][pnPN]*[gG]'))
+    img_list = sorted(img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+    return [cv2.imread(img_path) for img_path in img_list]
+
+def pack_avatar(avatar_path, model):
+    """pack an avatar stored in the image folder layout written by the avatar generators"""
+    with open(f"{avatar_path}/coords.pkl", 'rb') as f:
+        coords = pickle.load(f)
+    frames = _read_imgs(f"{avatar_path}/full_imgs")
+    if model == 'musetalk':
+        import torch
+        with open(f"{avatar_path}/mask_coords.pkl", 'rb') as f:
+            mask_coords = pickle.load(f)
+        masks = _read_imgs(f"{avatar_path}/mask")
+        latents = torch.load(f"{avatar_path}/latents.pt", map_location='cpu')
+        pack_musetalk(avatar_path, frames, masks, coords, mask_coords, latents)
+    else:
+        faces = _read_imgs(f"{avatar_path}/face_imgs")
+        pack_facecrop(avatar_path, model, frames, faces, coords)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avatar_id', type=str, required=True, help="avatar in data/avatars to pack")
+    parser.add_argument('--model', type=str, default='musetalk') #musetalk wav2lip ultralight
+    args = parser.parse_args()
+    pack_avatar(f"./data/avatars/{args.avatar_id}", args.model)
+    print(f"packed ./data/avatars/{args.avatar_id}/{PACK_FILE}")
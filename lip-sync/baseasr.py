@@ -25,6 +25,81 @@ import torch.multiprocessing as mp
 from basereal import BaseReal
 
 
+class AudioOutQueue:
+    """
+    The asr output of (frame,type,eventpoint), numbered in the order they are put. cancel()
+    marks every frame put so far as stale. Inference skips a batch of stale frames together
+    with its feature batch (skip_stale), so the next answer does not wait for the flushed
+    speech to play out; stale speech in a batch straddling the cancel comes out of get as
+    silence. is_stale tells the consumers further down which of the frames they hold are stale,
+    position moves their frame count past the skipped batches.
+    """
+    def __init__(self, maxsize, notify=None):
+        self.queue = Queue(maxsize)
+        self.notify = notify #eventpoints of skipped frames still reach the session
+        self.skipped = {} #get index:count of the frames skip_stale dropped there
+        self.put_count = 0
+        self.get_count = 0
+        self.stale_until = 0 #frames numbered below were put before the last cancel
+
+    def put(self, item, block=True, timeout=None):
+        self.put_count += 1 #counted while a full queue blocks, cancel covers it too
+        self.queue.put(item, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        item = self.queue.get(block, timeout)
+        index = self.get_count
+        self.get_count += 1
+        return self.silence(item) if index < self.stale_until else item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def skip_stale(self, count:int)->bool:
+        """drop the next count frames if all of them are stale, False leaves them queued"""
+        if not self.is_stale(self.get_count + count - 1):
+            return False
+        start = self.get_count
+        for _ in range(count):
+            _,_,eventpoint = self.get()
+            if eventpoint and self.notify is not None:
+                self.notify(eventpoint)
+        self.skipped[start] = count
+        return True
+
+    def position(self, index:int)->int:
+        """index of the next frame got, moved past the frames skip_stale dropped there"""
+        while index in self.skipped:
+            index += self.skipped.pop(index)
+        return index
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def cancel(self):
+        self.stale_until = self.put_count
+
+    def is_stale(self, index:int)->bool:
+        return index < self.stale_until
+
+    @staticmethod
+    def silence(item):
+        frame,type,eventpoint = item
+        if type != 0: #silence or custom audio
+            return item
+        return np.zeros_like(frame),1,eventpoint
+
+    def reset(self):
+        self.queue.queue.clear()
+        self.put_count = 0
+        self.get_count = 0
+        self.stale_until = 0
+        self.skipped.clear()
+
+
 class BaseASR:
     def __init__(self, opt, parent:BaseReal = None):
         self.opt = opt
@@ -34,7 +109,6 @@ class BaseASR:
         self.sample_rate = 16000
         self.chunk = self.sample_rate // self.fps # 320 samples per chunk (20ms * 16000 / 1000)
         self.queue = Queue()
-        self.output_queue = mp.Queue()
 
         self.batch_size = opt.batch_size
 
@@ -43,11 +117,19 @@ class BaseASR:
         self.stride_right_size = opt.r
         #self.context_size = 10
         self.feat_queue = mp.Queue(2)
+        # feature chunks of an all zero window. Idle sessions only hear silence, whose features
+        # do not depend on when it is heard, so they are extracted once and reused
+        self.silent_chunks = None
+        # audio frames run ahead of the features consumed by inference by at most the queued
+        # feature batches, the one run_step is building and the right stride
+        self.output_queue = AudioOutQueue(self.batch_size*2*4 + self.stride_left_size + self.stride_right_size,
+                                          parent.notify if parent is not None else None)
 
         #self.warm_up()
 
     def flush_talk(self):
         self.queue.queue.clear()
+        self.output_queue.cancel()
 
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
         self.queue.put((audio_chunk,eventpoint))
@@ -74,12 +156,27 @@ class BaseASR:
         return self.output_queue.get()
     
     def warm_up(self):
-        for _ in range(self.stride_left_size + self.stride_right_size):
+        #the left stride only fills the feature window, its audio is not played
+        for i in range(self.stride_left_size + self.stride_right_size):
             audio_frame,type,eventpoint=self.get_audio_frame()
             self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame,type,eventpoint))
-        for _ in range(self.stride_left_size):
-            self.output_queue.get()
+            if i >= self.stride_left_size:
+                self.output_queue.put((audio_frame,type,eventpoint))
+
+    def reset(self):
+        """back to the state after warm_up, for a session taken over by the next connection"""
+        self.queue.queue.clear()
+        while True:
+            try:
+                self.feat_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.output_queue.reset()
+        self.frames = []
+        feature_stream = getattr(self, 'feature_stream', None)
+        if feature_stream is not None:
+            feature_stream.reset()
+        self.warm_up()
 
     def run_step(self):
         pass
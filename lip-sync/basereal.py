@@ -28,7 +28,7 @@ import resampy
 
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from io import BytesIO
 import soundfile as sf
 
@@ -39,7 +39,10 @@ import av
 from fractions import Fraction
 
 from ttsreal import EdgeTTS,SovitsTTS,XTTS,CosyVoiceTTS,FishTTS,TencentTTS
+from videoenc import get_encoder,get_idle_packets,mirror_index
+from recorder import Recorder
 from logger import logger
+import metrics
 
 from tqdm import tqdm
 def read_imgs(img_list):
@@ -67,6 +70,73 @@ def play_audio(quit_event,queue):
         stream.write(queue.get(block=True))
     stream.close()
 
+class IdleFrames:
+    """
+    yuv420p copies of the frames played while silent, so idle playback skips the bgr to yuv
+    conversion here and in the encoder and leaves the avatar frames untouched. A frame is
+    converted the first time it is played and then reused by every session sharing this.
+    Copies are kept up to max_bytes; the idle loop plays the frames in a cycle, so later
+    frames are converted each time rather than evicting ones that come round again.
+    """
+    def __init__(self, frames, max_bytes:int):
+        self.frames = frames
+        self.yuv = [None]*len(frames)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, idx:int) -> VideoFrame:
+        yuv = self.yuv[idx]
+        if yuv is None:
+            image = np.array(self.frames[idx])
+            image[0,:] &= 0xFE
+            yuv = VideoFrame.from_ndarray(image, format="bgr24").reformat(format="yuv420p").to_ndarray()
+            with self.lock:
+                if self.yuv[idx] is None and self.size + yuv.nbytes <= self.max_bytes:
+                    self.yuv[idx] = yuv
+                    self.size += yuv.nbytes
+        return VideoFrame.from_ndarray(yuv, format="yuv420p")
+
+_idle_frames = {}
+_custom_idle_frames = {} #imgpath of a custom clip:IdleFrames
+
+def _even_size(frames):
+    height, width = frames[0].shape[:2]
+    return height % 2 == 0 and width % 2 == 0 #yuv420p needs even sizes
+
+def get_idle_frames(avatar, frames, max_bytes:int):
+    """idle frames of a loaded avatar, shared by all sessions rendering it"""
+    if not _even_size(frames):
+        return None
+    entry = _idle_frames.get(id(avatar))
+    if entry is None or entry[0] is not avatar:
+        entry = (avatar, IdleFrames(frames, max_bytes))
+        _idle_frames[id(avatar)] = entry
+    return entry[1]
+
+def get_custom_idle_frames(imgpath:str, frames, max_bytes:int):
+    """idle frames of a custom clip, shared by all sessions configured with it"""
+    if not _even_size(frames):
+        return None
+    idle_frames = _custom_idle_frames.get(imgpath)
+    if idle_frames is None:
+        idle_frames = _custom_idle_frames.setdefault(imgpath, IdleFrames(frames, max_bytes))
+    return idle_frames
+
+def release_idle_frames(avatar):
+    entry = _idle_frames.get(id(avatar))
+    if entry is not None and entry[0] is avatar:
+        del _idle_frames[id(avatar)]
+
+class AvatarSwitch:
+    """
+    Put in res_frame_queue by the inference thread when it starts rendering a new avatar,
+    frames queued before it still belong to the previous avatar. Only the serial travels
+    through the queue, which may pickle its items.
+    """
+    def __init__(self, serial:int):
+        self.serial = serial
+
 class BaseReal:
     def __init__(self, opt):
         self.opt = opt
@@ -90,9 +160,23 @@ class BaseReal:
         self.speaking = False
 
         self.recording = False
-        self._record_video_pipe = None
-        self._record_audio_pipe = None
-        self.width = self.height = 0
+        self._recorder = None
+
+        self._frame_buffer = None
+        self.idle_frames = None
+        self.custom_idle_frames = {}
+        self.idle_packets = None
+        self.encoder = get_encoder(opt) #None: aiortc encodes the VideoFrames
+        self._frame_count = 0 #position in the mirrored avatar loop, as the inference index
+        self._sending_idle_packets = False
+        self._audio_pos = 0 #number of the next asr output frame process_frames plays
+        self._tracks = None #(loop,audio_track,video_track) while process_frames sends to webrtc
+        self._video_resync = False #flush_talk dropped queued video, restart with a keyframe
+        self.avatar_queue = Queue() #avatars waiting for the inference thread to switch to
+        self._avatar_serial = 0
+        self._switching_avatars = {} #serial:avatar
+        self._avatar_switched = False
+        self.render_threads = [] #threads started by render besides the tts, joined by reset
 
         self.curr_state=0
         self.custom_img_cycle = {}
@@ -135,8 +219,21 @@ class BaseReal:
         return stream
 
     def flush_talk(self):
+        """
+        Stop talking now: pending messages are dropped, speech already in the asr output and
+        the rendered frames is skipped and the frames queued in the tracks are discarded.
+        """
         self.tts.flush_talk()
         self.asr.flush_talk()
+        tracks = self._tracks
+        if tracks is not None:
+            loop,audio_track,video_track = tracks
+            def flush():
+                audio_track.flush()
+                video_track.flush()
+                #only after the drain, a keyframe forced before it would be discarded with it
+                self._video_resync = True
+            loop.call_soon_threadsafe(flush)
 
     def is_speaking(self)->bool:
         return self.speaking
@@ -151,6 +248,10 @@ class BaseReal:
             self.custom_audio_index[item['audiotype']] = 0
             self.custom_index[item['audiotype']] = 0
             self.custom_opt[item['audiotype']] = item
+            if self.opt.idle_cache:
+                idle_frames = get_custom_idle_frames(item['imgpath'],self.custom_img_cycle[item['audiotype']],self.opt.idle_cache_size*1024*1024)
+                if idle_frames is not None:
+                    self.custom_idle_frames[item['audiotype']] = idle_frames
 
     def init_customindex(self):
         self.curr_state=0
@@ -164,106 +265,110 @@ class BaseReal:
 
     def start_recording(self):
         """开始录制视频"""
-        if self.recording:
-            return
-
-        command = ['ffmpeg',
-                    '-y', '-an',
-                    '-f', 'rawvideo',
-                    '-vcodec','rawvideo',
-                    '-pix_fmt', 'bgr24', #像素格式
-                    '-s', "{}x{}".format(self.width, self.height),
-                    '-r', str(25),
-                    '-i', '-',
-                    '-pix_fmt', 'yuv420p', 
-                    '-vcodec', "h264",
-                    #'-f' , 'flv',                  
-                    f'temp{self.opt.sessionid}.mp4']
-        self._record_video_pipe = subprocess.Popen(command, shell=False, stdin=subprocess.PIPE)
-
-        acommand = ['ffmpeg',
-                    '-y', '-vn',
-                    '-f', 's16le',
-                    #'-acodec','pcm_s16le',
-                    '-ac', '1',
-                    '-ar', '16000',
-                    '-i', '-',
-                    '-acodec', 'aac',
-                    #'-f' , 'wav',                  
-                    f'temp{self.opt.sessionid}.aac']
-        self._record_audio_pipe = subprocess.Popen(acommand, shell=False, stdin=subprocess.PIPE)
-
+        if self._recorder is not None:
+            return self._recorder.path
+        path = os.path.join(self.opt.record_dir, f'record_{self.sessionid}.mp4')
+        self._recorder = Recorder(path, maxsize=self.opt.record_queue_size)
         self.recording = True
-        # self.recordq_video.queue.clear()
-        # self.recordq_audio.queue.clear()
-        # self.container = av.open(path, mode="w")
-    
-        # process_thread = Thread(target=self.record_frame, args=())
-        # process_thread.start()
-    
+        return path
+
     def record_video_data(self,image):
-        if self.width == 0:
-            print("image.shape:",image.shape)
-            self.height,self.width,_ = image.shape
-        if self.recording:
-            self._record_video_pipe.stdin.write(image.tostring())
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.put_video(image)
 
     def record_audio_data(self,frame):
-        if self.recording:
-            self._record_audio_pipe.stdin.write(frame.tostring())
-    
-    # def record_frame(self): 
-    #     videostream = self.container.add_stream("libx264", rate=25)
-    #     videostream.codec_context.time_base = Fraction(1, 25)
-    #     audiostream = self.container.add_stream("aac")
-    #     audiostream.codec_context.time_base = Fraction(1, 16000)
-    #     init = True
-    #     framenum = 0       
-    #     while self.recording:
-    #         try:
-    #             videoframe = self.recordq_video.get(block=True, timeout=1)
-    #             videoframe.pts = framenum #int(round(framenum*0.04 / videostream.codec_context.time_base))
-    #             videoframe.dts = videoframe.pts
-    #             if init:
-    #                 videostream.width = videoframe.width
-    #                 videostream.height = videoframe.height
-    #                 init = False
-    #             for packet in videostream.encode(videoframe):
-    #                 self.container.mux(packet)
-    #             for k in range(2):
-    #                 audioframe = self.recordq_audio.get(block=True, timeout=1)
-    #                 audioframe.pts = int(round((framenum*2+k)*0.02 / audiostream.codec_context.time_base))
-    #                 audioframe.dts = audioframe.pts
-    #                 for packet in audiostream.encode(audioframe):
-    #                     self.container.mux(packet)
-    #             framenum += 1
-    #         except queue.Empty:
-    #             print('record queue empty,')
-    #             continue
-    #         except Exception as e:
-    #             print(e)
-    #             #break
-    #     for packet in videostream.encode(None):
-    #         self.container.mux(packet)
-    #     for packet in audiostream.encode(None):
-    #         self.container.mux(packet)
-    #     self.container.close()
-    #     self.recordq_video.queue.clear()
-    #     self.recordq_audio.queue.clear()
-    #     print('record thread stop')
-		
+        recorder = self._recorder
+        if recorder is not None:
+            recorder.put_audio(frame)
+
     def stop_recording(self):
         """停止录制视频"""
-        if not self.recording:
-            return
-        self.recording = False 
-        self._record_video_pipe.stdin.close()  #wait() 
-        self._record_video_pipe.wait()
-        self._record_audio_pipe.stdin.close()
-        self._record_audio_pipe.wait()
-        cmd_combine_audio = f"ffmpeg -y -i temp{self.opt.sessionid}.aac -i temp{self.opt.sessionid}.mp4 -c:v copy -c:a copy data/record.mp4"
-        os.system(cmd_combine_audio) 
-        #os.remove(output_path)
+        recorder = self._recorder
+        if recorder is None:
+            return None
+        self.recording = False
+        self._recorder = None
+        recorder.close()
+        return recorder.path
+
+    def switch_avatar(self,avatar):
+        """
+        Render avatar from the next inference batch on. The session keeps its connection,
+        tts and asr; the inference thread picks the avatar up between batches.
+        """
+        self._avatar_serial += 1
+        self._avatar_switched = True
+        self._switching_avatars[self._avatar_serial] = avatar
+        self.avatar_queue.put((AvatarSwitch(self._avatar_serial),)+self.get_avatar_inputs(avatar))
+
+    def reset(self,timeout:float=10)->bool:
+        """
+        Prepare a session whose connection closed for the next connection, once its render
+        threads stopped. False if they do not stop within timeout or the session switched
+        avatars; such a session is not reused.
+        """
+        if self._avatar_switched:
+            return False
+        deadline = time.perf_counter() + timeout
+        while self.render_event.is_set(): #render loop still running
+            if time.perf_counter() > deadline:
+                return False
+            time.sleep(0.05)
+        for thread in self.render_threads:
+            thread.join(max(0, deadline - time.perf_counter()))
+            if thread.is_alive():
+                return False
+        if not self.tts.reset(max(0, deadline - time.perf_counter())):
+            return False
+        self.render_threads = []
+        self.asr.reset()
+        while True:
+            try:
+                self.res_frame_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.speaking = False
+        self._frame_count = 0
+        self._sending_idle_packets = False
+        self._audio_pos = 0
+        self._video_resync = False
+        if self.encoder is not None: #closed by process_frames
+            self.encoder = get_encoder(self.opt)
+        return True
+
+    def get_avatar_inputs(self,avatar):
+        """inputs of the subclass inference thread for avatar, queued after the AvatarSwitch marker"""
+        raise NotImplementedError()
+
+    def set_avatar(self,avatar):
+        """unpack avatar into the attributes used by paste_back_frame"""
+        raise NotImplementedError()
+
+    def update_idle_frames(self,avatar):
+        self.idle_frames = None
+        if self.opt.idle_cache:
+            self.idle_frames = get_idle_frames(avatar,self.frame_list_cycle,self.opt.idle_cache_size*1024*1024)
+        self.idle_packets = None
+        if self.opt.idle_packets:
+            self.idle_packets = get_idle_packets(avatar,self.frame_list_cycle,self.opt.video_bitrate,self.opt.video_gop)
+
+    def get_frame_buffer(self,frame):
+        """
+        Reusable output frame for paste back, shaped like frame. The content is only valid
+        until the next call, process_frames consumes it before rendering the next frame.
+        """
+        if self._frame_buffer is None or self._frame_buffer.shape != frame.shape:
+            self._frame_buffer = np.empty_like(frame)
+        return self._frame_buffer
+
+    def paste_back_crop(self,crop,idx:int,box):
+        """paste a crop already resized and blended on the device into avatar frame idx at box (x1,y1,x2,y2)"""
+        x1, y1, x2, y2 = box
+        combine_frame = self.get_frame_buffer(self.frame_list_cycle[idx])
+        np.copyto(combine_frame,self.frame_list_cycle[idx])
+        combine_frame[y1:y2, x1:x2] = crop
+        return combine_frame
 
     def mirror_index(self,size, index):
         #size = len(self.coord_list_cycle)
@@ -307,11 +412,31 @@ class BaseReal:
             audio_thread = Thread(target=play_audio, args=(quit_event,audio_tmp,), daemon=True, name="pyaudio_stream")
             audio_thread.start()
         
+        if loop is not None and audio_track is not None and video_track is not None:
+            self._tracks = (loop,audio_track,video_track)
+        queue_wait = metrics.queue_wait.labels(self.sessionid)
+        paste_back = metrics.paste_back.labels(self.sessionid)
         while not quit_event.is_set():
+            t = time.perf_counter()
             try:
                 res_frame,idx,audio_frames = self.res_frame_queue.get(block=True, timeout=1)
             except queue.Empty:
                 continue
+            queue_wait.observe(time.perf_counter() - t)
+            if isinstance(res_frame,AvatarSwitch):
+                self.set_avatar(self._switching_avatars.pop(res_frame.serial))
+                self._frame_count = 0
+                continue
+            self._audio_pos = self.asr.output_queue.position(self._audio_pos) #skipped by inference
+            if self.asr.output_queue.is_stale(self._audio_pos + len(audio_frames) - 1): #rendered before flush_talk
+                self._audio_pos += len(audio_frames)
+                for _,_,eventpoint in audio_frames:
+                    if eventpoint:
+                        self.notify(eventpoint)
+                continue
+            self._audio_pos += len(audio_frames)
+            loop_pos = self._frame_count
+            self._frame_count += 1
             
             if enable_transition:
                 # 检测状态变化
@@ -321,6 +446,8 @@ class BaseReal:
                     _transition_start = time.time()
                 _last_speaking = current_speaking
 
+            idle_frame = None #(IdleFrames,index) of a silent frame that needs no compositing
+            idle_pos = None #loop position of a silent avatar frame, for the idle packets
             if audio_frames[0][1]!=0 and audio_frames[1][1]!=0: #全为静音数据，只需要取fullimg
                 self.speaking = False
                 audiotype = audio_frames[0][1]
@@ -328,8 +455,14 @@ class BaseReal:
                     mirindex = self.mirror_index(len(self.custom_img_cycle[audiotype]),self.custom_index[audiotype])
                     target_frame = self.custom_img_cycle[audiotype][mirindex]
                     self.custom_index[audiotype] += 1
+                    if audiotype in self.custom_idle_frames:
+                        idle_frame = (self.custom_idle_frames[audiotype],mirindex)
                 else:
                     target_frame = self.frame_list_cycle[idx]
+                    if self.idle_frames is not None:
+                        idle_frame = (self.idle_frames,idx)
+                    if mirror_index(len(self.frame_list_cycle),loop_pos) == idx:
+                        idle_pos = loop_pos
                 
                 if enable_transition:
                     # 说话→静音过渡
@@ -340,15 +473,19 @@ class BaseReal:
                         combine_frame = target_frame
                     # 缓存静音帧
                     _last_silent_frame = combine_frame.copy()
+                    idle_frame = None
+                    idle_pos = None
                 else:
                     combine_frame = target_frame
             else:
                 self.speaking = True
+                t = time.perf_counter()
                 try:
                     current_frame = self.paste_back_frame(res_frame,idx)
                 except Exception as e:
                     logger.warning(f"paste_back_frame error: {e}")
                     continue
+                paste_back.observe(time.perf_counter() - t)
                 if enable_transition:
                     # 静音→说话过渡
                     if time.time() - _transition_start < _transition_duration and _last_silent_frame is not None:
@@ -367,10 +504,30 @@ class BaseReal:
                     vircam = pyvirtualcam.Camera(width=width, height=height, fps=25, fmt=pyvirtualcam.PixelFormat.BGR,print_fps=True)
                 vircam.send(combine_frame)
             else: #webrtc
-                image = combine_frame
-                image[0,:] &= 0xFE
-                new_frame = VideoFrame.from_ndarray(image, format="bgr24")
-                asyncio.run_coroutine_threadsafe(video_track._queue.put((new_frame,None)), loop)
+                packet = None
+                resync = self._video_resync #read once, flush_talk sets it from the event loop
+                if idle_pos is not None and self.idle_packets is not None:
+                    packet = self.idle_packets.get(idle_pos,resume=self._sending_idle_packets and not resync)
+                if packet is not None:
+                    items = [packet]
+                else:
+                    if idle_frame is not None:
+                        new_frame = idle_frame[0].get(idle_frame[1])
+                    else:
+                        image = combine_frame
+                        image[0,:] &= 0xFE
+                        new_frame = VideoFrame.from_ndarray(image, format="bgr24")
+                    # the client decoded shared idle packets, the own encoder has to restart with a keyframe
+                    keyframe = self._sending_idle_packets or resync
+                    if self.encoder is not None:
+                        items = self.encoder.encode(new_frame,keyframe)
+                    else: #aiortc encodes, idle packets always come with an own encoder
+                        items = [new_frame]
+                self._sending_idle_packets = packet is not None
+                if resync: #either an idle keyframe or a forced one
+                    self._video_resync = False
+                for item in items:
+                    video_track.put_frame_threadsafe((item,None), loop, quit_event)
             self.record_video_data(combine_frame)
 
             for audio_frame in audio_frames:
@@ -383,13 +540,23 @@ class BaseReal:
                     new_frame = AudioFrame(format='s16', layout='mono', samples=frame.shape[0])
                     new_frame.planes[0].update(frame.tobytes())
                     new_frame.sample_rate=16000
-                    asyncio.run_coroutine_threadsafe(audio_track._queue.put((new_frame,eventpoint)), loop)
+                    audio_track.put_frame_threadsafe((new_frame,eventpoint), loop, quit_event)
                 self.record_audio_data(frame)
             if self.opt.transport=='virtualcam':
                 vircam.sleep_until_next_frame()
+        self._tracks = None
         if self.opt.transport=='virtualcam':
             audio_thread.join()
             vircam.close()
+        if self.encoder is not None:
+            self.encoder.close()
+        self.stop_recording()
+        # the inference thread may be blocked on the full res_frame_queue, keep taking frames until it stopped
+        while True:
+            try:
+                self.res_frame_queue.get(block=True, timeout=1)
+            except queue.Empty:
+                break
         logger.info('basereal process_frames thread stop') 
     
     # def process_custom(self,audiotype:int,idx:int):
@@ -0,0 +1,419 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Offline benchmark of the render pipeline, no gpu, checkpoints, tts server or client needed.
+Real LipReal, MuseReal or LightReal sessions (--pipeline) are driven end to end on a
+synthetic avatar:
+  stub tts -> BaseASR.run_step -> inference -> process_frames -> fake tracks
+with stub models returning the reference face, or for wav2lip a randomly initialized one.
+The stub audio feature extractors skip whisper and hubert but keep the feature shapes; musetalk
+still needs the face parsing weights in models/ to import its blending. For 1..N concurrent sessions it reports per stage latency percentiles, video frames/s, queue
+depths and cpu per session.
+
+    python benchmark.py --sessions 4 --duration 20
+    python benchmark.py --sessions 2 --model random --realtime --video_encoder thread
+    python benchmark.py --pipeline musetalk --batch_size 8
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from musetalk.whisper.audio2feature import Audio2Feature as WhisperFeature
+from ttsreal import BaseTTS
+from ultralight.audio2feature import Audio2Feature as HubertFeature
+
+class Stats:
+    """durations in seconds and samples per metric name, shared by the instrumented stages"""
+    def __init__(self):
+        self.values = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, name, value):
+        with self.lock:
+            self.values[name].append(value)
+
+    def timed(self, name, func):
+        """func recording its wall time as name and the cpu time of its thread as name_cpu"""
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - t)
+                self.add(name + '_cpu', time.thread_time() - cpu)
+        return wrapper
+
+    def summary(self, name, scale=1000.):
+        values = np.asarray(self.values.get(name, []), dtype=np.float64) * scale
+        if len(values) == 0:
+            return None
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'n': len(values), 'mean': values.mean(), 'p50': p50, 'p95': p95, 'p99': p99, 'max': values.max()}
+
+class StubWav2Lip(torch.nn.Module):
+    """wav2lip shaped stub, the reference half of the face input as prediction"""
+    def forward(self, mel_batch, img_batch):
+        return img_batch[:, 3:] + mel_batch.mean() * 0
+
+class StubUNet(torch.nn.Module):
+    """musetalk unet shaped stub, the reference latents as prediction"""
+    dtype = torch.float32
+
+    def forward(self, latent_batch, timesteps, encoder_hidden_states):
+        return SimpleNamespace(sample=latent_batch[:, 4:] + encoder_hidden_states.mean() * 0)
+
+class StubVae:
+    """musetalk vae shaped stub, latents upsampled to 256x256 faces"""
+    def decode_latents_tensor(self, latents):
+        image = torch.nn.functional.interpolate(latents[:, :3].float(), size=(256, 256), mode='nearest')
+        return torch.sigmoid(image) * 255
+
+    def decode_latents(self, latents):
+        return self.decode_latents_tensor(latents).permute(0, 2, 3, 1).round().to(torch.uint8).cpu().numpy()
+
+class StubWhisper(WhisperFeature):
+    """whisper features without the model, 50 frames of [5, 384] per second of 16k audio"""
+    def __init__(self):
+        pass
+
+    def audio2feat(self, audio):
+        level = audio[:len(audio) // 320 * 320].reshape(-1, 320).std(axis=1)
+        return np.broadcast_to(level[:, np.newaxis, np.newaxis], (len(level), 5, 384)).astype(np.float32)
+
+class StubHubert(HubertFeature):
+    """hubert features without the model, 50 frames of [1024] per second of 16k audio"""
+    def __init__(self):
+        pass
+
+    def get_hubert_from_16k_speech(self, speech, encode=None):
+        frames = (len(speech) - 80) // 320
+        level = speech[:frames * 320].reshape(frames, 320).std(axis=1)
+        return torch.from_numpy(np.broadcast_to(level[:, np.newaxis], (frames, 1024)).astype(np.float32))
+
+class StubUltralight(torch.nn.Module):
+    """ultralight unet shaped stub, the reference face as prediction"""
+    def forward(self, img_batch, mel_batch):
+        return img_batch[:, :3] + mel_batch.mean() * 0
+
+class TimedScheduler:
+    """a session's view of the shared musetalk InferScheduler, its infer calls timed"""
+    def __init__(self, scheduler, stats):
+        self.scheduler = scheduler
+        self.infer = stats.timed('inference', scheduler.infer)
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler, name)
+
+class StubTTS(BaseTTS):
+    """
+    Speaks every message as utterance seconds of a tone, streamed at real time like the
+    http backends. The start event carries the time the text was queued.
+    """
+    def txt_to_audio(self, msg):
+        text, textevent = msg
+        t = np.arange(int(self.opt.utterance * self.sample_rate)) / self.sample_rate
+        stream = (0.3 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 3 * t)) / 2).astype(np.float32)
+        frames, _ = self.split_frames(stream, np.zeros(0, np.float32))
+        start = time.perf_counter()
+        for i, frame in enumerate(frames):
+            if self.stopped():
+                return
+            delay = start + i * self.chunk / self.sample_rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            eventpoint = {'status': 'start', 'text': text, 'msgevent': textevent} if i == 0 else None
+            self.put_audio_frame(frame, eventpoint)
+        eventpoint = {'status': 'end', 'text': text, 'msgevent': textevent}
+        self.put_audio_frame(np.zeros(self.chunk, np.float32), eventpoint)
+
+class FakeTrack:
+    """
+    Stands in for PlayerStreamTrack. In real time mode it takes frames at the track's rate
+    like a client, which paces the pipeline; otherwise as fast as they are produced.
+    """
+    def __init__(self, kind, stats, realtime, period):
+        self.kind = kind
+        self.stats = stats
+        self.realtime = realtime
+        self.period = period
+        self.count = 0
+        self.start = None
+        self.last = None
+
+    def put_frame_threadsafe(self, item, loop, quit_event) -> bool:
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        if self.realtime:
+            delay = self.start + self.count * self.period - now
+            if delay > 0:
+                time.sleep(delay)
+                now = time.perf_counter()
+        if self.last is not None and self.kind == 'video':
+            self.stats.add('video_interval', now - self.last)
+        self.last = now
+        self.count += 1
+        frame, eventpoint = item
+        if eventpoint and eventpoint.get('status') == 'start':
+            msgevent = eventpoint.get('msgevent') or {}
+            if 'queued' in msgevent:
+                self.stats.add('text_to_audio_out', now - msgevent['queued'])
+        return True
+
+def make_frames(frames, height, width):
+    base = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    return [np.ascontiguousarray(np.broadcast_to(base + i, (height, width, 3)).astype(np.uint8)) for i in range(frames)]
+
+def face_box(height, width, size):
+    """(y1,y2,x1,x2) of a square of at most size in the middle of the frame"""
+    box = min(height, width, size)
+    y1, x1 = (height - box) // 2, (width - box) // 2
+    return y1, y1 + box, x1, x1 + box
+
+def make_avatar(frames, height, width, face):
+    """lipreal avatar tuple of synthetic frames with the face box in the middle"""
+    from lipreal import face_tensors
+    rng = np.random.default_rng(0)
+    frame_list = make_frames(frames, height, width)
+    face_list = [rng.integers(0, 255, (face, face, 3), dtype=np.uint8) for _ in range(frames)]
+    coords = [face_box(height, width, face * 3 // 2)] * frames
+    return frame_list, face_list, coords, face_tensors(face_list)
+
+def make_muse_avatar(frames, height, width, face):
+    """musereal avatar tuple: frames, blend weights, face and mask crop boxes, latents"""
+    import lipreal
+    from musetalk.utils.blending import get_blend_weights
+    rng = np.random.default_rng(0)
+    y1, y2, x1, x2 = face_box(height, width, face)
+    pad = (y2 - y1) // 4
+    bbox = (x1, y1, x2, y2)
+    crop_box = (max(0, x1 - pad), max(0, y1 - pad), min(width, x2 + pad), min(height, y2 + pad))
+    masks = [rng.integers(0, 255, (crop_box[3] - crop_box[1], crop_box[2] - crop_box[0], 3), dtype=np.uint8) for _ in range(frames)]
+    latents = [torch.randn(1, 8, 32, 32, device=lipreal.device) for _ in range(frames)]
+    return (make_frames(frames, height, width), [get_blend_weights(mask, bbox, crop_box) for mask in masks],
+            [bbox] * frames, [crop_box] * frames, latents)
+
+def make_light_avatar(frames, height, width, face):
+    """lightreal avatar tuple: its stub model, frames, 168x168 face crops, face boxes, face tensors"""
+    import lipreal
+    from lightreal import face_tensors
+    rng = np.random.default_rng(0)
+    face_list = [rng.integers(0, 255, (168, 168, 3), dtype=np.uint8) for _ in range(frames)]
+    y1, y2, x1, x2 = face_box(height, width, face)
+    model = StubUltralight().to(lipreal.device).eval()
+    return model, make_frames(frames, height, width), face_list, [(x1, y1, x2, y2)] * frames, face_tensors(face_list)
+
+def load(args):
+    """model and avatar of args.pipeline, warmed up"""
+    import lipreal
+    width, height = map(int, args.size.split('x'))
+    if args.pipeline == 'musetalk':
+        import musereal
+        device = torch.device(lipreal.device)
+        model = (StubVae(), SimpleNamespace(model=StubUNet().to(device).eval(), device=device), torch.nn.Identity(),
+                 torch.tensor([0], device=device), StubWhisper())
+        avatar = make_muse_avatar(args.frames, height, width, args.face)
+        musereal.warm_up(args.batch_size, model)
+        return model, avatar
+    if args.pipeline == 'ultralight':
+        import lightreal
+        avatar = make_light_avatar(args.frames, height, width, args.face)
+        lightreal.warm_up(args.batch_size, avatar, 160)
+        return StubHubert(), avatar
+    if args.model == 'random':
+        from wav2lip.models import Wav2Lip
+        torch.manual_seed(0)
+        model = Wav2Lip().to(lipreal.device).eval()
+    else:
+        model = StubWav2Lip().to(lipreal.device).eval()
+    if args.backend == 'onnx':
+        from onnxmodel import OnnxModel
+        checkpoint = os.path.join(tempfile.mkdtemp(prefix='benchmark'), f'wav2lip_{args.model}.pth')
+        torch.save(model.state_dict(), checkpoint) #exported next to it
+        model = OnnxModel(model, checkpoint)
+    avatar = make_avatar(args.frames, height, width, args.face)
+    lipreal.warm_up(args.batch_size, model, args.face)
+    return model, avatar
+
+def new_session(args, sessionid, model, avatar, stats):
+    """a session of args.pipeline with its batch inference timed as 'inference'"""
+    if args.pipeline == 'musetalk':
+        from musereal import MuseReal
+        real = MuseReal(session_opt(args, sessionid), model, avatar)
+        real.scheduler = TimedScheduler(real.scheduler, stats)
+        return real
+    if args.pipeline == 'ultralight':
+        from lightreal import LightReal
+        return LightReal(session_opt(args, sessionid), model, (stats.timed('inference', avatar[0]),) + avatar[1:])
+    from lipreal import LipReal
+    return LipReal(session_opt(args, sessionid), stats.timed('inference', model), avatar)
+
+def session_opt(args, sessionid):
+    """opt of an app session, the options the pipeline reads at app.py defaults"""
+    opt = argparse.Namespace(
+        fps=50, l=10, m=8, r=10, W=450, H=450, batch_size=args.batch_size, max_infer_batch=64, batch_deadline=10,
+        shared_asr=False, gpu_blend=False, backend=args.backend, onnx_threads=0, onnx_cpus='', onnx_quantize=False,
+        stream_asr=args.stream_asr, idle_cache=args.idle_cache, idle_cache_size=256, idle_packets=False, video_encoder=args.video_encoder,
+        encoder_workers=2, video_bitrate=1000000, video_gop=25, customopt=[], tts='edgetts', REF_FILE='', REF_TEXT=None,
+        TTS_SERVER='', tts_connect_timeout=3, tts_timeout=30, tts_cache_size=0, tts_cache_dir='', tts_cache_disk_size=0,
+        tts_lookahead=0, model='wav2lip', transport='webrtc', max_session=args.sessions, track_queue_size=10,
+        record_dir='data', record_queue_size=100, track_lag_policy='block', utterance=args.utterance)
+    opt.sessionid = sessionid
+    return opt
+
+def thread_cpu(native_ids):
+    """cpu seconds of the given threads of this process, None where /proc is not available"""
+    total = 0.
+    tick = os.sysconf('SC_CLK_TCK')
+    for tid in native_ids:
+        try:
+            with open(f'/proc/self/task/{tid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        total += (int(fields[11]) + int(fields[12])) / tick
+    return total
+
+def run(args, sessions, model, avatar):
+    stats = Stats()
+    quit_event = threading.Event()
+    reals = []
+    tracks = []
+    cpu_threads = []
+    for i in range(sessions):
+        known = {t.native_id for t in threading.enumerate()}
+        real = new_session(args, i, model, avatar, stats)
+        real.tts = StubTTS(real.opt, real)
+        real.asr.run_step = stats.timed('asr_step', real.asr.run_step)
+        real.paste_back_frame = stats.timed('paste_back', real.paste_back_frame)
+        audio_track = FakeTrack('audio', stats, args.realtime, 0.02)
+        video_track = FakeTrack('video', stats, args.realtime, 0.04)
+        threading.Thread(target=real.render, args=(quit_event, None, audio_track, video_track), daemon=True).start()
+        time.sleep(0.2)
+        cpu_threads.append([t.native_id for t in threading.enumerate() if t.native_id not in known])
+        reals.append(real)
+        tracks.append((audio_track, video_track))
+
+    def talk():
+        while not quit_event.is_set():
+            for real in reals:
+                if real.tts.msgqueue.empty():
+                    real.put_msg_txt('benchmark', {'queued': time.perf_counter()})
+            quit_event.wait(args.utterance + args.pause)
+
+    def sample_queues():
+        while not quit_event.wait(0.1):
+            for real in reals:
+                stats.add('q_tts_audio', real.asr.queue.qsize())
+                stats.add('q_feat', real.asr.feat_queue.qsize())
+                stats.add('q_asr_out', real.asr.output_queue.qsize())
+                stats.add('q_res_frame', real.res_frame_queue.qsize())
+
+    threading.Thread(target=talk, daemon=True).start()
+    threading.Thread(target=sample_queues, daemon=True).start()
+    time.sleep(args.warmup)
+    for name in list(stats.values):
+        stats.values[name] = []
+    counts = [video.count for _, video in tracks]
+    cpu_start = [thread_cpu(ids) for ids in cpu_threads]
+    process_start = time.process_time()
+    t = time.perf_counter()
+    time.sleep(args.duration)
+    elapsed = time.perf_counter() - t
+    counts = [video.count - count for (_, video), count in zip(tracks, counts)]
+    cpu = [None if start is None else thread_cpu(ids) - start for ids, start in zip(cpu_threads, cpu_start)]
+    process_cpu = time.process_time() - process_start
+    quit_event.set()
+    time.sleep(1.5)
+
+    report = {
+        'sessions': sessions,
+        'fps_per_session': [count / elapsed for count in counts],
+        'fps_total': sum(counts) / elapsed,
+        'cpu_per_session': [None if c is None else c / elapsed for c in cpu],
+        'cpu_process': process_cpu / elapsed,
+        'stages_ms': {name: stats.summary(name) for name in
+                      ('asr_step', 'asr_step_cpu', 'inference', 'inference_cpu', 'paste_back', 'paste_back_cpu',
+                       'video_interval', 'text_to_audio_out')},
+        'queues': {name: stats.summary(name, 1.) for name in ('q_tts_audio', 'q_feat', 'q_asr_out', 'q_res_frame')},
+    }
+    return report
+
+def print_report(report):
+    cpu = [c for c in report['cpu_per_session'] if c is not None]
+    print(f"\n== {report['sessions']} session(s): {report['fps_total']:.1f} video fps total, "
+          f"{min(report['fps_per_session']):.1f}..{max(report['fps_per_session']):.1f} per session, "
+          f"cpu {report['cpu_process']*100:.0f}% process"
+          + (f", {np.mean(cpu)*100:.0f}% per session" if cpu else ''))
+    print(f"{'stage (ms)':<20}{'n':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, s in report['stages_ms'].items():
+        if s is not None:
+            print(f"{name:<20}{s['n']:>7}{s['mean']:>9.2f}{s['p50']:>9.2f}{s['p95']:>9.2f}{s['p99']:>9.2f}{s['max']:>9.2f}")
+    print(f"{'queue depth':<20}{'n':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, s in report['queues'].items():
+        if s is not None:
+            print(f"{name:<20}{s['n']:>7}{s['mean']:>9.2f}{s['p50']:>9.0f}{s['p95']:>9.0f}{s['p99']:>9.0f}{s['max']:>9.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=1, help="run with 1..sessions concurrent sessions")
+    parser.add_argument('--duration', type=float, default=10, help="measured seconds per run")
+    parser.add_argument('--warmup', type=float, default=3, help="seconds run before measuring")
+    parser.add_argument('--pipeline', type=str, default='wav2lip', choices=['wav2lip', 'musetalk', 'ultralight'], help="session class driven, as app.py --model")
+    parser.add_argument('--model', type=str, default='stub', help="stub or random, a randomly initialized wav2lip")
+    parser.add_argument('--backend', type=str, default='torch', help="torch or onnx, as app.py --backend")
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--frames', type=int, default=50, help="frames of the synthetic avatar")
+    parser.add_argument('--size', type=str, default='450x450', help="avatar frame size WxH")
+    parser.add_argument('--face', type=int, default=256, help="face crop size of the wav2lip model, face box size of the others")
+    parser.add_argument('--utterance', type=float, default=4, help="seconds of speech per stub tts message")
+    parser.add_argument('--pause', type=float, default=1, help="silent seconds between messages")
+    parser.add_argument('--realtime', action='store_true', help="tracks take frames at 25fps like a client instead of as fast as possible")
+    parser.add_argument('--stream_asr', action='store_true')
+    parser.add_argument('--idle_cache', action='store_true')
+    parser.add_argument('--video_encoder', type=str, default='aiortc', help="aiortc (no encoding here), thread or process")
+    parser.add_argument('--json', type=str, default='', help="also write the reports to this file")
+    args = parser.parse_args()
+    if args.pipeline != 'wav2lip' and (args.stream_asr or args.model != 'stub' or args.backend != 'torch'):
+        parser.error('--stream_asr, --model and --backend apply to the wav2lip pipeline only')
+    if args.video_encoder == 'process':
+        from videoenc import get_pool
+        get_pool(session_opt(args, 0)) #workers started as in app.py, before the sessions
+
+    model, avatar = load(args)
+    reports = []
+    for sessions in range(1, args.sessions + 1):
+        report = run(args, sessions, model, avatar)
+        print_report(report)
+        reports.append(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=1)
+
+if __name__ == '__main__':
+    main()
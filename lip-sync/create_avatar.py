@@ -373,6 +373,15 @@ def create_avatar(video_path, avatar_name, burr=False):
             print("Avatar file movement failed")
             return False
         print("Avatar file movement successful")
+
+        # Pack avatar so renderers can memory map it, the image folders stay usable without it
+        print("Starting avatar packing...")
+        try:
+            from avatarpack import pack_avatar
+            pack_avatar(os.path.join(LIVEAVADIR, avatar_name), "musetalk")
+            print("Avatar packing successful")
+        except Exception as e:
+            print(f"Avatar packing failed, keeping image folders: {e}")
         
         # 5. Get avatar image
         print("Starting avatar image retrieval...")
@@ -0,0 +1,288 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Front process sharding webrtc sessions over several app.py workers, each with its own model
+copy on its own gpu or cpu group. /offer places a new session on the least loaded worker,
+the other api calls are routed to the worker holding their sessionid.
+
+    python dispatcher.py --gpus 0,1 --listenport 8010 --model wav2lip --avatar_id wav2lip256_avatar1 --max_session 4
+
+Arguments not known to the dispatcher are passed to every worker.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+from typing import Dict, List
+
+import aiohttp
+import aiohttp_cors
+from aiohttp import web
+
+import metrics
+from logger import logger
+
+worker_up = metrics.Gauge('livetalking_worker_up', 'worker answering its health check', ('worker',))
+worker_sessions = metrics.Gauge('livetalking_worker_sessions', 'sessions placed on the worker', ('worker',))
+
+def parse_cpus(group:str)->set:
+    '''"0-3,8" -> {0,1,2,3,8}'''
+    cpus = set()
+    for part in group.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+class Worker:
+    def __init__(self, index:int, port:int, app_args:List[str], token:str, gpu:str=None, cpus:set=None):
+        self.index = index
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        self.app_args = app_args
+        self.token = token #workers take a sessionid in /offer only along with it
+        self.gpu = gpu
+        self.cpus = cpus
+        self.process = None
+        self.healthy = False
+        self.max_sessions = 1
+        self.sessions = set() #sessionids reported by the worker
+        self.pending = set() #sessionids of offers in flight
+
+    def start(self):
+        env = dict(os.environ)
+        env['LIVETALKING_DISPATCHER_TOKEN'] = self.token
+        if self.gpu is not None:
+            env['CUDA_VISIBLE_DEVICES'] = self.gpu
+        preexec_fn = (lambda: os.sched_setaffinity(0, self.cpus)) if self.cpus else None
+        self.process = subprocess.Popen([sys.executable, 'app.py', *self.app_args, '--listenport', str(self.port)],
+                                        env=env, preexec_fn=preexec_fn)
+        self.healthy = False
+        self.sessions = set()
+        logger.info('worker %d pid %d port %d gpu %s cpus %s', self.index, self.process.pid, self.port, self.gpu, self.cpus)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    @property
+    def load(self)->int:
+        return len(self.sessions | self.pending)
+
+class Dispatcher:
+    def __init__(self, workers:List[Worker], health_interval:float):
+        self.workers = workers
+        self.health_interval = health_interval
+        self.routes:Dict[int, Worker] = {} #sessionid:worker
+        self.session:aiohttp.ClientSession = None
+
+    async def start(self, app):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        for worker in self.workers:
+            worker.start()
+        app['health'] = asyncio.create_task(self.watch())
+
+    async def stop(self, app):
+        app['health'].cancel()
+        await self.session.close()
+        for worker in self.workers:
+            worker.stop()
+
+    async def watch(self):
+        while True:
+            await asyncio.gather(*(self.check(worker) for worker in self.workers))
+            await asyncio.sleep(self.health_interval)
+
+    async def check(self, worker:Worker):
+        if worker.process.poll() is not None:
+            logger.error('worker %d exited with %s, restarting', worker.index, worker.process.returncode)
+            self.drop_routes(worker, set())
+            worker.start()
+        try:
+            async with self.session.get(worker.url + '/health', timeout=aiohttp.ClientTimeout(total=self.health_interval)) as response:
+                health = await response.json()
+            worker.max_sessions = health['max_sessions']
+            worker.sessions = set(health.get('sessionids', []))
+            worker.healthy = True
+            self.drop_routes(worker, worker.sessions | worker.pending)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError):
+            worker.healthy = False
+        worker_up.labels(worker.index).set(int(worker.healthy))
+        worker_sessions.labels(worker.index).set(worker.load)
+
+    def drop_routes(self, worker:Worker, alive:set):
+        for sessionid, routed in list(self.routes.items()):
+            if routed is worker and sessionid not in alive:
+                del self.routes[sessionid]
+
+    def place(self)->Worker:
+        """the healthy worker with the lowest share of its sessions in use, None if all are full"""
+        free = [worker for worker in self.workers if worker.healthy and worker.load < worker.max_sessions]
+        if not free:
+            return None
+        return min(free, key=lambda worker: (worker.load / worker.max_sessions, worker.load))
+
+    def new_sessionid(self)->int:
+        while True:
+            sessionid = random.randint(100000, 999999)
+            if sessionid not in self.routes:
+                return sessionid
+
+    async def offer(self, request):
+        params = await request.json()
+        worker = self.place()
+        if worker is None:
+            logger.info('reach max session on all workers')
+            return web.json_response({"code": -1, "msg": "reach max session"})
+        sessionid = self.new_sessionid()
+        params['sessionid'] = sessionid
+        worker.pending.add(sessionid)
+        self.routes[sessionid] = worker
+        try:
+            async with self.session.post(worker.url + '/offer', json=params,
+                                         headers={'X-Dispatcher-Token': worker.token}) as response:
+                body = await response.read()
+                status = response.status
+            answer = json.loads(body)
+            if 'sessionid' in answer:
+                self.routes.pop(sessionid, None)
+                sessionid = answer['sessionid']
+                self.routes[sessionid] = worker
+                worker.sessions.add(sessionid)
+            else:
+                self.routes.pop(sessionid, None)
+        except (aiohttp.ClientError, ValueError) as e:
+            self.routes.pop(sessionid, None)
+            logger.exception('offer to worker %d', worker.index)
+            return web.json_response({"code": -1, "msg": str(e)})
+        finally:
+            worker.pending.discard(params['sessionid'])
+        logger.info('session %s on worker %d', answer.get('sessionid'), worker.index)
+        return web.Response(body=body, status=status, content_type='application/json')
+
+    async def forward(self, request):
+        """pass the call to the worker of its sessionid; switch_avatar without one goes to all workers"""
+        if request.content_type.startswith('multipart/'):
+            form = await request.post()
+            try:
+                sessionid = int(form.get('sessionid', 0))
+            except (TypeError, ValueError):
+                return web.json_response({"code": -1, "msg": f"invalid sessionid {form.get('sessionid')}"})
+            data = aiohttp.FormData()
+            for name, value in form.items():
+                if isinstance(value, web.FileField):
+                    data.add_field(name, value.file, filename=value.filename, content_type=value.content_type)
+                else:
+                    data.add_field(name, value)
+            kwargs = {'data': data}
+        else:
+            params = await request.json()
+            if request.path == '/switch_avatar' and 'sessionid' not in params:
+                return await self.broadcast(request.path, params)
+            sessionid = params.get('sessionid', 0)
+            kwargs = {'json': params}
+        worker = self.routes.get(sessionid)
+        if worker is None:
+            return web.json_response({"code": -1, "msg": f"unknown session {sessionid}"})
+        try:
+            async with self.session.post(worker.url + request.path, **kwargs) as response:
+                return web.Response(body=await response.read(), status=response.status, content_type=response.content_type)
+        except aiohttp.ClientError as e:
+            logger.exception('forward %s to worker %d', request.path, worker.index)
+            return web.json_response({"code": -1, "msg": str(e)})
+
+    async def broadcast(self, path, params):
+        results = []
+        for worker in self.workers:
+            try:
+                async with self.session.post(worker.url + path, json=params) as response:
+                    results.append(await response.json())
+            except (aiohttp.ClientError, ValueError) as e:
+                results.append({"code": -1, "msg": f"worker {worker.index}: {e}"})
+        failed = [result for result in results if result.get('code') != 0]
+        return web.json_response(failed[0] if failed else {"code": 0, "msg": "ok"})
+
+    async def health(self, request):
+        return web.json_response({
+            "status": "healthy" if any(worker.healthy for worker in self.workers) else "starting",
+            "service": "dispatcher",
+            "sessions": sum(len(worker.sessions) for worker in self.workers),
+            "max_sessions": sum(worker.max_sessions for worker in self.workers if worker.healthy),
+            "workers": [{"worker": worker.index, "healthy": worker.healthy, "sessions": worker.load,
+                         "max_sessions": worker.max_sessions} for worker in self.workers],
+        })
+
+    async def metrics(self, request):
+        """worker placement only, each worker serves its pipeline metrics on its own port"""
+        return web.Response(text=metrics.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listenport', type=int, default=8010, help="web listen port of the dispatcher")
+    parser.add_argument('--workers', type=int, default=0, help="worker processes, defaults to one per --gpus or --cpu_groups entry")
+    parser.add_argument('--gpus', type=str, default='', help="comma separated gpu of each worker, e.g. 0,1")
+    parser.add_argument('--cpu_groups', type=str, default='', help="semicolon separated cpus each worker is pinned to, e.g. 0-7;8-15")
+    parser.add_argument('--worker_port', type=int, default=8110, help="listen port of the first worker, the others follow")
+    parser.add_argument('--health_interval', type=float, default=2, help="seconds between worker health checks")
+    opt, app_args = parser.parse_known_args()
+
+    gpus = [gpu for gpu in opt.gpus.split(',') if gpu]
+    cpu_groups = [parse_cpus(group) for group in opt.cpu_groups.split(';') if group]
+    count = opt.workers or max(len(gpus), len(cpu_groups), 1)
+    token = secrets.token_hex(16)
+    workers = [Worker(i, opt.worker_port + i, app_args, token,
+                      gpus[i % len(gpus)] if gpus else None,
+                      cpu_groups[i % len(cpu_groups)] if cpu_groups else None) for i in range(count)]
+    dispatcher = Dispatcher(workers, opt.health_interval)
+
+    appasync = web.Application(client_max_size=1024**2*100)
+    appasync.on_startup.append(dispatcher.start)
+    appasync.on_shutdown.append(dispatcher.stop)
+    appasync.router.add_post("/offer", dispatcher.offer)
+    for path in ("/human", "/humanaudio", "/set_audiotype", "/record", "/interrupt_talk", "/is_speaking", "/switch_avatar"):
+        appasync.router.add_post(path, dispatcher.forward)
+    appasync.router.add_get("/health", dispatcher.health)
+    appasync.router.add_get("/metrics", dispatcher.metrics)
+    appasync.router.add_static('/',path='web')
+
+    cors = aiohttp_cors.setup(appasync, defaults={
+            "*": aiohttp_cors.ResourceOptions(
+                allow_credentials=True,
+                expose_headers="*",
+                allow_headers="*",
+            )
+        })
+    for route in list(appasync.router.routes()):
+        cors.add(route)
+
+    logger.info('start dispatcher; http://<serverip>:%d/dashboard.html, %d workers', opt.listenport, count)
+    web.run_app(appasync, port=opt.listenport)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from logger import logger
+
+class GpuBlender:
+    """
+    Resize predicted faces to their bbox and blend them on the device for a whole batch,
+    so only the final bbox sized crops are copied back to the host.
+    boxes: per avatar frame (x1,y1,x2,y2) in the full frame
+    backgrounds/weights: per frame bbox region of the full frame and its float blending
+        weight, the crop becomes weight*face + (1-weight)*background (musetalk)
+    faces/inner: per frame face crop the prediction is written into at inner=(y1,y2,x1,x2)
+        before resizing the whole crop to the bbox (ultralight)
+    """
+    def __init__(self, boxes, device, backgrounds=None, weights=None, faces=None, inner=None):
+        self.boxes = [tuple(int(v) for v in box) for box in boxes]
+        self.device = device
+        self.backgrounds = None
+        self.weights = None
+        self.faces = None
+        self.inner = inner
+        if backgrounds is not None:
+            self.backgrounds = [self.__upload(bg).permute(2,0,1) for bg in backgrounds]
+            self.weights = [self.__upload(w).half() for w in weights]
+        if faces is not None:
+            self.faces = [self.__upload(face).permute(2,0,1) for face in faces]
+        logger.info('gpu blender ready, %d frames on %s', len(self.boxes), device)
+
+    def __upload(self, array):
+        return torch.from_numpy(np.ascontiguousarray(array)).to(self.device)
+
+    @torch.no_grad()
+    def __call__(self, pred_batch, idx_list):
+        """
+        :param pred_batch: tensor [B,3,h,w] on device, BGR in 0..255
+        :param idx_list: avatar frame index of each prediction
+        :return: list of uint8 bbox sized crops [h,w,3]
+        """
+        crops = []
+        for pred, idx in zip(pred_batch, idx_list):
+            x1, y1, x2, y2 = self.boxes[idx]
+            face = pred.float()
+            if self.faces is not None:
+                canvas = self.faces[idx].float()
+                iy1, iy2, ix1, ix2 = self.inner
+                canvas[:, iy1:iy2, ix1:ix2] = face
+                face = canvas
+            face = F.interpolate(face[None], size=(y2-y1, x2-x1), mode='bilinear', align_corners=False)[0]
+            if self.backgrounds is not None:
+                weight = self.weights[idx].float()
+                face = face*weight + self.backgrounds[idx].float()*(1-weight)
+            crops.append(face.round_().clamp_(0,255).to(torch.uint8).permute(1,2,0).reshape(-1))
+        # one device to host copy for the whole batch
+        flat = torch.cat(crops).cpu().numpy()
+        result = []
+        start = 0
+        for idx in idx_list:
+            x1, y1, x2, y2 = self.boxes[idx]
+            size = (y2-y1)*(x2-x1)*3
+            result.append(flat[start:start+size].reshape(y2-y1, x2-x1, 3))
+            start += size
+        return result
+
+_blenders = {}
+
+def get_blender(avatar, build):
+    """one blender per loaded avatar, shared by all sessions rendering it"""
+    entry = _blenders.get(id(avatar))
+    if entry is None or entry[0] is not avatar:
+        entry = (avatar, build())
+        _blenders[id(avatar)] = entry
+    return entry[1]
+
+def release_blender(avatar):
+    entry = _blenders.get(id(avatar))
+    if entry is not None and entry[0] is avatar:
+        del _blenders[id(avatar)]
@@ -1,7 +1,19 @@
 import time
 import torch
 import numpy as np
+from threading import Lock
 from baseasr import BaseASR
+from ultralight.audio2feature import Audio2FeatureStream,FeatureBatcher
+
+_batcher = None
+_batcher_lock = Lock()
+
+def get_batcher(audio_processor, opt):
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = FeatureBatcher(audio_processor, deadline=opt.batch_deadline/1000)
+    return _batcher
 
 # hubert audio feature
 class HubertASR(BaseASR):
@@ -12,6 +24,19 @@ class HubertASR(BaseASR):
         #self.stride_left_size = 32
         #self.stride_right_size = 32
         self.audio_feat_length = audio_feat_length
+        self.feature_stream = None
+        if opt.stream_asr:
+            self.feature_stream = Audio2FeatureStream(audio_processor,self.stride_left_size,chunk=self.chunk)
+        self.batcher = None
+        self.speaking = False
+        if opt.shared_asr:
+            self.batcher = get_batcher(audio_processor, opt)
+
+    def set_speaking(self, speaking:bool):
+        '''silent steps reuse silent_chunks and submit nothing to the shared batcher'''
+        if self.batcher is not None and speaking != self.speaking:
+            self.speaking = speaking
+            self.batcher.speaking(speaking)
 
 
     def run_step(self):
@@ -26,9 +51,20 @@ class HubertASR(BaseASR):
             return
         
         inputs = np.concatenate(self.frames)  # [N * chunk]
-
-        mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
-        mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
+        silent = not inputs.any()
+        self.set_speaking(not silent)
+        if silent and self.silent_chunks is not None:
+            mel_chunks = self.silent_chunks
+        else:
+            if self.feature_stream is not None and not silent:
+                mel = self.feature_stream.audio2feat(inputs,self.batch_size*2*self.chunk,self.batcher)
+            else:
+                mel = self.audio_processor.get_hubert_from_16k_speech(inputs,self.batcher)
+            mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
+            if silent:
+                self.silent_chunks = mel_chunks
+        if silent and self.feature_stream is not None:
+            self.feature_stream.reset() #its window state was not advanced
 
         self.feat_queue.put(mel_chunks)
         self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
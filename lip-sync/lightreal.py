@@ -37,6 +37,9 @@ from hubertasr import HubertASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from gpublend import GpuBlender,get_blender
+from avatarpack import open_pack
+from onnxmodel import backend_model
 
 #from imgcache import ImgCache
 
@@ -55,6 +58,7 @@ from torch.utils.data import DataLoader
 from ultralight.unet import Model
 from ultralight.audio2feature import Audio2Feature
 from logger import logger
+import metrics
 
 device = "cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu")
 print('Using {} for inference.'.format(device))
@@ -63,14 +67,22 @@ def load_model(opt):
     audio_processor = Audio2Feature()
     return audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,opt=None):
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
     coords_path = f"{avatar_path}/coords.pkl" 
     
     model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
-    model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+    model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth",map_location=device))
+    model = model.eval()
+    if opt is not None:
+        model = backend_model(model,f"{avatar_path}/ultralight.pth",opt)
+
+    pack = open_pack(avatar_path)
+    if pack is not None:
+        logger.info('loading packed avatar %s', pack.path)
+        return model,pack['frames'],pack['faces'],[tuple(box) for box in pack['coords'].tolist()],face_tensors(pack['faces'])
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
@@ -82,13 +94,25 @@ def load_avatar(avatar_id):
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
 
-    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
-
+    return model,frame_list_cycle,face_list_cycle,coord_list_cycle,face_tensors(face_list_cycle)
+
+def face_tensors(face_list_cycle,chunk=64):
+    """
+    model input of every 168x168 face crop, reference and masked channels [N,6,160,160]
+    prepared once and kept on the device as uint8; a batch is an index gather and one conversion
+    """
+    mask = cv2.rectangle(np.ones((160,160,3),dtype=np.uint8),(5,5,150,145),(0,0,0),-1)
+    res = torch.empty((len(face_list_cycle),6,160,160),dtype=torch.uint8,device=device)
+    for i in range(0,len(face_list_cycle),chunk):
+        img_real_ex = np.stack([face[4:164, 4:164] for face in face_list_cycle[i:i+chunk]])
+        img_masked = img_real_ex * mask
+        res[i:i+len(img_real_ex)] = torch.from_numpy(np.concatenate((img_real_ex, img_masked), axis=3).transpose(0, 3, 1, 2)).to(device)
+    return res
 
 @torch.no_grad()
 def warm_up(batch_size,avatar,modelres):
     logger.info('warmup model...')
-    model,_,_,_ = avatar
+    model = avatar[0]
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
     model(img_batch, mel_batch)
@@ -145,19 +169,27 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 
-def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model):
-    length = len(face_list_cycle)
+def inference(render_event, batch_size, face_tensors, audio_feat_queue, audio_out_queue, res_frame_queue, model, blender:GpuBlender=None,
+              avatar_queue:Queue=None, infer_metric=None):
+    length = len(face_tensors)
     index = 0
     count = 0
     counttime = 0
     logger.info('start inference')
 
-    while not quit_event.is_set():
+    while render_event.is_set():
         starttime=time.perf_counter()
+        if avatar_queue is not None and not avatar_queue.empty():
+            switch,face_tensors,model,blender = avatar_queue.get()
+            length = len(face_tensors)
+            index = 0
+            res_frame_queue.put((switch,None,None))
         try:
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        if audio_out_queue.skip_stale(batch_size*2): #flushed speech, dropped with its features
+            continue
         is_all_silence=True
         audio_frames = []
         for _ in range(batch_size*2):
@@ -171,37 +203,20 @@ def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_o
                 index = index + 1
         else:
             t = time.perf_counter()
-            img_batch = []
-
-            for i in range(batch_size):
-                idx = __mirror_index(length, index + i)
-                #face = face_list_cycle[idx]
-                crop_img = face_list_cycle[idx] #face[ymin:ymax, xmin:xmax]
-#                h, w = crop_img.shape[:2]
-                #crop_img = cv2.resize(crop_img, (168, 168), cv2.INTER_AREA)
-                #crop_img_ori = crop_img.copy()
-                img_real_ex = crop_img[4:164, 4:164].copy()
-                img_real_ex_ori = img_real_ex.copy()
-                img_masked = cv2.rectangle(img_real_ex_ori,(5,5,150,145),(0,0,0),-1)
-    
-                img_masked = img_masked.transpose(2,0,1).astype(np.float32)
-                img_real_ex = img_real_ex.transpose(2,0,1).astype(np.float32)
-    
-                img_real_ex_T = torch.from_numpy(img_real_ex / 255.0)
-                img_masked_T = torch.from_numpy(img_masked / 255.0)
-                img_concat_T = torch.cat([img_real_ex_T, img_masked_T], axis=0)[None]
-                img_batch.append(img_concat_T)
-
-            reshaped_mel_batch = [arr.reshape(32, 32, 32) for arr in mel_batch]
-            mel_batch = torch.stack([torch.from_numpy(arr) for arr in reshaped_mel_batch])
-            img_batch = torch.stack(img_batch).squeeze(1)
-
+            idx_batch = [__mirror_index(length, index + i) for i in range(batch_size)]
+            img_batch = face_tensors[idx_batch].float() / 255.0
+            mel_batch = torch.from_numpy(np.asarray(mel_batch).reshape(-1, 32, 32, 32))
 
             with torch.no_grad():
-                pred = model(img_batch.cuda(),mel_batch.cuda())
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+                pred = model(img_batch,mel_batch.to(device))
+            if blender is not None:
+                pred = blender(pred * 255.,idx_batch)
+            else:
+                pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
 
             counttime += (time.perf_counter() - t)
+            if infer_metric is not None:
+                infer_metric.observe(time.perf_counter() - t)
             count += batch_size
             if count >= 100:
                 logger.info(f"------actual avg infer fps:{count / counttime:.4f}")
@@ -237,7 +252,8 @@ class LightReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         audio_processor = model
-        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.set_avatar(avatar)
+        self.blender = self.__get_blender(avatar)
 
         self.asr = HubertASR(opt,self,audio_processor)
         self.asr.warm_up()
@@ -248,9 +264,26 @@ class LightReal(BaseReal):
     def __del__(self):
         logger.info(f'lightreal({self.sessionid}) delete')
 
+    def set_avatar(self,avatar):
+        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensors = avatar
+        self.update_idle_frames(avatar)
+
+    def get_avatar_inputs(self,avatar):
+        #ultralight avatars carry their own trained model
+        return avatar[4],avatar[0],self.__get_blender(avatar)
+
+    def __get_blender(self,avatar):
+        if not self.opt.gpu_blend:
+            return None
+        _,_,face_list_cycle,coord_list_cycle,_ = avatar
+        return get_blender(avatar,lambda: GpuBlender(coord_list_cycle,device,faces=face_list_cycle,inner=(4,164,4,164)))
+
     def paste_back_frame(self,pred_frame,idx:int):
         bbox = self.coord_list_cycle[idx]
-        combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
+        if self.blender is not None:
+            return self.paste_back_crop(pred_frame,idx,bbox)
+        combine_frame = self.get_frame_buffer(self.frame_list_cycle[idx])
+        np.copyto(combine_frame,self.frame_list_cycle[idx])
         x1, y1, x2, y2 = bbox
 
         crop_img = self.face_list_cycle[idx]
@@ -258,8 +291,7 @@ class LightReal(BaseReal):
         #res_frame = np.array(res_frame, dtype=np.uint8)
 
         crop_img_ori[4:164, 4:164] = pred_frame.astype(np.uint8)
-        crop_img_ori = cv2.resize(crop_img_ori, (x2-x1,y2-y1))
-        combine_frame[y1:y2, x1:x2] = crop_img_ori
+        cv2.resize(crop_img_ori, (x2-x1,y2-y1), dst=combine_frame[y1:y2, x1:x2])
         return combine_frame
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -270,11 +302,15 @@ class LightReal(BaseReal):
         self.init_customindex()
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
-        
-
-        #self.render_event.set() #start infer process render
+        if self.asr.batcher is not None:
+            self.asr.batcher.register()
+        self.render_event.set() #start infer process render
+        infer_thread = Thread(target=inference, args=(self.render_event,self.batch_size,self.face_tensors,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+                                           self.model,self.blender,self.avatar_queue,metrics.infer.labels(self.sessionid)))
+        infer_thread.start()  #mp.Process
+        self.render_threads = [process_thread,infer_thread]
+
+        asr_step = metrics.asr_step.labels(self.sessionid)
         count=0
         totaltime=0
         _starttime=time.perf_counter()
@@ -284,18 +320,19 @@ class LightReal(BaseReal):
             # audio stream thread...
             t = time.perf_counter()
             self.asr.run_step()
+            asr_step.observe(time.perf_counter() - t)
 
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
             #     time.sleep(delay)
-        #self.render_event.clear() #end infer process render
+        self.render_event.clear() #end infer process render
+        if self.asr.batcher is not None:
+            self.asr.set_speaking(False)
+            self.asr.batcher.unregister()
         logger.info('lightreal thread stop')
             
 
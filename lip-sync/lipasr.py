@@ -27,6 +27,26 @@ from baseasr import BaseASR
 from wav2lip import audio
 
 class LipASR(BaseASR):
+    def __init__(self, opt, parent=None):
+        super().__init__(opt,parent)
+        self.mel_stream = None
+        if opt.stream_asr:
+            self.mel_stream = self.__new_mel_stream()
+
+    def __new_mel_stream(self):
+        #columns of the window plus the last chunk, 80 mel columns per second
+        window = (self.stride_left_size + self.stride_right_size + self.batch_size*2) * 80 // self.fps
+        return audio.MelStream(window + 64)
+
+    def warm_up(self):
+        super().warm_up()
+        if self.mel_stream is not None: #the window starts with the warm up frames
+            self.mel_stream.push(np.concatenate(self.frames))
+
+    def reset(self):
+        if self.mel_stream is not None:
+            self.mel_stream = self.__new_mel_stream()
+        super().reset()
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
@@ -36,28 +56,34 @@ class LipASR(BaseASR):
             self.frames.append(frame)
             # put to output
             self.output_queue.put((frame,type,eventpoint))
+        if self.mel_stream is not None:
+            self.mel_stream.push(np.concatenate(self.frames[-self.batch_size*2:]))
         # context not enough, do not run network.
         if len(self.frames) <= self.stride_left_size + self.stride_right_size:
             return
         
         inputs = np.concatenate(self.frames) # [N * chunk]
-        mel = audio.melspectrogram(inputs)
-        #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
+        silent = not inputs.any()
+        if silent and self.silent_chunks is not None:
+            self.feat_queue.put(self.silent_chunks)
+            self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+            return
         # cut off stride
         left = max(0, self.stride_left_size*80/50)
-        right = min(len(mel[0]), len(mel[0]) - self.stride_right_size*80/50)
         mel_idx_multiplier = 80.*2/self.fps 
         mel_step_size = 16
-        i = 0
-        mel_chunks = []
-        while i < (len(self.frames)-self.stride_left_size-self.stride_right_size)/2:
-            start_idx = int(left + i * mel_idx_multiplier)
-            #print(start_idx)
-            if start_idx + mel_step_size > len(mel[0]):
-                mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-            else:
-                mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-            i += 1
+        num_chunks = int(np.ceil((len(self.frames)-self.stride_left_size-self.stride_right_size)/2))
+        offsets = left + np.arange(num_chunks) * mel_idx_multiplier
+        if self.mel_stream is not None:
+            window_start = self.mel_stream.samples - len(inputs)
+            mel_chunks = self.mel_stream.chunks(window_start, offsets, mel_step_size)
+        else:
+            mel = audio.melspectrogram(inputs)
+            #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
+            start_idx = np.minimum(offsets.astype(np.int64), len(mel[0]) - mel_step_size)
+            mel_chunks = mel[:, start_idx[:, np.newaxis] + np.arange(mel_step_size)].transpose(1, 0, 2)
+        if silent:
+            self.silent_chunks = mel_chunks
         self.feat_queue.put(mel_chunks)
         
         # discard the old part to save memory
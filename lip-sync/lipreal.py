@@ -38,11 +38,14 @@ import asyncio
 from av import AudioFrame, VideoFrame
 from wav2lip.models import Wav2Lip
 from basereal import BaseReal
+from gpublend import GpuBlender,get_blender
+from avatarpack import open_pack
 
 #from imgcache import ImgCache
 
 from tqdm import tqdm
 from logger import logger
+import metrics
 
 device = "cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu")
 print('Using {} for inference.'.format(device))
@@ -73,6 +76,11 @@ def load_avatar(avatar_id):
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
     coords_path = f"{avatar_path}/coords.pkl"
+
+    pack = open_pack(avatar_path)
+    if pack is not None:
+        logger.info('loading packed avatar %s', pack.path)
+        return pack['frames'],pack['faces'],[tuple(box) for box in pack['coords'].tolist()],face_tensors(pack['faces'])
     
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
@@ -84,7 +92,22 @@ def load_avatar(avatar_id):
     input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     face_list_cycle = read_imgs(input_face_list)
 
-    return frame_list_cycle,face_list_cycle,coord_list_cycle
+    return frame_list_cycle,face_list_cycle,coord_list_cycle,face_tensors(face_list_cycle)
+
+def face_tensors(face_list_cycle,chunk=64):
+    """
+    model input of every face crop, masked and reference channels [N,6,H,W] prepared once
+    and kept on the device as uint8; a batch is an index gather and one conversion
+    """
+    length = len(face_list_cycle)
+    height,width = face_list_cycle[0].shape[:2]
+    res = torch.empty((length,6,height,width),dtype=torch.uint8,device=device)
+    for i in range(0,length,chunk):
+        faces = np.stack(face_list_cycle[i:i+chunk])
+        masked = faces.copy()
+        masked[:, height//2:] = 0
+        res[i:i+len(faces)] = torch.from_numpy(np.concatenate((masked, faces), axis=3).transpose(0, 3, 1, 2)).to(device)
+    return res
 
 @torch.no_grad()
 def warm_up(batch_size,model,modelres):
@@ -111,7 +134,8 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+def inference(render_event,batch_size,face_tensors,audio_feat_queue,audio_out_queue,res_frame_queue,model,blender:GpuBlender=None,
+              avatar_queue:Queue=None,infer_metric=None):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -119,18 +143,25 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
     # face_list_cycle = read_imgs(input_face_list)
     
     #input_latent_list_cycle = torch.load(latents_out_path)
-    length = len(face_list_cycle)
+    length = len(face_tensors)
     index = 0
     count=0
     counttime=0
     logger.info('start inference')
-    while not quit_event.is_set():
+    while render_event.is_set():
         starttime=time.perf_counter()
+        if avatar_queue is not None and not avatar_queue.empty():
+            switch,face_tensors,blender = avatar_queue.get()
+            length = len(face_tensors)
+            index = 0
+            res_frame_queue.put((switch,None,None))
         mel_batch = []
         try:
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        if audio_out_queue.skip_stale(batch_size*2): #flushed speech, dropped with its features
+            continue
             
         is_all_silence=True
         audio_frames = []
@@ -147,27 +178,23 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
         else:
             # print('infer=======')
             t=time.perf_counter()
-            img_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                face = face_list_cycle[idx]
-                img_batch.append(face)
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-            img_masked = img_batch.copy()
-            img_masked[:, face.shape[0]//2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
+            idx_batch = [__mirror_index(length,index+i) for i in range(batch_size)]
+            img_batch = face_tensors[idx_batch].float() / 255.
+            mel_batch = np.asarray(mel_batch)
             mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
             
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
             mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
 
             with torch.no_grad():
                 pred = model(mel_batch, img_batch)
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+            if blender is not None:
+                pred = blender(pred * 255.,idx_batch)
+            else:
+                pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
 
             counttime += (time.perf_counter() - t)
+            if infer_metric is not None:
+                infer_metric.observe(time.perf_counter() - t)
             count += batch_size
             #_totalframe += 1
             if count>=100:
@@ -196,7 +223,8 @@ class LipReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         self.model = model
-        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.set_avatar(avatar)
+        self.blender = self.__get_blender(avatar)
 
         self.asr = LipASR(opt,self)
         self.asr.warm_up()
@@ -206,15 +234,29 @@ class LipReal(BaseReal):
     def __del__(self):
         logger.info(f'lipreal({self.sessionid}) delete')
 
+    def set_avatar(self,avatar):
+        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensors = avatar
+        self.update_idle_frames(avatar)
+
+    def get_avatar_inputs(self,avatar):
+        return avatar[3],self.__get_blender(avatar)
+
+    def __get_blender(self,avatar):
+        if not self.opt.gpu_blend:
+            return None
+        return get_blender(avatar,lambda: GpuBlender([(x1,y1,x2,y2) for y1,y2,x1,x2 in avatar[2]],device))
+
     def paste_back_frame(self,pred_frame,idx:int):
         bbox = self.coord_list_cycle[idx]
-        combine_frame = copy.deepcopy(self.frame_list_cycle[idx])
-        #combine_frame = copy.deepcopy(self.imagecache.get_img(idx))
         y1, y2, x1, x2 = bbox
-        res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
+        if self.blender is not None:
+            return self.paste_back_crop(pred_frame,idx,(x1,y1,x2,y2))
+        combine_frame = self.get_frame_buffer(self.frame_list_cycle[idx])
+        np.copyto(combine_frame,self.frame_list_cycle[idx])
+        #combine_frame = copy.deepcopy(self.imagecache.get_img(idx))
         #combine_frame = get_image(ori_frame,res_frame,bbox)
         #t=time.perf_counter()
-        combine_frame[y1:y2, x1:x2] = res_frame
+        cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1),dst=combine_frame[y1:y2, x1:x2])
         return combine_frame
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -226,11 +268,14 @@ class LipReal(BaseReal):
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
 
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
+        self.render_event.set() #start infer process render
+        infer_thread = Thread(target=inference, args=(self.render_event,self.batch_size,self.face_tensors,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+                                           self.model,self.blender,self.avatar_queue,metrics.infer.labels(self.sessionid)))
+        infer_thread.start()  #mp.Process
+        self.render_threads = [process_thread,infer_thread]
 
-        #self.render_event.set() #start infer process render
+        asr_step = metrics.asr_step.labels(self.sessionid)
         count=0
         totaltime=0
         _starttime=time.perf_counter()
@@ -240,17 +285,15 @@ class LipReal(BaseReal):
             # audio stream thread...
             t = time.perf_counter()
             self.asr.run_step()
+            asr_step.observe(time.perf_counter() - t)
 
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
-            if video_track and video_track._queue.qsize()>=5:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
                 
             # delay = _starttime+_totalframe*0.04-time.perf_counter() #40ms
             # if delay > 0:
             #     time.sleep(delay)
-        #self.render_event.clear() #end infer process render
+        self.render_event.clear() #end infer process render
         logger.info('lipreal thread stop')
             
\ No newline at end of file
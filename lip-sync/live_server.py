@@ -3,11 +3,13 @@ from fastapi.responses import Response
 import subprocess
 import os
 import json
+import re
 import time
 import uvicorn
 import tempfile
 import shutil
 import threading
+import requests
 
 # Import create_avatar related functions
 from create_avatar import create_avatar
@@ -53,7 +55,8 @@ app = FastAPI()
 @app.post("/switch_avatar")
 def switch_avatar(
     avatar_id: str = Query(..., description="Avatar ID, e.g., avator_1"),
-    ref_file: str = Query(..., description="Reference audio file path")
+    ref_file: str = Query(..., description="Reference audio file path"),
+    sessionid: int = Query(None, description="Session of the caller, switched in place; without it only new sessions use the avatar")
 ):
     """Execute new script command using conda environment"""
     # Get parameters from configuration file
@@ -65,6 +68,9 @@ def switch_avatar(
     tts_server = get_config_value("servers.tts_server", "http://127.0.0.1:8604")
     ref_text = get_config_value("default_texts.ref_text", "hello this is tutorNet speaking, what do you need? do you want a cup of coffee?")
 
+    if not re.fullmatch(r'[\w.-]+', avatar_id) or avatar_id in ('.', '..'):
+        raise HTTPException(status_code=400, detail=f"Invalid avatar_id '{avatar_id}'")
+
     # Check if avatar_id exists
     working_directory = get_config_value("paths.working_directory", "/workspace/share/yuntao/LiveTalking")
     LIVEAVADIR = os.path.join(working_directory, "data", "avatars")
@@ -113,6 +119,34 @@ def switch_avatar(
     
     print(f"Avatar and reference audio file checks passed")
 
+    # Switch inside the running service if it runs the same model, transport and tts: models stay
+    # loaded and the sessions of other users keep their avatar
+    try:
+        health = requests.get(f"http://127.0.0.1:{listenport}/health", timeout=5).json()
+        running = (health.get("model"), health.get("transport"), health.get("tts"))
+        if running == (model, transport, tts):
+            params = {"avatar_id": avatar_id, "ref_file": ref_file}
+            if sessionid is not None:
+                params["sessionid"] = sessionid
+            response = requests.post(
+                f"http://127.0.0.1:{listenport}/switch_avatar",
+                json=params,
+                timeout=60
+            )
+            if response.ok and response.json().get("code") == 0:
+                print(f"Switched to avatar {avatar_id} in running service")
+                return {
+                    "status": "success",
+                    "message": f"Successfully switched to avatar {avatar_id} in service on port {listenport}: {response.json().get('msg')}"
+                }
+            if sessionid is not None: #a restart would end the sessions of every user
+                raise HTTPException(status_code=400, detail=f"Switch of session {sessionid} rejected: {response.text}")
+            print(f"Hot switch rejected, restarting service: {response.text}")
+        else:
+            print(f"Service runs {running}, restarting it for {(model, transport, tts)}")
+    except (requests.RequestException, ValueError) as e:
+        print(f"Service not reachable for hot switch, starting it: {e}")
+
     # Build command
     app_command = (
         f"python3 app.py --transport {transport} --model {model} --avatar_id {avatar_id} "
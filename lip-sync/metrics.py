@@ -0,0 +1,163 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Counters, gauges and histograms of the render pipeline, served by /metrics in the Prometheus
+text format. Recording is a lookup and a few additions under a lock, cheap enough for every
+frame. Series labelled with a session are dropped by remove_session when it closes.
+"""
+
+import bisect
+import threading
+
+# seconds, from sub-millisecond stages up to tts round trips
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28, 2.56, 5.12)
+
+_metrics = []
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {} #label values:series
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        series = self.series.get(values)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(values, self._new_series())
+        return series
+
+    def remove(self, **labels):
+        """drop the series whose labels match all of the given ones"""
+        with self.lock:
+            for values in list(self.series):
+                if all(values[self.labelnames.index(name)] == str(value) for name, value in labels.items()):
+                    del self.series[values]
+
+    def _new_series(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, series in list(self.series.items()):
+            lines.extend(self._render_series(values, series))
+        return lines
+
+class _Value:
+    def __init__(self, lock):
+        self.value = 0.
+        self.lock = lock
+
+    def inc(self, amount=1.):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_series(self):
+        return _Value(self.lock)
+
+    def _render_series(self, values, series):
+        return [f'{self.name}_total{_format_labels(self.labelnames, values)} {series.value}']
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_series(self):
+        return _Value(self.lock)
+
+    def _render_series(self, values, series):
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {series.value}']
+
+class _HistogramSeries:
+    def __init__(self, buckets, lock):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.lock = lock
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets, self.lock)
+
+    def _render_series(self, values, series):
+        with self.lock:
+            counts = list(series.counts)
+            total = series.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, values, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, values)} {total}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, values)} {cumulative}')
+        return lines
+
+def render()->str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def remove_session(sessionid):
+    for metric in _metrics:
+        if 'session' in metric.labelnames:
+            metric.remove(session=sessionid)
+
+sessions = Gauge('livetalking_sessions', 'open sessions')
+tts_first_audio = Histogram('livetalking_tts_first_audio_seconds', 'from the start of a message synthesis to its first audio frame', ('session',))
+asr_step = Histogram('livetalking_asr_step_seconds', 'asr run_step of one batch, including waiting for audio', ('session',))
+infer = Histogram('livetalking_infer_seconds', 'lip-sync inference of one batch as seen by the session', ('session',))
+unet = Histogram('livetalking_unet_seconds', 'musetalk unet of one shared batch')
+vae_decode = Histogram('livetalking_vae_decode_seconds', 'musetalk vae decode of one shared batch')
+paste_back = Histogram('livetalking_paste_back_seconds', 'pasting one predicted face back into the avatar frame', ('session',))
+queue_wait = Histogram('livetalking_frame_queue_wait_seconds', 'process_frames waiting for the next inference result', ('session',))
+send_jitter = Histogram('livetalking_frame_send_jitter_seconds', 'lateness of a frame handed to webrtc against its schedule', ('session', 'kind'))
+av_drift = Gauge('livetalking_av_drift_seconds', 'wall clock position of the video track minus the audio track', ('session',))
+video_fps = Gauge('livetalking_video_fps', 'video frames per second sent over the last 100 frames', ('session',))
+frames_sent = Counter('livetalking_frames_sent', 'frames handed to webrtc', ('session', 'kind'))
+frames_dropped = Counter('livetalking_frames_dropped', 'frames dropped by a lagging track', ('session', 'kind'))
@@ -22,12 +22,15 @@ import queue
 from queue import Queue
 #import multiprocessing as mp
 from baseasr import BaseASR
-from musetalk.whisper.audio2feature import Audio2Feature
+from musetalk.whisper.audio2feature import Audio2Feature,Audio2FeatureStream
 
 class MuseASR(BaseASR):
     def __init__(self, opt, parent,audio_processor:Audio2Feature):
         super().__init__(opt,parent)
         self.audio_processor = audio_processor
+        self.feature_stream = None
+        if opt.stream_asr:
+            self.feature_stream = Audio2FeatureStream(audio_processor,self.stride_left_size,chunk=self.chunk)
 
     def run_step(self):
         ############################################## extract audio feature ##############################################
@@ -41,11 +44,22 @@ class MuseASR(BaseASR):
             return
         
         inputs = np.concatenate(self.frames) # [N * chunk]
-        whisper_feature = self.audio_processor.audio2feat(inputs)
-        # for feature in whisper_feature:
-        #     self.audio_feats.append(feature)        
-        #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, inputs shape:{inputs.shape} whisper_feature len:{len(whisper_feature)}")
-        whisper_chunks = self.audio_processor.feature2chunks(feature_array=whisper_feature,fps=self.fps/2,batch_size=self.batch_size,start=self.stride_left_size/2 )
+        silent = not inputs.any()
+        if silent and self.silent_chunks is not None:
+            whisper_chunks = self.silent_chunks
+        else:
+            if self.feature_stream is not None and not silent:
+                whisper_feature = self.feature_stream.audio2feat(inputs,self.batch_size*2*self.chunk)
+            else:
+                whisper_feature = self.audio_processor.audio2feat(inputs)
+            # for feature in whisper_feature:
+            #     self.audio_feats.append(feature)        
+            #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, inputs shape:{inputs.shape} whisper_feature len:{len(whisper_feature)}")
+            whisper_chunks = self.audio_processor.feature2chunks(feature_array=whisper_feature,fps=self.fps/2,batch_size=self.batch_size,start=self.stride_left_size/2 )
+            if silent:
+                self.silent_chunks = whisper_chunks
+        if silent and self.feature_stream is not None:
+            self.feature_stream.reset() #its window state was not advanced
         #print(f"whisper_chunks len:{len(whisper_chunks)},self.audio_feats len:{len(self.audio_feats)},self.output_queue len:{self.output_queue.qsize()}")
         #self.audio_feats = self.audio_feats[-(self.stride_left_size + self.stride_right_size):]
         self.feat_queue.put(whisper_chunks)
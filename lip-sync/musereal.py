@@ -31,22 +31,25 @@ import copy
 
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Condition, Lock
 import torch.multiprocessing as mp
 
 from musetalk.utils.utils import get_file_type,get_video_fps,datagen
 #from musetalk.utils.preprocessing import get_landmark_and_bbox,read_imgs,coord_placeholder
-from musetalk.utils.blending import get_image,get_image_prepare_material,get_image_blending
+from musetalk.utils.blending import get_image,get_image_prepare_material,get_image_blending,get_blend_weights,get_image_blending_into
 from musetalk.utils.utils import load_all_model,load_diffusion_model,load_audio_model
 from musetalk.whisper.audio2feature import Audio2Feature
 
 from museasr import MuseASR
+from gpublend import GpuBlender,get_blender
+from avatarpack import open_pack
 import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
 
 from tqdm import tqdm
 from logger import logger
+import metrics
 
 def load_model():
     # load model weights
@@ -77,6 +80,16 @@ def load_avatar(avatar_id):
     #     "bbox_shift":self.bbox_shift   
     # }
 
+    pack = open_pack(avatar_path)
+    if pack is not None:
+        logger.info('loading packed avatar %s', pack.path)
+        device = torch.device("cuda" if torch.cuda.is_available() else ("mps" if (hasattr(torch.backends, "mps") and torch.backends.mps.is_available()) else "cpu"))
+        input_latent_list_cycle = torch.from_numpy(np.array(pack['latents'])).to(device)
+        coord_list_cycle = [tuple(box) for box in pack['coords'].tolist()]
+        mask_coords_list_cycle = [tuple(box) for box in pack['mask_coords'].tolist()]
+        blend_list_cycle = list(zip(pack['blend'],pack['blend_inv']))
+        return pack['frames'],blend_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
+
     input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
@@ -88,7 +101,9 @@ def load_avatar(avatar_id):
     input_mask_list = glob.glob(os.path.join(mask_out_path, '*.[jpJP][pnPN]*[gG]'))
     input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
     mask_list_cycle = read_imgs(input_mask_list)
-    return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
+    blend_list_cycle = [get_blend_weights(mask,bbox,mask_crop_box)
+                        for mask,bbox,mask_crop_box in zip(mask_list_cycle,coord_list_cycle,mask_coords_list_cycle)]
+    return frame_list_cycle,blend_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
 
 @torch.no_grad()
 def warm_up(batch_size,model):
@@ -99,15 +114,178 @@ def warm_up(batch_size,model):
     #timesteps = torch.tensor([0], device=unet.device)
     whisper_batch = np.ones((batch_size, 50, 384), dtype=np.uint8)
     latent_batch = torch.ones(batch_size, 8, 32, 32).to(unet.device)
+    infer_batch(vae, unet, pe, timesteps, whisper_batch, latent_batch)
 
+@torch.no_grad()
+def infer_batch(vae, unet, pe, timesteps, whisper_batch, latent_batch, to_tensor=False, timed=False):
+    """timed records the unet and vae decode times in metrics"""
+    if timed:
+        marks = _TimeMarks(unet.device)
     audio_feature_batch = torch.from_numpy(whisper_batch)
-    audio_feature_batch = audio_feature_batch.to(device=unet.device, dtype=unet.model.dtype)
+    audio_feature_batch = audio_feature_batch.to(device=unet.device,
+                                                    dtype=unet.model.dtype)
     audio_feature_batch = pe(audio_feature_batch)
-    latent_batch = latent_batch.to(dtype=unet.model.dtype)
+    latent_batch = latent_batch.to(device=unet.device, dtype=unet.model.dtype)
+
     pred_latents = unet.model(latent_batch,
                               timesteps,
                               encoder_hidden_states=audio_feature_batch).sample
-    vae.decode_latents(pred_latents)
+    if timed:
+        marks.mark()
+    if to_tensor:
+        recon = vae.decode_latents_tensor(pred_latents)
+    else:
+        recon = vae.decode_latents(pred_latents)
+    if timed:
+        marks.mark()
+        unet_time, vae_time = marks.elapsed()
+        metrics.unet.labels().observe(unet_time)
+        metrics.vae_decode.labels().observe(vae_time)
+    return recon
+
+class _TimeMarks:
+    """
+    Intervals between marks. On cuda these are events on the stream, so timing does not
+    stall the kernel launches; elapsed() waits for the last mark.
+    """
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.marks = []
+        self.mark()
+
+    def mark(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.marks.append(event)
+        else:
+            self.marks.append(time.perf_counter())
+
+    def elapsed(self):
+        if self.cuda:
+            self.marks[-1].synchronize()
+            return [start.elapsed_time(end) / 1000. for start, end in zip(self.marks, self.marks[1:])]
+        return [end - start for start, end in zip(self.marks, self.marks[1:])]
+
+class InferJob:
+    def __init__(self, whisper_batch, latent_batch):
+        self.whisper_batch = whisper_batch
+        self.latent_batch = latent_batch
+        self.size = len(whisper_batch)
+        self.created = time.perf_counter()
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class InferScheduler:
+    """
+    Central unet/vae runner shared by all MuseReal sessions of the process.
+    Requests from every live session are packed into one dynamic batch, which is
+    dispatched when every speaking session has submitted, when max_batch frames
+    are pending, or when the oldest request has waited deadline seconds. Silent
+    sessions skip inference, so they are not waited for.
+    """
+    def __init__(self, model, max_batch=64, deadline=0.01, to_tensor=False):
+        self.vae, self.unet, self.pe, self.timesteps, _ = model
+        self.max_batch = max_batch
+        self.deadline = deadline
+        self.to_tensor = to_tensor
+        self._cond = Condition()
+        self._pending = []
+        self._sessions = 0
+        self._speaking = 0
+        self._thread = None
+
+    def register(self):
+        with self._cond:
+            self._sessions += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True, name="musetalk_infer_scheduler")
+                self._thread.start()
+
+    def unregister(self):
+        with self._cond:
+            self._sessions = max(0, self._sessions - 1)
+            self._cond.notify()
+
+    def speaking(self, active:bool):
+        """a registered session starts or stops submitting a batch every step"""
+        with self._cond:
+            self._speaking = max(0, self._speaking + (1 if active else -1))
+            self._cond.notify()
+
+    def infer(self, whisper_batch, latent_batch):
+        job = InferJob(whisper_batch, latent_batch)
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify()
+        return job.wait()
+
+    def _next_jobs(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            while True:
+                pending_frames = sum(job.size for job in self._pending)
+                if pending_frames >= self.max_batch or len(self._pending) >= min(self._speaking, self._sessions):
+                    break
+                remain = self._pending[0].created + self.deadline - time.perf_counter()
+                if remain <= 0:
+                    break
+                self._cond.wait(remain)
+            jobs = [self._pending.pop(0)]
+            frames = jobs[0].size
+            while self._pending and frames + self._pending[0].size <= self.max_batch:
+                job = self._pending.pop(0)
+                frames += job.size
+                jobs.append(job)
+            return jobs
+
+    def _run(self):
+        count = 0
+        counttime = 0
+        while True:
+            jobs = self._next_jobs()
+            t = time.perf_counter()
+            try:
+                whisper_batch = np.concatenate([job.whisper_batch for job in jobs])
+                latent_batch = torch.cat([job.latent_batch for job in jobs], dim=0)
+                recon = infer_batch(self.vae, self.unet, self.pe, self.timesteps, whisper_batch, latent_batch,
+                                    to_tensor=self.to_tensor, timed=True)
+            except Exception as e:
+                logger.exception('infer scheduler')
+                for job in jobs:
+                    job.error = e
+                    job.done.set()
+                continue
+            start = 0
+            for job in jobs:
+                job.result = recon[start:start+job.size]
+                start += job.size
+                job.done.set()
+            counttime += (time.perf_counter() - t)
+            count += start
+            if count>=100:
+                logger.info(f"------scheduler avg infer fps:{count/counttime:.4f}, last batch:{start} frames/{len(jobs)} sessions")
+                count=0
+                counttime=0
+
+_scheduler = None
+_scheduler_lock = Lock()
+
+def get_scheduler(model, opt):
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = InferScheduler(model, max_batch=max(opt.batch_size, opt.max_infer_batch),
+                                        deadline=opt.batch_deadline/1000, to_tensor=opt.gpu_blend)
+    return _scheduler
 
 def read_imgs(img_list):
     frames = []
@@ -128,7 +306,7 @@ def __mirror_index(size, index):
 
 @torch.no_grad()
 def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,
-              vae, unet, pe,timesteps): #vae, unet, pe,timesteps
+              scheduler:InferScheduler,blender:GpuBlender=None,avatar_queue:Queue=None,infer_metric=None):
     
     # vae, unet, pe = load_diffusion_model()
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -142,12 +320,20 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
     count=0
     counttime=0
     logger.info('start inference')
+    speaking = False
     while render_event.is_set():
         starttime=time.perf_counter()
+        if avatar_queue is not None and not avatar_queue.empty():
+            switch,input_latent_list_cycle,blender = avatar_queue.get()
+            length = len(input_latent_list_cycle)
+            index = 0
+            res_frame_queue.put((switch,None,None))
         try:
             whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        if audio_out_queue.skip_stale(batch_size*2): #flushed speech, dropped with its features
+            continue
         is_all_silence=True
         audio_frames = []
         for _ in range(batch_size*2):
@@ -155,6 +341,9 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             audio_frames.append((frame,type,eventpoint))
             if type==0:
                 is_all_silence=False
+        if speaking == is_all_silence:
+            speaking = not is_all_silence
+            scheduler.speaking(speaking)
         if is_all_silence:
             for i in range(batch_size):
                 res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
@@ -162,29 +351,17 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
         else:
             # print('infer=======')
             t=time.perf_counter()
-            whisper_batch = np.stack(whisper_chunks)
+            whisper_batch = np.asarray(whisper_chunks)
             latent_batch = []
             for i in range(batch_size):
                 idx = __mirror_index(length,index+i)
                 latent = input_latent_list_cycle[idx]
                 latent_batch.append(latent)
             latent_batch = torch.cat(latent_batch, dim=0)
-            
-            # for i, (whisper_batch,latent_batch) in enumerate(gen):
-            audio_feature_batch = torch.from_numpy(whisper_batch)
-            audio_feature_batch = audio_feature_batch.to(device=unet.device,
-                                                            dtype=unet.model.dtype)
-            audio_feature_batch = pe(audio_feature_batch)
-            latent_batch = latent_batch.to(dtype=unet.model.dtype)
-            # print('prepare time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-
-            pred_latents = unet.model(latent_batch, 
-                                        timesteps, 
-                                        encoder_hidden_states=audio_feature_batch).sample
-            # print('unet time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-            recon = vae.decode_latents(pred_latents)
+
+            recon = scheduler.infer(whisper_batch, latent_batch)
+            if blender is not None:
+                recon = blender(recon,[__mirror_index(length,index+i) for i in range(len(recon))])
             # infer_inqueue.put((whisper_batch,latent_batch,sessionid))
             # recon,outsessionid = infer_outqueue.get()
             # if outsessionid != sessionid:
@@ -193,6 +370,8 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
             # print('vae time:',time.perf_counter()-t)
             #print('diffusion len=',len(recon))
             counttime += (time.perf_counter() - t)
+            if infer_metric is not None:
+                infer_metric.observe(time.perf_counter() - t)
             count += batch_size
             #_totalframe += 1
             if count>=100:
@@ -204,6 +383,9 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
                 res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
                 index = index + 1
             #print('total batch time:',time.perf_counter()-starttime)            
+    if speaking:
+        scheduler.speaking(False)
+    scheduler.unregister()
     logger.info('musereal inference processor stop')
 
 class MuseReal(BaseReal):
@@ -221,7 +403,9 @@ class MuseReal(BaseReal):
         self.res_frame_queue = mp.Queue(self.batch_size*2)
 
         self.vae, self.unet, self.pe, self.timesteps, self.audio_processor = model
-        self.frame_list_cycle,self.mask_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle = avatar
+        self.scheduler = get_scheduler(model, opt)
+        self.set_avatar(avatar)
+        self.blender = self.__get_blender(avatar)
         #self.__loadavatar()
 
         self.asr = MuseASR(opt,self,self.audio_processor)
@@ -233,6 +417,24 @@ class MuseReal(BaseReal):
         logger.info(f'musereal({self.sessionid}) delete')
     
 
+    def set_avatar(self,avatar):
+        self.frame_list_cycle,self.blend_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle = avatar
+        self.update_idle_frames(avatar)
+
+    def get_avatar_inputs(self,avatar):
+        return avatar[4],self.__get_blender(avatar)
+
+    def __get_blender(self,avatar):
+        if not self.opt.gpu_blend:
+            return None
+        return get_blender(avatar,lambda: self.__build_blender(avatar))
+
+    def __build_blender(self,avatar):
+        frame_list_cycle,blend_list_cycle,coord_list_cycle,_,_ = avatar
+        return GpuBlender(coord_list_cycle,self.unet.device,
+                          backgrounds=[frame[y1:y2, x1:x2] for frame,(x1,y1,x2,y2) in zip(frame_list_cycle,coord_list_cycle)],
+                          weights=[mask for mask,_ in blend_list_cycle])
+
     def __mirror_index(self, index):
         size = len(self.coord_list_cycle)
         turn = index // size
@@ -245,7 +447,7 @@ class MuseReal(BaseReal):
     def __warm_up(self): 
         self.asr.run_step()
         whisper_chunks = self.asr.get_next_feat()
-        whisper_batch = np.stack(whisper_chunks)
+        whisper_batch = np.asarray(whisper_chunks)
         latent_batch = []
         for i in range(self.batch_size):
             idx = self.__mirror_index(self.idx+i)
@@ -253,29 +455,18 @@ class MuseReal(BaseReal):
             latent_batch.append(latent)
         latent_batch = torch.cat(latent_batch, dim=0)
         logger.info('infer=======')
-        # for i, (whisper_batch,latent_batch) in enumerate(gen):
-        audio_feature_batch = torch.from_numpy(whisper_batch)
-        audio_feature_batch = audio_feature_batch.to(device=self.unet.device,
-                                                        dtype=self.unet.model.dtype)
-        audio_feature_batch = self.pe(audio_feature_batch)
-        latent_batch = latent_batch.to(dtype=self.unet.model.dtype)
-
-        pred_latents = self.unet.model(latent_batch, 
-                                    self.timesteps, 
-                                    encoder_hidden_states=audio_feature_batch).sample
-        recon = self.vae.decode_latents(pred_latents)
+        recon = infer_batch(self.vae, self.unet, self.pe, self.timesteps, whisper_batch, latent_batch)
       
 
     def paste_back_frame(self,pred_frame,idx:int):
         bbox = self.coord_list_cycle[idx]
-        ori_frame = copy.deepcopy(self.frame_list_cycle[idx])
+        if self.blender is not None:
+            return self.paste_back_crop(pred_frame,idx,bbox)
+        ori_frame = self.frame_list_cycle[idx]
         x1, y1, x2, y2 = bbox
 
         res_frame = cv2.resize(pred_frame.astype(np.uint8),(x2-x1,y2-y1))
-        mask = self.mask_list_cycle[idx]
-        mask_crop_box = self.mask_coords_list_cycle[idx]
-
-        combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
+        combine_frame = get_image_blending_into(self.get_frame_buffer(ori_frame),ori_frame,res_frame,bbox,self.blend_list_cycle[idx])
         return combine_frame
             
     def render(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -288,9 +479,13 @@ class MuseReal(BaseReal):
         process_thread.start()
 
         self.render_event.set() #start infer process render
-        Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
+        self.scheduler.register()
+        infer_thread = Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.vae, self.unet, self.pe,self.timesteps)).start() #mp.Process
+                                           self.scheduler,self.blender,self.avatar_queue,metrics.infer.labels(self.sessionid)))
+        infer_thread.start() #mp.Process
+        self.render_threads = [process_thread,infer_thread]
+        asr_step = metrics.asr_step.labels(self.sessionid)
         count=0
         totaltime=0
         _starttime=time.perf_counter()
@@ -300,6 +495,7 @@ class MuseReal(BaseReal):
             # audio stream thread...
             t = time.perf_counter()
             self.asr.run_step()
+            asr_step.observe(time.perf_counter() - t)
             #self.test_step(loop,audio_track,video_track)
             # totaltime += (time.perf_counter() - t)
             # count += self.opt.batch_size
@@ -307,9 +503,6 @@ class MuseReal(BaseReal):
             #     print(f"------actual avg infer fps:{count/totaltime:.4f}")
             #     count=0
             #     totaltime=0
-            if video_track and video_track._queue.qsize()>=1.5*self.opt.batch_size:
-                logger.debug('sleep qsize=%d',video_track._queue.qsize())
-                time.sleep(0.04*video_track._queue.qsize()*0.8)
             # if video_track._queue.qsize()>=5:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
@@ -106,6 +106,18 @@ class VAE():
         image = (image * 255).round().astype("uint8")
         image = image[...,::-1] # RGB to BGR
         return image
+
+    def decode_latents_tensor(self, latents):
+        """
+        Decode latent variables back into images kept on the device.
+        :param latents: The latent variables to decode.
+        :return: A BGR tensor [B, 3, H, W] with values in 0..255.
+        """
+        latents = (1/  self.scaling_factor) * latents
+        image = self.vae.decode(latents.to(self.vae.dtype)).sample
+        image = (image / 2 + 0.5).clamp(0, 1)
+        image = image.detach().float() * 255
+        return image.flip(1) # RGB to BGR
     
     def get_latents_for_unet(self,img):
         """
@@ -4,6 +4,7 @@ import json
 import os
 import pickle
 import shutil
+import sys
 
 import cv2
 import numpy as np
@@ -252,6 +253,8 @@ def create_dir(dir_path):
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+from avatarpack import pack_musetalk
 
 
 def create_musetalk_human(file, avatar_id):
@@ -322,6 +325,8 @@ def create_musetalk_human(file, avatar_id):
     with open(coords_path, 'wb') as f:
         pickle.dump(coord_list_cycle, f)
     torch.save(input_latent_list_cycle, os.path.join(latents_out_path))
+    pack_musetalk(save_path, frame_list_cycle, mask_list_cycle, coord_list_cycle, mask_coords_list_cycle,
+                  input_latent_list_cycle)
 
 
 # initialize the mmpose model
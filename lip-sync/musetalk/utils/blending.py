@@ -122,4 +122,29 @@ def get_image_blending(image,face,face_box,mask_array,crop_box):
     body[y_s:y_e, x_s:x_e] = cv2.blendLinear(face_large,body[y_s:y_e, x_s:x_e],mask_image,1-mask_image)
 
     #body.paste(face_large, crop_box[:2], mask_image)
-    return body
\ No newline at end of file
+    return body
+
+def get_blend_weights(mask_array,face_box,crop_box):
+    """
+    Precompute the blending weights of one avatar frame once at load time.
+    Outside the face box the pasted crop equals the original frame, so the weights
+    are cropped to the face box and only that region is blended per frame.
+    """
+    x, y, x1, y1 = face_box
+    x_s, y_s, x_e, y_e = crop_box
+    if mask_array.ndim == 3:
+        mask_array = cv2.cvtColor(mask_array,cv2.COLOR_BGR2GRAY)
+    mask_image = (mask_array/255).astype(np.float32)
+    mask_image = np.ascontiguousarray(mask_image[y-y_s:y1-y_s, x-x_s:x1-x_s])
+    return mask_image,1-mask_image
+
+def get_image_blending_into(out,image,face,face_box,blend_weights):
+    """
+    Same result as get_image_blending, but writes into the preallocated out frame
+    instead of modifying a deep copy of image.
+    """
+    x, y, x1, y1 = face_box
+    mask_image,mask_image_inv = blend_weights
+    np.copyto(out,image)
+    cv2.blendLinear(face,image[y:y1, x:x1],mask_image,mask_image_inv,dst=out[y:y1, x:x1])
+    return out
\ No newline at end of file
@@ -1,7 +1,10 @@
 import os
 from .whisper import load_model
+from .whisper.audio import mel_filters, N_FFT, HOP_LENGTH
 import soundfile as sf
 import numpy as np
+import torch
+import torch.nn.functional as F
 import time
 import sys
 sys.path.append("..")
@@ -79,22 +82,28 @@ class Audio2Feature():
         return selected_feature,selected_idx
     
 
-    def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [2,2],start=0):
-        whisper_chunks = []
-        whisper_idx_multiplier = 50./fps 
-        i = 0
-        #print(f"video in {fps} FPS, audio idx in 50FPS")
-        for _ in range(batch_size):
-            # start_idx = int(i * whisper_idx_multiplier)
-            # if start_idx>=len(feature_array):
-            #     break
-            selected_feature,selected_idx = self.get_sliced_feature(feature_array= feature_array,vid_idx = i+start,audio_feat_length=audio_feat_length,fps=fps)
-            #print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-            
-
-        return whisper_chunks
+    def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [2,2],start=0,out=None,pin_memory=False):
+        """
+        get_sliced_feature for video frames start..start+batch_size in one gather
+        :param out: optional preallocated contiguous [batch_size, 50, 384] buffer of the feature dtype
+        :param pin_memory: return a torch tensor in pinned memory instead of an ndarray
+        :return: [batch_size, 50, 384]
+        """
+        feature_array = np.asarray(feature_array)
+        center_idx = ((np.arange(batch_size) + start)*50/fps).astype(np.int64) #truncated like int()
+        idx = center_idx[:,np.newaxis] + np.arange(-audio_feat_length[0]*2, (audio_feat_length[1]+1)*2)
+        shape = (batch_size, idx.shape[1]*int(np.prod(feature_array.shape[1:]))//384, 384)
+        tensor = None
+        if out is None:
+            if pin_memory and torch.cuda.is_available():
+                tensor = torch.empty(shape, dtype=torch.from_numpy(feature_array[:0]).dtype, pin_memory=True)
+                out = tensor.numpy()
+            else:
+                out = np.empty(shape, dtype=feature_array.dtype)
+        np.take(feature_array, idx, axis=0, out=out.reshape(idx.shape + feature_array.shape[1:]), mode='clip')
+        if pin_memory:
+            return tensor if tensor is not None else torch.from_numpy(out)
+        return out
 
     def audio2feat(self,audio_path):
         # get the sample rate of the audio
@@ -111,6 +120,83 @@ class Audio2Feature():
         concatenated_array = np.concatenate(embed_list, axis=0)
         return concatenated_array
 
+class Audio2FeatureStream():
+    """
+    Incremental whisper feature extraction for one ASR session.
+    Keeps the log-mel columns of the sliding window between steps and only computes
+    the columns of newly arrived audio, runs the encoder on the short window instead
+    of a padded 30s segment, and reuses the left context features of the last step.
+    """
+    def __init__(self, audio_processor:Audio2Feature, stride_left, overlap=4, chunk=320):
+        self.model = audio_processor.model
+        self.stride_left = stride_left
+        self.overlap = min(overlap, stride_left)
+        self.chunk = chunk
+        self.mel = None # raw log10 mel of current window, [80, 2*frames]
+        self.feats = None # encoder embeddings of current window, [frames, 5, 384]
+        self.dtype = torch.float16 if self.model.device.type == "cuda" else torch.float32
+
+    def reset(self):
+        self.mel = None
+        self.feats = None
+
+    def __log_mel(self, audio, start_col, num_cols):
+        # columns centered at start_col*HOP_LENGTH.., same framing as log_mel_spectrogram
+        start = start_col*HOP_LENGTH - N_FFT//2
+        pad_left = max(0, -start)
+        segment = torch.from_numpy(audio[max(0, start):])
+        segment = F.pad(segment[None, None], (pad_left, N_FFT//2), mode="reflect")[0, 0]
+        window = torch.hann_window(N_FFT)
+        stft = torch.stft(segment, N_FFT, HOP_LENGTH, window=window, center=False, return_complex=True)
+        magnitudes = stft[:, :num_cols].abs() ** 2
+        mel_spec = mel_filters(magnitudes.device) @ magnitudes
+        return torch.clamp(mel_spec, min=1e-10).log10().numpy()
+
+    @torch.no_grad()
+    def __encode(self, mel, start):
+        encoder = self.model.encoder
+        x = torch.from_numpy(mel)[None].to(device=self.model.device, dtype=self.dtype)
+        x = F.gelu(encoder.conv1(x))
+        x = F.gelu(encoder.conv2(x))
+        x = x.permute(0, 2, 1)
+        x = (x + encoder.positional_embedding[start:start+x.shape[1]]).to(x.dtype)
+        embeddings = [x]
+        for block in encoder.blocks:
+            x = block(x)
+            embeddings.append(x)
+        return torch.stack(embeddings, dim=2)[0].cpu().numpy() # [frames, 5, 384]
+
+    def audio2feat(self, audio, new_samples):
+        """
+        :param audio: 16k pcm of the whole sliding window
+        :param new_samples: number of samples appended since the last call
+        :return: encoder embeddings of the window, [frames, 5, 384] like Audio2Feature.audio2feat
+        """
+        audio = audio.astype(np.float32, copy=False)
+        frames = len(audio) // self.chunk
+        cols = frames * 2
+        new_frames = new_samples // self.chunk
+        if self.mel is None or self.mel.shape[1] != cols or new_frames >= frames:
+            self.mel = self.__log_mel(audio, 0, cols)
+            dirty = 0
+        else:
+            # the last columns of the previous window were computed on reflected padding
+            dirty = max(0, cols - new_frames*2 - N_FFT//2//HOP_LENGTH - 1)
+            self.mel = np.concatenate((self.mel[:, new_frames*2:dirty+new_frames*2],
+                                       self.__log_mel(audio, dirty, cols-dirty)), axis=1)
+        log_spec = np.maximum(self.mel, self.mel.max() - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+
+        if self.feats is None or len(self.feats) != frames or new_frames + self.stride_left > frames:
+            feats = self.__encode(log_spec, 0)
+        else:
+            cached = self.feats[new_frames:new_frames+self.stride_left]
+            start = self.stride_left - self.overlap
+            fresh = self.__encode(log_spec[:, start*2:], start)
+            feats = np.concatenate((cached, fresh[self.overlap:]), axis=0)
+        self.feats = feats
+        return feats
+
 if __name__ == "__main__":
     audio_processor = Audio2Feature(model_path="../../models/whisper/whisper_tiny.pt")
     audio_path = "./test.mp3"
@@ -0,0 +1,122 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+onnxruntime cpu backend for the wav2lip and ultralight models (--backend onnx).
+OnnxModel is called like the torch model it wraps. The torch model is exported next to its
+checkpoint once per input shape, so every graph has fixed batch shapes, and re-exported
+when the checkpoint is newer than the export.
+"""
+
+import os
+import inspect
+import threading
+
+import numpy as np
+import torch
+
+from logger import logger
+
+ONNX_OPSET = 11
+
+def parse_cpus(spec:str):
+    """'0-3,6' -> [0,1,2,3,6]"""
+    cpus = []
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last)+1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+class OnnxModel:
+    def __init__(self, model, checkpoint, threads=0, cpus='', quantize=False):
+        import onnxruntime
+        self.ort = onnxruntime
+        self.model = model
+        self.checkpoint = checkpoint
+        self.prefix = os.path.splitext(checkpoint)[0]
+        self.threads = threads
+        self.cpus = parse_cpus(cpus)
+        self.quantize = quantize
+        self.sessions = {} #input shapes:InferenceSession
+        self.lock = threading.Lock()
+
+    def __call__(self, *inputs):
+        shapes = tuple(tuple(x.shape) for x in inputs)
+        session = self.sessions.get(shapes)
+        if session is None:
+            session = self.__load(inputs, shapes)
+        feed = {arg.name: x.detach().float().cpu().numpy() for arg, x in zip(session.get_inputs(), inputs)}
+        out = session.run(None, feed)[0]
+        return torch.from_numpy(out).to(inputs[0].device)
+
+    def __export(self, inputs, path):
+        logger.info('export onnx model %s', path)
+        kwargs = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            kwargs['dynamo'] = False #torchscript exporter, newer torch defaults to dynamo
+        with torch.no_grad():
+            torch.onnx.export(self.model, tuple(inputs), path + '.tmp',
+                              input_names=[f'input{i}' for i in range(len(inputs))], output_names=['output'],
+                              opset_version=ONNX_OPSET, export_params=True, **kwargs)
+        os.replace(path + '.tmp', path)
+
+    def __stale(self, path):
+        return not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(self.checkpoint)
+
+    def __load(self, inputs, shapes):
+        with self.lock:
+            if shapes in self.sessions:
+                return self.sessions[shapes]
+            path = self.prefix + '_' + '_'.join('x'.join(map(str, shape)) for shape in shapes) + '.onnx'
+            if self.__stale(path):
+                self.__export(inputs, path)
+            if self.quantize:
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                int8_path = path[:-len('.onnx')] + '_int8.onnx'
+                if self.__stale(int8_path) or os.path.getmtime(int8_path) < os.path.getmtime(path):
+                    logger.info('quantize onnx model %s', int8_path)
+                    quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+                path = int8_path
+
+            options = self.ort.SessionOptions()
+            options.graph_optimization_level = self.ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.execution_mode = self.ort.ExecutionMode.ORT_SEQUENTIAL
+            options.inter_op_num_threads = 1
+            if self.cpus:
+                #the calling thread is the first intra op thread, pin the others one per cpu
+                #(onnxruntime counts logical processors from 1)
+                options.intra_op_num_threads = len(self.cpus)
+                if len(self.cpus) > 1:
+                    options.add_session_config_entry('session.intra_op_thread_affinities',
+                                                     ';'.join(str(cpu+1) for cpu in self.cpus[1:]))
+            elif self.threads > 0:
+                options.intra_op_num_threads = self.threads
+            session = self.ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.sessions[shapes] = session
+            logger.info('onnx session %s', path)
+            return session
+
+def backend_model(model, checkpoint, opt):
+    """model run by the backend selected with --backend, the torch model itself for torch"""
+    if opt.backend == 'onnx':
+        return OnnxModel(model, checkpoint, opt.onnx_threads, opt.onnx_cpus, opt.onnx_quantize)
+    return model
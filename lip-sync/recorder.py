@@ -0,0 +1,118 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Session recording into one mp4 with PyAV. The render thread only copies frames into a
+bounded queue, a writer thread encodes and muxes them. When the writer falls behind frames
+are dropped from the recording, never blocking the live stream; timestamps are assigned on
+submission so audio and video stay in sync across drops.
+"""
+
+import os
+import queue
+import threading
+from fractions import Fraction
+
+import av
+import numpy as np
+from av import AudioFrame, VideoFrame
+
+from logger import logger
+
+class Recorder:
+    def __init__(self, path, fps=25, sample_rate=16000, maxsize=100):
+        self.path = path
+        self.fps = fps
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(maxsize)
+        self.video_pts = 0
+        self.audio_pts = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.__write, daemon=True, name="recorder")
+        self.thread.start()
+
+    def __put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning('recorder %s behind, dropped %d frames', self.path, self.dropped)
+
+    def put_video(self, image):
+        """bgr24 frame, copied since the caller may reuse its buffer"""
+        self.__put(('video', np.array(image), self.video_pts))
+        self.video_pts += 1
+
+    def put_audio(self, pcm):
+        """int16 mono pcm"""
+        self.__put(('audio', np.array(pcm, dtype=np.int16), self.audio_pts))
+        self.audio_pts += len(pcm)
+
+    def close(self):
+        """finish the file, returns once it is written"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def __write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        container = av.open(self.path, mode='w')
+        video_stream = None
+        audio_stream = container.add_stream('aac', rate=self.sample_rate, layout='mono')
+        # the muxer may change the stream time bases, frames keep the ones their pts count in
+        video_time_base = Fraction(1, self.fps)
+        audio_time_base = Fraction(1, self.sample_rate)
+        pending_audio = [] #audio before the first video frame, video sets up the container
+        item = True
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                kind, data, pts = item
+                if kind == 'video':
+                    if video_stream is None:
+                        video_stream = container.add_stream('libx264', rate=self.fps)
+                        video_stream.width = data.shape[1] - data.shape[1] % 2
+                        video_stream.height = data.shape[0] - data.shape[0] % 2
+                        video_stream.pix_fmt = 'yuv420p'
+                    frame = VideoFrame.from_ndarray(data[:video_stream.height, :video_stream.width], format='bgr24')
+                    frame.pts = pts
+                    frame.time_base = video_time_base
+                    container.mux(video_stream.encode(frame))
+                    for audio in pending_audio:
+                        container.mux(audio_stream.encode(audio))
+                    pending_audio = []
+                else:
+                    frame = AudioFrame.from_ndarray(data.reshape(1, -1), format='s16', layout='mono')
+                    frame.sample_rate = self.sample_rate
+                    frame.pts = pts
+                    frame.time_base = audio_time_base
+                    if video_stream is None:
+                        pending_audio.append(frame)
+                    else:
+                        container.mux(audio_stream.encode(frame))
+            if video_stream is not None:
+                container.mux(video_stream.encode(None))
+                container.mux(audio_stream.encode(None))
+        except Exception:
+            logger.exception('recorder %s', self.path)
+            while item is not None: #keep taking frames until close()
+                item = self.queue.get()
+        finally:
+            container.close()
+        logger.info('recorded %s, %d video frames, %d dropped', self.path, self.video_pts, self.dropped)
@@ -0,0 +1,99 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Sessions built and warmed before the offers that use them (--session_pool). An offer takes
+an idle session, so connecting does not wait for the tts, asr warm up and queues to be built.
+A session whose connection closed is reset and returned to the pool; one that cannot be
+reset is dropped and a new one is built in its place. Idle sessions built before a global
+/switch_avatar changed the defaults of new sessions are dropped and rebuilt.
+"""
+
+import threading
+from typing import Callable, Dict
+
+from basereal import BaseReal
+from logger import logger
+
+class SessionPool:
+    def __init__(self, build:Callable[[int],BaseReal], size:int, defaults:Dict):
+        self.build = build
+        self.size = size
+        self.defaults = defaults #opt values of new sessions, updated by /switch_avatar
+        self.idle = []
+        self.lock = threading.Lock()
+        self.filling = False
+        self.__start_fill()
+
+    def __current(self, nerfreal:BaseReal)->bool:
+        return all(getattr(nerfreal.opt, name, None) == value for name, value in self.defaults.items())
+
+    def __start_fill(self):
+        with self.lock:
+            if self.filling:
+                return
+            self.filling = True
+        threading.Thread(target=self.__fill, daemon=True, name="session-pool").start()
+
+    def __fill(self):
+        while True:
+            with self.lock:
+                if len(self.idle) >= self.size:
+                    self.filling = False
+                    break
+            try:
+                self.__add(self.build(0))
+            except Exception:
+                logger.exception('session pool build')
+                with self.lock:
+                    self.filling = False
+                return
+        logger.info('session pool ready with %d sessions', self.size)
+
+    def __add(self, nerfreal:BaseReal):
+        with self.lock:
+            if len(self.idle) < self.size and self.__current(nerfreal):
+                self.idle.append(nerfreal)
+
+    def refresh(self):
+        """drop the idle sessions not matching the defaults and build their replacements"""
+        with self.lock:
+            stale = len(self.idle)
+            self.idle = [nerfreal for nerfreal in self.idle if self.__current(nerfreal)]
+            stale -= len(self.idle)
+        if stale:
+            logger.info('session pool dropped %d sessions of the previous avatar', stale)
+            self.__start_fill()
+
+    def acquire(self, sessionid:int)->BaseReal:
+        """an idle session renamed to sessionid, or a new one when none is idle"""
+        self.refresh()
+        with self.lock:
+            nerfreal = self.idle.pop() if self.idle else None
+        if nerfreal is None:
+            logger.info('session pool empty, building session %d', sessionid)
+            nerfreal = self.build(sessionid)
+        nerfreal.sessionid = nerfreal.opt.sessionid = sessionid
+        return nerfreal
+
+    def release(self, nerfreal:BaseReal):
+        """return a closed session, blocks until its render threads stopped"""
+        if nerfreal.reset() and self.__current(nerfreal):
+            self.__add(nerfreal)
+        else:
+            logger.info('session %d not reusable, building a replacement', nerfreal.sessionid)
+            self.__add(self.build(0))
@@ -0,0 +1,13 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import musetalk.utils  # puts face_parsing on sys.path
+import face_parsing
+
+# musetalk.utils.blending builds a face parser at import; without the weights the unit tests
+# still import it, they never segment a face
+if not os.path.isfile(os.path.join(ROOT, 'models/face-parse-bisent/79999_iter.pth')):
+    face_parsing.FaceParsing.__init__ = lambda self, *args, **kwargs: None
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from musetalk.whisper.audio2feature import Audio2Feature as WhisperFeature
+from ultralight.audio2feature import Audio2Feature as HubertFeature
+
+
+def _sliced(processor, feature_array, fps, batch_size, start, audio_feat_length):
+    return np.stack([processor.get_sliced_feature(feature_array, start + i, audio_feat_length=audio_feat_length, fps=fps)[0]
+                     for i in range(batch_size)])
+
+
+@pytest.mark.parametrize('start', [0, 5.0, 90])
+def test_hubert_feature2chunks_matches_get_sliced_feature(start):
+    processor = object.__new__(HubertFeature) #no model needed for slicing
+    feature_array = np.random.default_rng(0).standard_normal((200, 1024)).astype(np.float32)
+    chunks = processor.feature2chunks(feature_array, fps=25, batch_size=8, audio_feat_length=[8, 8], start=start)
+    np.testing.assert_array_equal(chunks, _sliced(processor, feature_array, 25, 8, start, [8, 8]))
+
+    out = np.empty_like(chunks)
+    assert processor.feature2chunks(feature_array, fps=25, batch_size=8, start=start, out=out) is out
+    np.testing.assert_array_equal(out, chunks)
+
+
+@pytest.mark.parametrize('start', [0, 5.0, 90])
+def test_whisper_feature2chunks_matches_get_sliced_feature(start):
+    processor = object.__new__(WhisperFeature)
+    feature_array = np.random.default_rng(1).standard_normal((200, 5, 384)).astype(np.float32)
+    chunks = processor.feature2chunks(feature_array, fps=25, batch_size=8, start=start)
+    assert chunks.shape == (8, 50, 384)
+    np.testing.assert_array_equal(chunks, _sliced(processor, feature_array, 25, 8, start, [2, 2]))
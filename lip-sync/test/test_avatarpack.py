@@ -0,0 +1,46 @@
+import os
+import time
+
+import numpy as np
+
+from avatarpack import PACK_FILE, AvatarPack, open_pack, pack_musetalk, write_pack
+
+
+def test_round_trip_dense_ragged_and_empty(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 255, (4, 6, 3), dtype=np.uint8) for _ in range(3)]
+    faces = [rng.integers(0, 255, (2 + i, 3, 3), dtype=np.uint8) for i in range(3)]
+    coords = np.arange(12, dtype=np.int32).reshape(3, 4)
+    path = str(tmp_path / PACK_FILE)
+    write_pack(path, {'frames': frames, 'faces': faces, 'coords': coords, 'empty': []}, meta={'model': 'test'})
+
+    pack = AvatarPack(path)
+    assert pack.meta == {'model': 'test'}
+    np.testing.assert_array_equal(pack['frames'], np.stack(frames))
+    for face, packed in zip(faces, pack['faces']):
+        np.testing.assert_array_equal(packed, face)
+    np.testing.assert_array_equal(pack['coords'], coords)
+    assert len(pack['empty']) == 0
+
+
+def test_pack_musetalk_blend_weights(tmp_path):
+    from musetalk.utils.blending import get_blend_weights
+    frames = [np.zeros((64, 64, 3), np.uint8)]
+    masks = [np.random.default_rng(1).integers(0, 255, (40, 40, 3), dtype=np.uint8)]
+    coords = [(10, 12, 30, 34)]
+    mask_coords = [(4, 6, 44, 46)]
+    pack_musetalk(str(tmp_path), frames, masks, coords, mask_coords, np.zeros((1, 1, 8, 32, 32), np.float32))
+    pack = open_pack(str(tmp_path))
+    weights, weights_inv = get_blend_weights(masks[0], coords[0], mask_coords[0])
+    np.testing.assert_array_equal(pack['blend'], weights[np.newaxis])
+    np.testing.assert_array_equal(pack['blend_inv'], weights_inv[np.newaxis])
+
+
+def test_open_pack_ignores_pack_older_than_folders(tmp_path):
+    os.makedirs(tmp_path / 'full_imgs')
+    (tmp_path / 'full_imgs' / '00000000.png').write_bytes(b'')
+    write_pack(str(tmp_path / PACK_FILE), {'frames': np.zeros((1, 2, 2, 3), np.uint8)})
+    assert open_pack(str(tmp_path)) is not None
+    later = time.time() + 10
+    os.utime(tmp_path / 'full_imgs' / '00000000.png', (later, later))
+    assert open_pack(str(tmp_path)) is None
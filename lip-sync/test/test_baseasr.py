@@ -0,0 +1,50 @@
+import numpy as np
+
+from baseasr import AudioOutQueue
+
+
+def _speech(i, eventpoint=None):
+    return np.full(320, 0.1 + i, np.float32), 0, eventpoint
+
+
+def test_cancel_skips_stale_batches_and_silences_the_straddling_one():
+    notified = []
+    queue = AudioOutQueue(20, notify=notified.append)
+    queue.put(_speech(0, {'status': 'start'}))
+    for i in range(1, 6):
+        queue.put(_speech(i))
+    queue.cancel()
+    for i in range(6, 10):
+        queue.put(_speech(i))
+    assert queue.is_stale(5) and not queue.is_stale(6)
+
+    assert queue.skip_stale(4)
+    assert notified == [{'status': 'start'}]
+    assert queue.position(0) == 4 #the skipped frames 0..3
+    assert queue.qsize() == 6
+
+    assert not queue.skip_stale(4) #frames 4,5 stale, 6,7 not
+    frames = [queue.get() for _ in range(4)]
+    assert [type for _, type, _ in frames] == [1, 1, 0, 0]
+    assert not frames[0][0].any()
+    np.testing.assert_array_equal(frames[2][0], _speech(6)[0])
+
+
+def test_cancel_keeps_silence_and_custom_audio():
+    queue = AudioOutQueue(4)
+    custom = (np.ones(320, np.float32), 2, None)
+    queue.put(custom)
+    queue.put(_speech(1))
+    queue.cancel()
+    assert queue.get() is custom
+    frame, type, _ = queue.get()
+    assert type == 1 and not frame.any()
+
+
+def test_reset_forgets_cancel():
+    queue = AudioOutQueue(4)
+    queue.put(_speech(0))
+    queue.cancel()
+    queue.reset()
+    assert queue.empty() and not queue.is_stale(0)
+    assert not queue.skip_stale(1)
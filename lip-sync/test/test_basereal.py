@@ -0,0 +1,63 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+
+from benchmark import StubWav2Lip, make_avatar, session_opt
+
+
+class _Track:
+    def __init__(self):
+        self.items = []
+
+    def put_frame_threadsafe(self, item, loop, quit_event):
+        self.items.append(item)
+        return True
+
+
+def _session(batch_size):
+    import lipreal
+    args = argparse.Namespace(batch_size=batch_size, backend='torch', stream_asr=False, idle_cache=False,
+                              video_encoder='aiortc', sessions=1, utterance=1)
+    model = StubWav2Lip().to(lipreal.device).eval()
+    return lipreal.LipReal(session_opt(args, 0), model, make_avatar(4, 96, 96, 64))
+
+
+def _speech(text, i):
+    return np.full(320, 0.1, np.float32), 0, {'text': text, 'frame': i}
+
+
+def _render(real, queue, count):
+    """inference of one batch: its audio frames, two per video frame, into res_frame_queue"""
+    frames = [queue.get() for _ in range(count)]
+    for i in range(0, count, 2):
+        real.res_frame_queue.put((np.zeros((64, 64, 3), np.uint8), 0, frames[i:i + 2]))
+
+
+def test_fresh_speech_after_skipped_batch_is_played():
+    real = _session(batch_size=2)
+    queue = real.asr.output_queue
+    queue.reset()
+    for i in range(8):
+        queue.put(_speech('old', i))
+    _render(real, queue, 4) #rendered before the flush, still queued for process_frames
+    queue.cancel()
+    assert queue.skip_stale(4) #the next batch is dropped by inference
+    for i in range(4):
+        queue.put(_speech('new', i))
+    _render(real, queue, 4)
+
+    audio, video = _Track(), _Track()
+    quit_event = threading.Event()
+    thread = threading.Thread(target=real.process_frames, args=(quit_event, object(), audio, video))
+    thread.start()
+    end = time.time() + 5
+    while len(audio.items) < 4 and time.time() < end:
+        time.sleep(0.01)
+    quit_event.set()
+    thread.join(5)
+
+    assert [eventpoint for _, eventpoint in audio.items] == [{'text': 'new', 'frame': i} for i in range(4)]
+    assert len(video.items) == 2
+    assert real._audio_pos == 12
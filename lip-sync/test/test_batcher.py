@@ -0,0 +1,47 @@
+import threading
+import time
+
+import torch
+
+from ultralight.audio2feature import FeatureBatcher
+
+
+class _Hubert:
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, extract_features):
+        self.batches.append(len(extract_features))
+        return extract_features * 2
+
+
+def test_silent_session_is_not_waited_for():
+    hubert = _Hubert()
+    batcher = FeatureBatcher(hubert, deadline=5)
+    batcher.register()
+    batcher.register() #a second session that stays silent
+    batcher.speaking(True)
+    t = time.perf_counter()
+    out = batcher(torch.ones(1, 4, 2))
+    assert time.perf_counter() - t < 1
+    torch.testing.assert_close(out, torch.full((1, 4, 2), 2.0))
+    assert hubert.batches == [1]
+
+
+def test_speaking_sessions_share_a_batch():
+    hubert = _Hubert()
+    batcher = FeatureBatcher(hubert, deadline=5)
+    for _ in range(2):
+        batcher.register()
+        batcher.speaking(True)
+    results = [None, None]
+    def submit(i):
+        results[i] = batcher(torch.full((1, 4, 2), float(i)))
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert hubert.batches == [2]
+    for i in range(2):
+        torch.testing.assert_close(results[i], torch.full((1, 4, 2), 2.0 * i))
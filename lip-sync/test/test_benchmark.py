@@ -0,0 +1,20 @@
+import argparse
+
+import pytest
+
+from benchmark import load, run
+
+
+def _args(pipeline):
+    return argparse.Namespace(pipeline=pipeline, model='stub', backend='torch', batch_size=4, frames=8, size='128x128',
+                              face=64, sessions=1, duration=1, warmup=0.5, utterance=1, pause=0.2, realtime=False,
+                              stream_asr=False, idle_cache=False, video_encoder='aiortc')
+
+
+@pytest.mark.parametrize('pipeline', ['wav2lip', 'musetalk', 'ultralight'])
+def test_smoke(pipeline):
+    args = _args(pipeline)
+    model, avatar = load(args)
+    report = run(args, 1, model, avatar)
+    assert report['fps_total'] > 0
+    assert report['stages_ms']['inference']['n'] > 0
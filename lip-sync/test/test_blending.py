@@ -0,0 +1,25 @@
+import numpy as np
+
+from musetalk.utils.blending import get_blend_weights, get_image_blending, get_image_blending_into
+
+
+def test_blending_into_matches_get_image_blending():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (120, 100, 3), dtype=np.uint8)
+    face_box = (30, 40, 70, 90)
+    crop_box = (20, 25, 80, 105)
+    x, y, x1, y1 = face_box
+    face = rng.integers(0, 255, (y1 - y, x1 - x, 3), dtype=np.uint8)
+    mask = rng.integers(0, 255, (crop_box[3] - crop_box[1], crop_box[2] - crop_box[0], 3), dtype=np.uint8)
+    #the mask is zero outside the face box, as the face parsing masks of the avatars
+    mask[:y - crop_box[1]] = 0
+    mask[y1 - crop_box[1]:] = 0
+    mask[:, :x - crop_box[0]] = 0
+    mask[:, x1 - crop_box[0]:] = 0
+
+    expected = get_image_blending(image.copy(), face, face_box, mask, crop_box)
+    out = np.empty_like(image)
+    result = get_image_blending_into(out, image, face, face_box, get_blend_weights(mask, face_box, crop_box))
+    assert result is out
+    np.testing.assert_array_equal(out, expected)
+    assert not np.shares_memory(out, image)
@@ -0,0 +1,61 @@
+import asyncio
+import json
+
+import aiohttp
+from aiohttp import web
+
+from dispatcher import Dispatcher, Worker, parse_cpus
+
+
+def _worker(index, load, max_sessions, healthy=True):
+    worker = Worker(index, 8110 + index, [], 'token')
+    worker.healthy = healthy
+    worker.max_sessions = max_sessions
+    worker.sessions = set(range(index * 100, index * 100 + load))
+    return worker
+
+
+def test_parse_cpus():
+    assert parse_cpus('0-3,8') == {0, 1, 2, 3, 8}
+    assert parse_cpus('5') == {5}
+
+
+def test_place_least_loaded_share():
+    workers = [_worker(0, 2, 4), _worker(1, 1, 4), _worker(2, 0, 4, healthy=False)]
+    assert Dispatcher(workers, 2).place() is workers[1]
+
+    workers[1].pending.update({1, 2})
+    assert Dispatcher(workers, 2).place() is workers[0]
+
+    #a bigger worker with more sessions can still have the lower share in use
+    workers = [_worker(0, 1, 2), _worker(1, 2, 8)]
+    assert Dispatcher(workers, 2).place() is workers[1]
+
+
+def test_place_none_when_full():
+    workers = [_worker(0, 2, 2), _worker(1, 0, 2, healthy=False)]
+    assert Dispatcher(workers, 2).place() is None
+
+
+def test_forward_malformed_sessionid():
+    async def run():
+        dispatcher = Dispatcher([], 2)
+        app = web.Application()
+        app.router.add_post('/humanaudio', dispatcher.forward)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            data = aiohttp.FormData()
+            data.add_field('sessionid', 'abc')
+            data.add_field('file', b'\0\0', filename='a.wav')
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f'http://127.0.0.1:{port}/humanaudio', data=data) as response:
+                    return response.status, json.loads(await response.read())
+        finally:
+            await runner.cleanup()
+    status, answer = asyncio.run(run())
+    assert status == 200
+    assert answer['code'] == -1 and 'abc' in answer['msg']
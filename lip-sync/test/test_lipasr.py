@@ -0,0 +1,52 @@
+import argparse
+
+import numpy as np
+import pytest
+
+from lipasr import LipASR
+
+
+def _opt(stream_asr):
+    return argparse.Namespace(fps=50, batch_size=4, l=10, r=10, stream_asr=stream_asr)
+
+
+def _steps(stream_asr, audio, steps):
+    asr = LipASR(_opt(stream_asr))
+    asr.warm_up()
+    chunks = []
+    frame = 0
+    for _ in range(steps):
+        for _ in range(asr.batch_size * 2):
+            if frame < len(audio):
+                asr.put_audio_frame(audio[frame])
+            frame += 1
+        asr.run_step()
+        chunks.append(asr.feat_queue.get(timeout=1))
+        while not asr.output_queue.empty(): #played out by inference in a session
+            asr.output_queue.get()
+    return chunks
+
+
+@pytest.mark.parametrize('leading_silence', [0, 16])
+def test_mel_stream_matches_melspectrogram(leading_silence):
+    t = np.arange(320 * 60) / 16000
+    speech = (0.3 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 3 * t)) / 2).astype(np.float32)
+    audio = [np.zeros(320, np.float32)] * leading_silence + list(speech.reshape(-1, 320))
+    expected = _steps(False, audio, 8)
+    streamed = _steps(True, audio, 8)
+    # a step moves the window by 12.8 mel columns: every 5th window starts on the stream's
+    # column grid and matches exactly, the others are rounded to the nearest column
+    for step, (want, got) in enumerate(zip(expected, streamed)):
+        assert got.shape == want.shape
+        if step % 5 == 0:
+            np.testing.assert_allclose(got, want, atol=1e-4)
+        else:
+            assert np.abs(got - want).mean() < 0.1
+
+
+def test_silent_chunks_are_normalized_silence():
+    asr = LipASR(_opt(True))
+    asr.warm_up()
+    asr.run_step()
+    chunks = asr.feat_queue.get(timeout=1)
+    assert chunks.min() == chunks.max() == pytest.approx(-4.0)
@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+
+import metrics
+
+
+def test_render_histogram_and_remove_session():
+    histogram = metrics.Histogram('test_stage_seconds', 'test stage', ('session',), buckets=(0.01, 0.1))
+    histogram.labels(1).observe(0.005)
+    histogram.labels(1).observe(0.05)
+    histogram.labels(2).observe(1.0)
+    text = metrics.render()
+    assert '# TYPE test_stage_seconds histogram' in text
+    assert 'test_stage_seconds_bucket{session="1",le="0.01"} 1' in text
+    assert 'test_stage_seconds_bucket{session="1",le="0.1"} 2' in text
+    assert 'test_stage_seconds_bucket{session="1",le="+Inf"} 2' in text
+    assert 'test_stage_seconds_count{session="2"} 1' in text
+    metrics.remove_session(1)
+    text = metrics.render()
+    assert 'session="1"' not in text
+    assert 'test_stage_seconds_count{session="2"} 1' in text
+
+
+def test_render_counter_gauge_and_escaping():
+    counter = metrics.Counter('test_frames', 'test frames', ('kind',))
+    counter.labels('video').inc()
+    counter.labels('video').inc(2)
+    gauge = metrics.Gauge('test_level', 'test level', ('name',))
+    gauge.labels('a"b').set(3)
+    text = metrics.render()
+    assert 'test_frames_total{kind="video"} 3.0' in text
+    assert 'test_level{name="a\\"b"} 3' in text
+
+
+class _Unet:
+    device = 'cpu'
+
+    def __init__(self):
+        self.model = self
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def __call__(self, latent_batch, timesteps, encoder_hidden_states):
+        class Output:
+            sample = latent_batch[:, :4]
+        return Output()
+
+
+class _Vae:
+    def decode_latents(self, latents):
+        return np.zeros((len(latents), 256, 256, 3), np.uint8)
+
+
+def test_infer_batch_timed_records_unet_and_vae():
+    from musereal import infer_batch
+    before = sum(sum(series.counts) for series in metrics.unet.series.values())
+    recon = infer_batch(_Vae(), _Unet(), lambda feature: feature, torch.tensor([0]),
+                        np.ones((2, 50, 384), dtype=np.uint8), torch.ones(2, 8, 32, 32), timed=True)
+    assert recon.shape == (2, 256, 256, 3)
+    assert sum(sum(series.counts) for series in metrics.unet.series.values()) == before + 1
+    assert sum(sum(series.counts) for series in metrics.vae_decode.series.values()) >= 1
@@ -0,0 +1,50 @@
+import argparse
+import time
+
+from sessionpool import SessionPool
+
+
+class _Session:
+    def __init__(self, avatar_id):
+        self.opt = argparse.Namespace(avatar_id=avatar_id, REF_FILE='voice', sessionid=0)
+        self.sessionid = 0
+
+    def reset(self):
+        return True
+
+
+def _wait(condition, timeout=2):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_switch_rebuilds_idle_sessions():
+    defaults = {}
+    built = []
+    def build(sessionid):
+        session = _Session(defaults.get('avatar_id', 'avatar1'))
+        built.append(session)
+        return session
+    pool = SessionPool(build, 2, defaults)
+    assert _wait(lambda: len(pool.idle) == 2)
+
+    defaults['avatar_id'] = 'avatar2'
+    pool.refresh()
+    assert _wait(lambda: len(pool.idle) == 2 and not pool.filling)
+    assert [session.opt.avatar_id for session in pool.idle] == ['avatar2', 'avatar2']
+
+    session = pool.acquire(7)
+    assert session.sessionid == session.opt.sessionid == 7 and session.opt.avatar_id == 'avatar2'
+
+
+def test_release_of_previous_avatar_is_replaced():
+    defaults = {}
+    pool = SessionPool(lambda sessionid: _Session(defaults.get('avatar_id', 'avatar1')), 1, defaults)
+    assert _wait(lambda: len(pool.idle) == 1)
+    session = pool.acquire(1)
+    defaults['avatar_id'] = 'avatar2'
+    pool.release(session)
+    assert _wait(lambda: len(pool.idle) == 1)
+    assert pool.idle[0] is not session and pool.idle[0].opt.avatar_id == 'avatar2'
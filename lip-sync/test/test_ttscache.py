@@ -0,0 +1,46 @@
+import os
+import time
+
+import numpy as np
+
+from ttscache import AudioCache
+
+
+def _pcm(value, samples=100):
+    return np.full(samples, value, np.float32) #400 bytes
+
+
+def test_key_normalizes_text():
+    assert AudioCache.key('EdgeTTS', 'voice', ' Hello　 World ') == AudioCache.key('EdgeTTS', 'voice', 'hello world')
+    assert AudioCache.key('EdgeTTS', 'voice', 'hello') != AudioCache.key('EdgeTTS', 'other', 'hello')
+
+
+def test_memory_lru_eviction():
+    cache = AudioCache(1000)
+    cache.put('a', _pcm(1))
+    cache.put('b', _pcm(2))
+    assert cache.get('a') is not None #a is now more recent than b
+    cache.put('c', _pcm(3))
+    assert cache.get('b') is None
+    np.testing.assert_array_equal(cache.get('a'), _pcm(1))
+    np.testing.assert_array_equal(cache.get('c'), _pcm(3))
+    assert cache.size == 800
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache.put('big', _pcm(4, 1000)) #larger than the whole cache, not kept
+    assert cache.get('big') is None and cache.size == 800
+
+
+def test_disk_tier_reload_and_eviction(tmp_path):
+    cache = AudioCache(1000, str(tmp_path), max_disk_bytes=1200)
+    for i, key in enumerate(('a', 'b', 'c')):
+        cache.put(key, _pcm(i))
+        past = time.time() - 100 + i
+        os.utime(tmp_path / f'{key}.npy', (past, past)) #mtime order a < b < c
+    cache.put('d', _pcm(3)) #a .npy of 100 samples is 528 bytes, only the two newest fit
+    assert sorted(os.listdir(tmp_path)) == ['c.npy', 'd.npy']
+
+    reloaded = AudioCache(1000, str(tmp_path))
+    np.testing.assert_array_equal(reloaded.get('c'), _pcm(2))
+    assert reloaded.get('a') is None
+    assert 'c' in reloaded.entries
@@ -0,0 +1,102 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ttsreal import BaseTTS, StreamingResampler
+
+
+class _Parent:
+    sessionid = 0
+
+    def __init__(self):
+        self.frames = []
+
+    def put_audio_frame(self, audio_chunk, eventpoint=None):
+        self.frames.append(eventpoint)
+
+
+class _EndlessTTS(BaseTTS):
+    """a stream that only ends when its message is flushed"""
+    def __init__(self, opt, parent):
+        super().__init__(opt, parent)
+        self.running = set()
+
+    def txt_to_audio(self, msg):
+        text, _ = msg
+        self.running.add(text)
+        try:
+            while not self.stopped():
+                self.put_audio_frame(np.zeros(self.chunk, np.float32), {'text': text})
+                time.sleep(0.01)
+        finally:
+            self.running.discard(text)
+
+
+def _opt(lookahead):
+    return argparse.Namespace(fps=50, tts_lookahead=lookahead, tts_cache_size=0, tts_cache_dir='', max_session=1)
+
+
+def _wait(condition, timeout=2):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_flush_cancels_lookahead_syntheses():
+    parent = _Parent()
+    tts = _EndlessTTS(_opt(2), parent)
+    quit_event = threading.Event()
+    tts.render(quit_event)
+    try:
+        for text in ('a', 'b', 'c'):
+            tts.put_msg_txt(text)
+        assert _wait(lambda: tts.running == {'a', 'b', 'c'})
+        tts.flush_talk()
+        tts.put_msg_txt('d')
+        assert _wait(lambda: tts.running == {'d'})
+        parent.frames.clear()
+        time.sleep(0.1)
+        assert {frame['text'] for frame in parent.frames} == {'d'}
+    finally:
+        tts.flush_talk()
+        quit_event.set()
+        tts.thread.join(2)
+
+
+@pytest.mark.parametrize('sample_rate', [22050, 24000, 32000, 44100, 48000])
+def test_resampler_chunked_equals_one_shot(sample_rate):
+    t = np.arange(sample_rate) / sample_rate
+    stream = (0.5 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+    resampler = StreamingResampler(sample_rate, 16000)
+    one_shot = np.concatenate((resampler.resample(stream), resampler.flush()))
+
+    resampler = StreamingResampler(sample_rate, 16000)
+    rng = np.random.default_rng(0)
+    chunks = []
+    start = 0
+    while start < len(stream):
+        size = int(rng.integers(1, 2000))
+        chunks.append(resampler.resample(stream[start:start + size]))
+        start += size
+    chunks.append(resampler.flush())
+    chunked = np.concatenate(chunks)
+
+    assert len(one_shot) == 16000
+    np.testing.assert_array_equal(chunked, one_shot)
+    t = np.arange(16000) / 16000
+    np.testing.assert_allclose(one_shot[200:-200], 0.5 * np.sin(2 * np.pi * 440 * t)[200:-200], atol=1e-3)
+
+
+def test_update_voice_rereads_ref_file():
+    from ttsreal import TencentTTS
+    opt = _opt(0)
+    opt.REF_FILE = '101001'
+    tts = TencentTTS(opt, _Parent())
+    assert tts.voice_type == 101001
+    opt.REF_FILE = '101002' #as set by /switch_avatar
+    tts.update_voice()
+    assert tts.voice_type == 101002
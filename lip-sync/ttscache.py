@@ -0,0 +1,141 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Cache of synthesized 16k pcm for repeated utterances, shared by all tts sessions.
+Entries are keyed by a hash of (tts backend, voice, normalized text). The memory tier is an
+lru bounded in bytes; the optional disk tier keeps .npy files and evicts the least recently
+used ones when over its size.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from logger import logger
+
+def normalize_text(text:str)->str:
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip().lower()
+
+class AudioCache:
+    def __init__(self, max_bytes:int, cache_dir:str='', max_disk_bytes:int=0):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict() #key:pcm, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(backend:str, voice:str, text:str)->str:
+        return hashlib.sha1('\0'.join((backend, voice or '', normalize_text(text))).encode('utf-8')).hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """cached float32 pcm or None"""
+        with self.lock:
+            pcm = self.entries.get(key)
+            if pcm is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return pcm
+        if self.cache_dir:
+            path = self.__path(key)
+            try:
+                pcm = np.load(path)
+                os.utime(path)
+            except (OSError, ValueError):
+                pcm = None
+            if pcm is not None:
+                with self.lock:
+                    self.hits += 1
+                    self.__insert(key, pcm)
+                return pcm
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, pcm):
+        pcm = np.ascontiguousarray(pcm, dtype=np.float32)
+        with self.lock:
+            self.__insert(key, pcm)
+        if self.cache_dir:
+            path = self.__path(key)
+            try:
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, pcm)
+                os.replace(path + '.tmp', path)
+                self.__evict_disk()
+            except OSError:
+                logger.exception('tts cache write %s', path)
+
+    def __insert(self, key, pcm):
+        if pcm.nbytes > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.nbytes
+        self.entries[key] = pcm
+        self.size += pcm.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def __evict_disk(self):
+        if self.max_disk_bytes <= 0:
+            return
+        files = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_tts_cache(opt):
+    """the process-wide cache configured by --tts_cache_size/--tts_cache_dir, None if disabled"""
+    global _cache
+    if opt.tts_cache_size <= 0 and not opt.tts_cache_dir:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = AudioCache(opt.tts_cache_size*1024*1024, opt.tts_cache_dir, opt.tts_cache_disk_size*1024*1024)
+            logger.info('tts cache %dMB memory, dir %s', opt.tts_cache_size, opt.tts_cache_dir or 'none')
+    return _cache
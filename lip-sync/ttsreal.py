@@ -16,10 +16,12 @@
 ###############################################################################
 from __future__ import annotations
 import time
+import math
 import numpy as np
 import soundfile as sf
-import resampy
+from scipy import signal
 import asyncio
+import av
 import edge_tts
 
 import os
@@ -36,7 +38,8 @@ import requests
 import queue
 from queue import Queue
 from io import BytesIO
-from threading import Thread, Event
+from threading import Thread, Event, Lock, local
+from collections import deque
 from enum import Enum
 
 from typing import TYPE_CHECKING
@@ -44,10 +47,120 @@ if TYPE_CHECKING:
     from basereal import BaseReal
 
 from logger import logger
+from ttscache import get_tts_cache
+import metrics
+
+_resample_filters = {}
+
+def _resample_filter(sr_orig:int, sr_new:int, zeros:int=16):
+    """polyphase bank [up, taps] of a kaiser windowed lowpass for the rate pair, built once"""
+    key = (sr_orig, sr_new)
+    if key not in _resample_filters:
+        g = math.gcd(sr_orig, sr_new)
+        up, down = sr_new // g, sr_orig // g
+        taps = 2 * zeros * max(up, down) + 1
+        h = signal.firwin(taps, 0.95 / max(up, down), window=('kaiser', 8.0)) * up
+        per_phase = -(-taps // up)
+        h = np.pad(h, (0, per_phase * up - taps))
+        # bank[p, j] weights input sample base-j for output phase p
+        _resample_filters[key] = (up, down, (taps - 1) // 2, h.reshape(per_phase, up).T.astype(np.float32))
+    return _resample_filters[key]
+
+class StreamingResampler:
+    """
+    Rational rate resampler for pcm arriving in chunks. The filter state is carried over,
+    so a stream resampled chunk by chunk equals the stream resampled at once, without
+    discontinuities at chunk boundaries. Output is aligned with the input (no filter delay),
+    flush() returns the tail once the input has ended.
+    """
+    def __init__(self, sr_orig:int, sr_new:int):
+        self.up, self.down, self.delay, self.bank = _resample_filter(sr_orig, sr_new)
+        self.taps = self.bank.shape[1]
+        self.x = np.zeros(self.taps - 1, dtype=np.float32) # input kept for the next outputs
+        self.x_start = -(self.taps - 1) # input index of x[0], zeros before the stream
+        self.consumed = 0 # input samples pushed
+        self.produced = 0 # output samples returned
+
+    def __run(self, end):
+        # every output whose newest input sample is below end
+        t_last = (end - 1) * self.up
+        n_end = (t_last - self.delay) // self.down + 1 if t_last >= self.delay else 0
+        if n_end <= self.produced:
+            return np.zeros(0, dtype=np.float32)
+        t = np.arange(self.produced, n_end) * self.down + self.delay
+        base, phase = t // self.up, t % self.up
+        idx = base[:, np.newaxis] - np.arange(self.taps) - self.x_start
+        out = np.einsum('ij,ij->i', self.bank[phase], self.x[idx]).astype(np.float32)
+        self.produced = n_end
+        keep_from = (n_end * self.down + self.delay) // self.up - self.taps + 1
+        if keep_from > self.x_start:
+            self.x = self.x[keep_from - self.x_start:]
+            self.x_start = keep_from
+        return out
+
+    def resample(self, pcm):
+        pcm = np.asarray(pcm, dtype=np.float32)
+        self.x = np.concatenate((self.x, pcm))
+        self.consumed += len(pcm)
+        return self.__run(self.consumed)
+
+    def flush(self):
+        total = -(-self.consumed * self.up // self.down) # output length of the whole input
+        pad = self.delay // self.up + 1
+        self.x = np.concatenate((self.x, np.zeros(pad, dtype=np.float32)))
+        out = self.__run(self.consumed + pad)
+        return out[:max(0, len(out) - (self.produced - total))]
+
+_http_session = None
+_http_lock = Lock()
+
+def get_http_session(pool_size:int=10):
+    """requests.Session shared by all tts sessions, keeping connections to the tts servers alive"""
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+    return _http_session
+
+def http_pool_stats():
+    """(requests, connections opened) over the shared session's pools"""
+    requests_sent = connections = 0
+    if _http_session is not None:
+        for adapter in set(_http_session.adapters.values()):
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+    return requests_sent, connections
+
+_ref_audio = {}
+
+def read_ref_audio(path:str)->bytes:
+    """reference audio file content, read again only when the file changes"""
+    mtime = os.path.getmtime(path)
+    entry = _ref_audio.get(path)
+    if entry is None or entry[0] != mtime:
+        with open(path, 'rb') as f:
+            entry = (mtime, f.read())
+        _ref_audio[path] = entry
+    return entry[1]
+
 class State(Enum):
     RUNNING=0
     PAUSE=1
 
+class MessageSink:
+    """audio frames of one message synthesized ahead of its playout, None at the end"""
+    def __init__(self, generation:int):
+        self.generation = generation
+        self.frames = Queue()
+        self.cancelled = Event() #set by flush_talk, the synthesis stops reading its stream
+
 class BaseTTS:
     def __init__(self, opt, parent:BaseReal):
         self.opt=opt
@@ -60,10 +173,26 @@ class BaseTTS:
 
         self.msgqueue = Queue()
         self.state = State.RUNNING
+        self.generation = 0 #incremented by flush_talk, sinks of older generations are dropped
+        self.local = local() #sink and cache recording of the message synthesized by the current thread
+        self.cache = get_tts_cache(opt)
+        self.thread = None #process_tts of the current render
+        self.sinks = deque() #messages being synthesized ahead, in playout order
 
     def flush_talk(self):
         self.msgqueue.queue.clear()
+        self.generation += 1
         self.state = State.PAUSE
+        for sink in list(self.sinks):
+            sink.cancelled.set()
+
+    def stopped(self, sink:MessageSink=None)->bool:
+        """flush_talk cut the message, sink defaults to the one synthesized by the calling thread"""
+        if sink is None:
+            sink = getattr(self.local, 'sink', None)
+        if sink is not None:
+            return sink.cancelled.is_set()
+        return self.state!=State.RUNNING
 
     def put_msg_txt(self,msg:str,eventpoint=None): 
         if len(msg)>0:
@@ -72,84 +201,238 @@ class BaseTTS:
     def render(self,quit_event):
         process_thread = Thread(target=self.process_tts, args=(quit_event,))
         process_thread.start()
+        self.thread = process_thread
+
+    def update_voice(self):
+        """re-read opt.REF_FILE/REF_TEXT after /switch_avatar changed them, for backends caching them"""
+        pass
+
+    def reset(self,timeout:float)->bool:
+        """drop pending messages once rendering stopped, False if the tts thread does not exit"""
+        self.flush_talk()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                return False
+        self.state = State.RUNNING
+        return True
     
     def process_tts(self,quit_event):        
+        if self.opt.tts_lookahead > 0:
+            self.__process_lookahead(quit_event)
+            return
         while not quit_event.is_set():
             try:
                 msg = self.msgqueue.get(block=True, timeout=1)
                 self.state=State.RUNNING
             except queue.Empty:
                 continue
-            self.txt_to_audio(msg)
+            self.speak(msg)
+        logger.info('ttsreal thread stop')
+
+    def __process_lookahead(self,quit_event):
+        """
+        The next tts_lookahead messages are synthesized concurrently with the one playing out,
+        each into its own sink; this thread forwards the sinks to the parent in message order.
+        """
+        pending = self.sinks = deque()
+        while not quit_event.is_set():
+            while len(pending) <= self.opt.tts_lookahead:
+                try:
+                    msg = self.msgqueue.get(block=not pending, timeout=1)
+                except queue.Empty:
+                    break
+                generation = self.generation
+                self.state=State.RUNNING
+                sink = MessageSink(generation)
+                Thread(target=self.__synthesize, args=(msg,sink), daemon=True, name="tts-lookahead").start()
+                pending.append(sink)
+            if not pending:
+                continue
+            sink = pending[0]
+            if sink.generation != self.generation: #flushed, its thread stops on sink.cancelled
+                pending.popleft()
+                continue
+            try:
+                frame = sink.frames.get(block=True, timeout=0.02)
+            except queue.Empty:
+                continue
+            if frame is None:
+                pending.popleft()
+            elif sink.generation == self.generation:
+                self.parent.put_audio_frame(*frame)
         logger.info('ttsreal thread stop')
+
+    def __synthesize(self,msg,sink:MessageSink):
+        self.local.sink = sink
+        try:
+            self.speak(msg)
+        except Exception:
+            logger.exception('tts')
+        finally:
+            sink.frames.put(None)
+
+    def speak(self,msg):
+        """txt_to_audio through the tts cache, a cached message is replayed without synthesis"""
+        self.local.started = time.perf_counter()
+        self.local.generation = self.generation
+        if self.cache is None:
+            self.txt_to_audio(msg)
+            return
+        text,textevent = msg
+        key = self.cache.key(type(self).__name__, self.opt.REF_FILE, text)
+        pcm = self.cache.get(key)
+        if pcm is not None:
+            frames, _ = self.split_frames(pcm, np.zeros(0,np.float32))
+            for i, frame in enumerate(frames):
+                eventpoint = {'status':'start','text':text,'msgevent':textevent} if i==0 else None
+                self.put_audio_frame(frame,eventpoint)
+            eventpoint={'status':'end','text':text,'msgevent':textevent}
+            self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
+            return
+        generation = self.local.generation
+        self.local.record = []
+        try:
+            self.txt_to_audio(msg)
+        finally:
+            record = self.local.record
+            self.local.record = None
+        #only complete messages, not ones cut short by flush_talk
+        if record and self.state==State.RUNNING and generation==self.generation:
+            self.cache.put(key, np.concatenate(record))
+
+    def put_audio_frame(self,audio_chunk,eventpoint=None):
+        """output of txt_to_audio, into the message's sink when synthesized ahead"""
+        if getattr(self.local, 'generation', self.generation) != self.generation: #flushed while synthesizing
+            return
+        started = getattr(self.local, 'started', None)
+        if started is not None:
+            self.local.started = None
+            metrics.tts_first_audio.labels(self.parent.sessionid).observe(time.perf_counter() - started)
+        record = getattr(self.local, 'record', None)
+        if record is not None and (eventpoint is None or eventpoint.get('status')!='end'):
+            record.append(audio_chunk)
+        sink = getattr(self.local, 'sink', None)
+        if sink is None:
+            self.parent.put_audio_frame(audio_chunk,eventpoint)
+        else:
+            sink.frames.put((audio_chunk,eventpoint))
     
     def txt_to_audio(self,msg):
         pass
+
+    def post(self, url, **kwargs):
+        """POST to the tts server over the shared keep-alive session"""
+        session = get_http_session(self.opt.max_session * (self.opt.tts_lookahead + 1))
+        res = session.post(url, timeout=(self.opt.tts_connect_timeout, self.opt.tts_timeout), **kwargs)
+        requests_sent, connections = http_pool_stats()
+        logger.debug('tts http requests %d, connections %d', requests_sent, connections)
+        return res
+
+    def get_resampler(self, sample_rate:int):
+        """streaming resampler from the tts output rate to 16k, None if it already is 16k"""
+        if sample_rate == self.sample_rate:
+            return None
+        return StreamingResampler(sample_rate, self.sample_rate)
+
+    def split_frames(self, stream, rest):
+        """20ms frames of rest+stream, and the samples left for the next chunk"""
+        if len(rest):
+            stream = np.concatenate((rest, stream))
+        n = len(stream) // self.chunk * self.chunk
+        return stream[:n].reshape(-1, self.chunk), stream[n:]
     
 
 ###########################################################################################
+_edge_loop = None
+_edge_loop_lock = Lock()
+
+def get_edge_loop():
+    """event loop shared by all EdgeTTS sessions, running in its own thread"""
+    global _edge_loop
+    with _edge_loop_lock:
+        if _edge_loop is None:
+            _edge_loop = asyncio.new_event_loop()
+            Thread(target=_edge_loop.run_forever, daemon=True, name="edgetts-loop").start()
+    return _edge_loop
+
 class EdgeTTS(BaseTTS):
     def txt_to_audio(self,msg):
         voicename = self.opt.REF_FILE #"zh-CN-YunxiaNeural"
         text,textevent = msg
         t = time.time()
-        asyncio.new_event_loop().run_until_complete(self.__main(voicename,text))
+        chunks = Queue() #mp3 data from the loop, None at the end
+        sink = getattr(self.local, 'sink', None)
+        asyncio.run_coroutine_threadsafe(self.__main(voicename,text,chunks,sink), get_edge_loop())
+        decoder = av.CodecContext.create('mp3', 'r')
+        resampler = None
+        rest = np.zeros(0,np.float32) #samples short of a full frame, carried to the next chunk
+        first = True
+        while True:
+            data = chunks.get()
+            if self.stopped(sink):
+                if data is None:
+                    break
+                continue
+            for stream, sample_rate in self.__decode(decoder, data):
+                if sample_rate != self.sample_rate:
+                    if resampler is None:
+                        resampler = self.get_resampler(sample_rate)
+                    stream = resampler.resample(stream)
+                if data is None and resampler is not None:
+                    stream = np.concatenate((stream, resampler.flush()))
+                frames, rest = self.split_frames(stream, rest)
+                for frame in frames:
+                    eventpoint=None
+                    if first:
+                        logger.info(f'-------edge tts time to first audio:{time.time()-t:.4f}s')
+                        eventpoint={'status':'start','text':text,'msgevent':textevent}
+                        first = False
+                    self.put_audio_frame(frame,eventpoint)
+            if data is None:
+                break
         logger.info(f'-------edge tts time:{time.time()-t:.4f}s')
-        if self.input_stream.getbuffer().nbytes<=0: #edgetts err
+        if first: #edgetts err
             logger.error('edgetts err!!!!!')
             return
-        
-        self.input_stream.seek(0)
-        stream = self.__create_bytes_stream(self.input_stream)
-        streamlen = stream.shape[0]
-        idx=0
-        while streamlen >= self.chunk and self.state==State.RUNNING:
-            eventpoint=None
-            streamlen -= self.chunk
-            if idx==0:
-                eventpoint={'status':'start','text':text,'msgevent':textevent}
-            elif streamlen<self.chunk:
-                eventpoint={'status':'end','text':text,'msgevent':textevent}
-            self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-            idx += self.chunk
-        #if streamlen>0:  #skip last frame(not 20ms)
-        #    self.queue.put(stream[idx:])
-        self.input_stream.seek(0)
-        self.input_stream.truncate() 
-
-    def __create_bytes_stream(self,byte_stream):
-        #byte_stream=BytesIO(buffer)
-        stream, sample_rate = sf.read(byte_stream) # [T*sample_rate,] float64
-        logger.info(f'[INFO]tts audio stream {sample_rate}: {stream.shape}')
-        stream = stream.astype(np.float32)
-
-        if stream.ndim > 1:
-            logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
-            stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
-
-        return stream
+        eventpoint={'status':'end','text':text,'msgevent':textevent}
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
+
+    def __decode(self, decoder, data):
+        """
+        (pcm, sample_rate) of the mp3 frames completed by data, data None drains the decoder.
+        Always yields at least once so the caller can flush at the end.
+        """
+        packets = decoder.parse(data if data is not None else b'')
+        if data is None:
+            packets.append(None)
+        pcm = []
+        sample_rate = self.sample_rate
+        for packet in packets:
+            try:
+                for frame in decoder.decode(packet):
+                    pcm.append(frame.to_ndarray()[0].astype(np.float32, copy=False)) #first channel
+                    sample_rate = frame.sample_rate
+            except av.error.InvalidDataError: #id3 tag or a broken frame
+                continue
+        if pcm or data is None:
+            yield (np.concatenate(pcm) if pcm else np.zeros(0,np.float32)), sample_rate
     
-    async def __main(self,voicename: str, text: str):
+    async def __main(self,voicename: str, text: str, chunks: Queue, sink: MessageSink=None):
         try:
             communicate = edge_tts.Communicate(text, voicename)
 
-            #with open(OUTPUT_FILE, "wb") as file:
-            first = True
             async for chunk in communicate.stream():
-                if first:
-                    first = False
-                if chunk["type"] == "audio" and self.state==State.RUNNING:
-                    #self.push_audio(chunk["data"])
-                    self.input_stream.write(chunk["data"])
-                    #file.write(chunk["data"])
+                if self.stopped(sink):
+                    break
+                if chunk["type"] == "audio":
+                    chunks.put(chunk["data"])
                 elif chunk["type"] == "WordBoundary":
                     pass
         except Exception as e:
             logger.exception('edgetts')
+        finally:
+            chunks.put(None)
 
 ###########################################################################################
 class FishTTS(BaseTTS):
@@ -176,7 +459,7 @@ class FishTTS(BaseTTS):
             'use_memory_cache':'on'
         }
         try:
-            res = requests.post(
+            res = self.post(
                 f"{server_url}/v1/tts",
                 json=req,
                 stream=True,
@@ -199,7 +482,10 @@ class FishTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"fish_speech Time to first chunk: {end-start}s")
                     first = False
-                if chunk and self.state==State.RUNNING:
+                if self.stopped():
+                    res.close() #flushed, drop the connection instead of reading the message out
+                    break
+                if chunk:
                     yield chunk
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
@@ -208,24 +494,23 @@ class FishTTS(BaseTTS):
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = self.get_resampler(44100)
+        rest = np.zeros(0,np.float32) #samples short of a full frame, carried to the next chunk
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
                 stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=44100, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
+                frames, rest = self.split_frames(resampler.resample(stream), rest)
+                for frame in frames:
                     eventpoint=None
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
+                    self.put_audio_frame(frame,eventpoint)
+        frames, _ = self.split_frames(resampler.flush(), rest)
+        for frame in frames:
+            self.put_audio_frame(frame)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 class SovitsTTS(BaseTTS):
@@ -260,7 +545,7 @@ class SovitsTTS(BaseTTS):
         # #req["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
         # req["streaming_mode"] = True
         try:
-            res = requests.post(
+            res = self.post(
                 f"{server_url}/tts",
                 json=req,
                 stream=True,
@@ -280,7 +565,10 @@ class SovitsTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"gpt_sovits Time to first chunk: {end-start}s")
                     first = False
-                if chunk and self.state==State.RUNNING:
+                if self.stopped():
+                    res.close() #flushed, drop the connection instead of reading the message out
+                    break
+                if chunk:
                     yield chunk
             #print("gpt_sovits response.elapsed:", res.elapsed)
         except Exception as e:
@@ -295,34 +583,36 @@ class SovitsTTS(BaseTTS):
         if stream.ndim > 1:
             logger.info(f'[WARN] audio has {stream.shape[1]} channels, only use the first.')
             stream = stream[:, 0]
-    
-        if sample_rate != self.sample_rate and stream.shape[0]>0:
-            logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
-            stream = resampy.resample(x=stream, sr_orig=sample_rate, sr_new=self.sample_rate)
 
-        return stream
+        return stream, sample_rate
 
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = None #created with the rate of the first chunk
+        rest = np.zeros(0,np.float32) #samples short of a full frame, carried to the next chunk
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
-                #stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                #stream = resampy.resample(x=stream, sr_orig=32000, sr_new=self.sample_rate)
                 byte_stream=BytesIO(chunk)
-                stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
+                stream, sample_rate = self.__create_bytes_stream(byte_stream)
+                if sample_rate != self.sample_rate:
+                    if resampler is None:
+                        logger.info(f'[WARN] audio sample rate is {sample_rate}, resampling into {self.sample_rate}.')
+                        resampler = self.get_resampler(sample_rate)
+                    stream = resampler.resample(stream)
+                frames, rest = self.split_frames(stream, rest)
+                for frame in frames:
                     eventpoint=None
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
+                    self.put_audio_frame(frame,eventpoint)
+        if resampler is not None:
+            frames, _ = self.split_frames(resampler.flush(), rest)
+            for frame in frames:
+                self.put_audio_frame(frame)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)
 
 ###########################################################################################
 class CosyVoiceTTS(BaseTTS):
@@ -346,8 +636,8 @@ class CosyVoiceTTS(BaseTTS):
             'prompt_text': reftext
         }
         try:
-            files = [('prompt_wav', ('prompt_wav', open(reffile, 'rb'), 'application/octet-stream'))]
-            res = requests.request("POST", f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
+            files = [('prompt_wav', ('prompt_wav', read_ref_audio(reffile), 'application/octet-stream'))]
+            res = self.post(f"{server_url}/inference_zero_shot", data=payload, files=files, stream=True)
             
             end = time.perf_counter()
             logger.info(f"cosy_voice Time to make POST: {end-start}s")
@@ -363,7 +653,10 @@ class CosyVoiceTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"cosy_voice Time to first chunk: {end-start}s")
                     first = False
-                if chunk and self.state==State.RUNNING:
+                if self.stopped():
+                    res.close() #flushed, drop the connection instead of reading the message out
+                    break
+                if chunk:
                     yield chunk
         except Exception as e:
             logger.exception('cosyvoice')
@@ -371,24 +664,23 @@ class CosyVoiceTTS(BaseTTS):
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = self.get_resampler(24000)
+        rest = np.zeros(0,np.float32) #samples short of a full frame, carried to the next chunk
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
                 stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
+                frames, rest = self.split_frames(resampler.resample(stream), rest)
+                for frame in frames:
                     eventpoint=None
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
+                    self.put_audio_frame(frame,eventpoint)
+        frames, _ = self.split_frames(resampler.flush(), rest)
+        for frame in frames:
+            self.put_audio_frame(frame)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
 _PROTOCOL = "https://"
@@ -402,11 +694,14 @@ class TencentTTS(BaseTTS):
         self.appid = os.getenv("TENCENT_APPID")
         self.secret_key = os.getenv("TENCENT_SECRET_KEY")
         self.secret_id = os.getenv("TENCENT_SECRET_ID")
-        self.voice_type = int(opt.REF_FILE)
+        self.update_voice()
         self.codec = "pcm"
         self.sample_rate = 16000
         self.volume = 0
         self.speed = 0
+
+    def update_voice(self):
+        self.voice_type = int(self.opt.REF_FILE)
     
     def __gen_signature(self, params):
         sort_dict = sorted(params.keys())
@@ -463,7 +758,7 @@ class TencentTTS(BaseTTS):
         }
         url = _PROTOCOL + _HOST + _PATH
         try:
-            res = requests.post(url, headers=headers,
+            res = self.post(url, headers=headers,
                           data=json.dumps(params), stream=True)
             
             end = time.perf_counter()
@@ -484,7 +779,10 @@ class TencentTTS(BaseTTS):
                         end = time.perf_counter()
                         logger.info(f"tencent Time to first chunk: {end-start}s")
                         first = False                    
-                if chunk and self.state==State.RUNNING:
+                if self.stopped():
+                    res.close() #flushed, drop the connection instead of reading the message out
+                    break
+                if chunk:
                     yield chunk
         except Exception as e:
             logger.exception('tencent')
@@ -507,19 +805,23 @@ class TencentTTS(BaseTTS):
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+                    self.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
                     streamlen -= self.chunk
                     idx += self.chunk
                 last_stream = stream[idx:] #get the remain stream
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint) 
 
 ###########################################################################################
+_xtts_speakers = {}
 
 class XTTS(BaseTTS):
     def __init__(self, opt, parent):
         super().__init__(opt,parent)
-        self.speaker = self.get_speaker(opt.REF_FILE, opt.TTS_SERVER)
+        self.update_voice()
+
+    def update_voice(self):
+        self.speaker = self.get_speaker(self.opt.REF_FILE, self.opt.TTS_SERVER)
 
     def txt_to_audio(self,msg):
         text,textevent = msg  
@@ -535,19 +837,26 @@ class XTTS(BaseTTS):
         )
 
     def get_speaker(self,ref_audio,server_url):
-        files = {"wav_file": ("reference.wav", open(ref_audio, "rb"))}
-        response = requests.post(f"{server_url}/clone_speaker", files=files)
-        return response.json()
+        """speaker latents of the reference audio, cloned once per server and file"""
+        key = (server_url, ref_audio, os.path.getmtime(ref_audio))
+        speaker = _xtts_speakers.get(key)
+        if speaker is None:
+            files = {"wav_file": ("reference.wav", read_ref_audio(ref_audio))}
+            response = self.post(f"{server_url}/clone_speaker", files=files)
+            speaker = response.json()
+            _xtts_speakers[key] = speaker
+        return speaker
 
     def xtts(self,text, speaker, language, server_url, stream_chunk_size) -> Iterator[bytes]:
         start = time.perf_counter()
-        speaker["text"] = text
-        speaker["language"] = language
-        speaker["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
+        req = dict(speaker) #the speaker is shared, messages may be synthesized concurrently
+        req["text"] = text
+        req["language"] = language
+        req["stream_chunk_size"] = stream_chunk_size  # you can reduce it to get faster response, but degrade quality
         try:
-            res = requests.post(
+            res = self.post(
                 f"{server_url}/tts_stream",
-                json=speaker,
+                json=req,
                 stream=True,
             )
             end = time.perf_counter()
@@ -564,6 +873,9 @@ class XTTS(BaseTTS):
                     end = time.perf_counter()
                     logger.info(f"xtts Time to first chunk: {end-start}s")
                     first = False
+                if self.stopped():
+                    res.close() #flushed, drop the connection instead of reading the message out
+                    break
                 if chunk:
                     yield chunk
         except Exception as e:
@@ -572,21 +884,20 @@ class XTTS(BaseTTS):
     def stream_tts(self,audio_stream,msg):
         text,textevent = msg
         first = True
+        resampler = self.get_resampler(24000)
+        rest = np.zeros(0,np.float32) #samples short of a full frame, carried to the next chunk
         for chunk in audio_stream:
             if chunk is not None and len(chunk)>0:          
                 stream = np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32767
-                stream = resampy.resample(x=stream, sr_orig=24000, sr_new=self.sample_rate)
-                #byte_stream=BytesIO(buffer)
-                #stream = self.__create_bytes_stream(byte_stream)
-                streamlen = stream.shape[0]
-                idx=0
-                while streamlen >= self.chunk:
+                frames, rest = self.split_frames(resampler.resample(stream), rest)
+                for frame in frames:
                     eventpoint=None
                     if first:
                         eventpoint={'status':'start','text':text,'msgevent':textevent}
                         first = False
-                    self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
-                    streamlen -= self.chunk
-                    idx += self.chunk
+                    self.put_audio_frame(frame,eventpoint)
+        frames, _ = self.split_frames(resampler.flush(), rest)
+        for frame in frames:
+            self.put_audio_frame(frame)
         eventpoint={'status':'end','text':text,'msgevent':textevent}
-        self.parent.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
+        self.put_audio_frame(np.zeros(self.chunk,np.float32),eventpoint)  
\ No newline at end of file
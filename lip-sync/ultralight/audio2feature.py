@@ -1,4 +1,6 @@
 from transformers import Wav2Vec2Processor, HubertModel
+import time
+from threading import Thread, Condition, Event
 import torch
 import numpy as np
 
@@ -11,7 +13,24 @@ class Audio2Feature():
 
 
     @torch.no_grad()
-    def get_hubert_from_16k_speech(self, speech):
+    def extract(self, input_values):
+        """conv frontend of HubertModel, [B, T, 512]"""
+        return self.model.feature_extractor(input_values).transpose(1, 2)
+
+    @torch.no_grad()
+    def encode(self, extract_features):
+        """feature projection and transformer of HubertModel on frontend features, [B, T, 1024]"""
+        hidden_states = self.model.feature_projection(extract_features)
+        if isinstance(hidden_states, tuple): #wav2vec2 style projection also returns its input
+            hidden_states = hidden_states[0]
+        return self.model.encoder(hidden_states)[0]
+
+    @torch.no_grad()
+    def get_hubert_from_16k_speech(self, speech, encode=None):
+        """
+        :param encode: runs the transformer on frontend features of the last clip, defaults to
+            self.encode; a FeatureBatcher shares it with other sessions
+        """
         if speech.ndim == 2:
             speech = speech[:, 0]  # [T, 2] ==> [T,]
         input_values_all = self.processor(speech, return_tensors="pt", sampling_rate=16000).input_values  # [1, T]
@@ -38,7 +57,7 @@ class Audio2Feature():
         else:
             input_values = input_values_all
         if input_values.shape[1] >= kernel:  # if the last batch is shorter than kernel_size, skip it            
-            hidden_states = self.model(input_values).last_hidden_state  # [B=1, T=pts//320, hid=1024]
+            hidden_states = (encode or self.encode)(self.extract(input_values))  # [B=1, T=pts//320, hid=1024]
         res_lst.append(hidden_states[0])
         ret = torch.cat(res_lst, dim=0).cpu()  # [T, 1024]
         assert abs(ret.shape[0] - expected_T) <= 1
@@ -79,18 +98,154 @@ class Audio2Feature():
         selected_feature = selected_feature.reshape(-1, 1024)
         return selected_feature,selected_idx
 
-    def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [8,8],start=0):
-        whisper_chunks = []
-        whisper_idx_multiplier = 50./fps
-        i = 0
-        #print(f"video in {fps} FPS, audio idx in 50FPS")
-        for _ in range(batch_size):
-            # start_idx = int(i * whisper_idx_multiplier)
-            # if start_idx>=len(feature_array):
-            #     break
-            selected_feature,selected_idx = self.get_sliced_feature(feature_array= feature_array,vid_idx = i+start,audio_feat_length=audio_feat_length,fps=fps)
-            #print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-
-        return whisper_chunks
+    def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [8,8],start=0,out=None):
+        """
+        get_sliced_feature for video frames start..start+batch_size in one gather
+        :param out: optional preallocated contiguous [batch_size, window, 1024] buffer
+        :return: [batch_size, window, 1024]
+        """
+        feature_array = np.asarray(feature_array)
+        length = len(feature_array)
+        center_idx = ((np.arange(batch_size) + start)*50/fps).astype(np.int64)
+        idx = center_idx[:,np.newaxis] + np.arange(-audio_feat_length[0]*2, audio_feat_length[1]*2)
+        if out is None:
+            out = np.empty((batch_size, idx.shape[1]*int(np.prod(feature_array.shape[1:]))//1024, 1024), dtype=feature_array.dtype)
+        np.take(feature_array, idx, axis=0, out=out.reshape(idx.shape + feature_array.shape[1:]), mode='clip')
+        return out
+
+class Audio2FeatureStream():
+    """
+    Incremental hubert features for one ASR session.
+    The conv frontend outputs of the sliding window are kept between steps and only computed
+    for newly arrived audio; the transformer runs from overlap frames before the end of the
+    left context, whose features are reused from the last step. The input is normalized with
+    the statistics of the current window, cached frontend frames keep those of the window
+    they were computed in.
+    """
+    def __init__(self, audio_processor:Audio2Feature, stride_left, overlap=4, chunk=320):
+        self.audio_processor = audio_processor
+        self.stride_left = stride_left
+        self.overlap = min(overlap, stride_left)
+        self.chunk = chunk
+        self.do_normalize = getattr(audio_processor.processor.feature_extractor, 'do_normalize', True)
+        self.extract_features = None # frontend output of the current window, [1, frames, 512]
+        self.feats = None # hubert features of the current window, [frames, 1024]
+
+    def reset(self):
+        self.extract_features = None
+        self.feats = None
+
+    @torch.no_grad()
+    def audio2feat(self, audio, new_samples, encode=None):
+        """
+        :param audio: 16k pcm of the whole sliding window
+        :param new_samples: number of samples appended since the last call
+        :param encode: see Audio2Feature.get_hubert_from_16k_speech
+        :return: [frames, 1024] like Audio2Feature.get_hubert_from_16k_speech
+        """
+        encode = encode or self.audio_processor.encode
+        audio = audio.astype(np.float32, copy=False)
+        if self.do_normalize:
+            audio = (audio - audio.mean()) / np.sqrt(audio.var() + 1e-7)
+        frames = (len(audio) - 80) // self.chunk
+        new_frames = new_samples // self.chunk
+        input_values = torch.from_numpy(audio)[None].to(self.audio_processor.device)
+        if self.extract_features is None or self.extract_features.shape[1] != frames or new_frames >= frames:
+            self.extract_features = self.audio_processor.extract(input_values)
+            self.feats = encode(self.extract_features)[0].cpu()
+            return self.feats
+        # frontend frames within the last window are unchanged, only the new ones are computed
+        kept = frames - new_frames
+        fresh = self.audio_processor.extract(input_values[:, kept*self.chunk:])
+        self.extract_features = torch.cat((self.extract_features[:, new_frames:], fresh), dim=1)
+        if new_frames + self.stride_left > frames:
+            self.feats = encode(self.extract_features)[0].cpu()
+            return self.feats
+        cached = self.feats[new_frames:new_frames+self.stride_left]
+        start = self.stride_left - self.overlap
+        hidden = encode(self.extract_features[:, start:])[0].cpu()
+        self.feats = torch.cat((cached, hidden[self.overlap:]), dim=0)
+        return self.feats
+
+class FeatureJob:
+    def __init__(self, extract_features):
+        self.extract_features = extract_features
+        self.created = time.perf_counter()
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class FeatureBatcher:
+    """
+    Runs the hubert transformer for all HubertASR sessions of the process. Frontend features
+    of the same length are stacked into one batch, dispatched when every speaking session
+    has submitted or when the oldest request has waited deadline seconds. Silent sessions
+    reuse their cached chunks and submit nothing, so they are not waited for.
+    """
+    def __init__(self, audio_processor:Audio2Feature, deadline=0.01):
+        self.audio_processor = audio_processor
+        self.deadline = deadline
+        self._cond = Condition()
+        self._pending = []
+        self._sessions = 0
+        self._speaking = 0
+        self._thread = None
+
+    def register(self):
+        with self._cond:
+            self._sessions += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True, name="hubert_batcher")
+                self._thread.start()
+
+    def unregister(self):
+        with self._cond:
+            self._sessions = max(0, self._sessions - 1)
+            self._cond.notify()
+
+    def speaking(self, active:bool):
+        """a registered session starts or stops submitting a job every step"""
+        with self._cond:
+            self._speaking = max(0, self._speaking + (1 if active else -1))
+            self._cond.notify()
+
+    def __call__(self, extract_features):
+        job = FeatureJob(extract_features)
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify()
+        return job.wait()
+
+    def _next_jobs(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            while len(self._pending) < min(self._speaking, self._sessions):
+                remain = self._pending[0].created + self.deadline - time.perf_counter()
+                if remain <= 0:
+                    break
+                self._cond.wait(remain)
+            shape = self._pending[0].extract_features.shape
+            jobs = [job for job in self._pending if job.extract_features.shape == shape]
+            self._pending = [job for job in self._pending if job.extract_features.shape != shape]
+            return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._next_jobs()
+            try:
+                hidden = self.audio_processor.encode(torch.cat([job.extract_features for job in jobs], dim=0))
+            except Exception as e:
+                for job in jobs:
+                    job.error = e
+                    job.done.set()
+                continue
+            for i, job in enumerate(jobs):
+                job.result = hidden[i:i+1]
+                job.done.set()
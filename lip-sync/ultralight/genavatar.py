@@ -1,5 +1,6 @@
 import argparse
 import os
+import sys
 import cv2
 import torch
 import numpy as np
@@ -113,4 +114,8 @@ with open(coords_path, 'wb') as f:
         pickle.dump(coord_list, f)
 os.system(f"cp {checkpoint} {pth_path}")
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from avatarpack import pack_avatar
+pack_avatar(avatar_path, 'ultralight')
+
 # ffmpeg -i test_video.mp4 -i test_audio.pcm -c:v libx264 -c:a aac result_test.mp4
\ No newline at end of file
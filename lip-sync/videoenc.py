@@ -0,0 +1,253 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+H.264 encoding outside of aiortc. PlayerStreamTrack.recv may return av.Packet instead of
+VideoFrame, aiortc then only packetizes it. This is used for
+ - IdlePackets: the mirrored idle loop of an avatar encoded once and shared by every session
+ - encoder stages that encode a session's frames in its render thread or in a worker process
+   instead of aiortc's per connection encoder
+Only H.264 packets can be passed through, the offer restricts the codec when these are used.
+"""
+
+import fractions
+import queue
+import threading
+import time
+
+import av
+import numpy as np
+import multiprocessing as mp
+from av import VideoFrame
+from av.video.frame import PictureType
+
+from logger import logger
+
+VIDEO_FPS = 25
+
+def create_h264_context(width, height, bitrate, gop):
+    """libx264 configured like aiortc's H264Encoder, with a fixed keyframe interval"""
+    codec = av.CodecContext.create("libx264", "w")
+    codec.width = width
+    codec.height = height
+    codec.bit_rate = bitrate
+    codec.pix_fmt = "yuv420p"
+    codec.framerate = fractions.Fraction(VIDEO_FPS, 1)
+    codec.time_base = fractions.Fraction(1, VIDEO_FPS)
+    codec.gop_size = gop
+    codec.options = {"profile": "baseline", "level": "31", "tune": "zerolatency"}
+    codec.open()
+    return codec
+
+def to_yuv(image):
+    """bgr avatar frame to the yuv420p planes sent to the client"""
+    image = np.array(image)
+    image[0,:] &= 0xFE
+    return VideoFrame.from_ndarray(image, format="bgr24").reformat(format="yuv420p").to_ndarray()
+
+def encode_yuv(codec, yuv, pts, keyframe=False):
+    frame = VideoFrame.from_ndarray(yuv, format="yuv420p")
+    frame.pts = pts
+    if keyframe:
+        frame.pict_type = PictureType.I
+    return [(bytes(packet), packet.is_keyframe) for packet in codec.encode(frame)]
+
+def mirror_index(size, index):
+    turn = index // size
+    res = index % size
+    if turn % 2 == 0:
+        return res
+    else:
+        return size - res - 1
+
+class IdlePackets:
+    """
+    The idle loop of an avatar as played while silent, frame_list_cycle in mirrored order over
+    2*len(frames) positions, encoded once in a background thread. A session switches to these
+    packets at a keyframe and back to its own encoder with a forced keyframe.
+    """
+    def __init__(self, frames, bitrate, gop):
+        self.size = len(frames)
+        self.packets = None
+        threading.Thread(target=self.__encode, args=(frames, bitrate, gop), daemon=True, name="idle-encoder").start()
+
+    def __encode(self, frames, bitrate, gop):
+        t = time.perf_counter()
+        height, width = frames[0].shape[:2]
+        codec = create_h264_context(width, height, bitrate, gop)
+        yuv_list = [None]*self.size
+        packets = []
+        for pos in range(2*self.size):
+            idx = mirror_index(self.size, pos)
+            if yuv_list[idx] is None:
+                yuv_list[idx] = to_yuv(frames[idx])
+            encoded = encode_yuv(codec, yuv_list[idx], pos, keyframe=(pos % gop == 0))
+            if len(encoded) != 1:
+                logger.warning('idle encoder returned %d packets for one frame, idle packets disabled', len(encoded))
+                return
+            packets.append(encoded[0])
+        self.packets = packets
+        logger.info('encoded %d idle packets in %.2fs', len(packets), time.perf_counter()-t)
+
+    def get(self, pos:int, resume:bool):
+        """
+        packet for loop position pos, None while still encoding or when joining (not resume)
+        anywhere but at a keyframe
+        """
+        if self.packets is None:
+            return None
+        data, keyframe = self.packets[pos % len(self.packets)]
+        if not resume and not keyframe:
+            return None
+        return av.Packet(data)
+
+_idle_packets = {}
+
+def get_idle_packets(avatar, frames, bitrate, gop):
+    """idle packets of a loaded avatar, shared by all sessions rendering it"""
+    height, width = frames[0].shape[:2]
+    if height % 2 or width % 2: #yuv420p needs even sizes
+        return None
+    entry = _idle_packets.get(id(avatar))
+    if entry is None or entry[0] is not avatar:
+        entry = (avatar, IdlePackets(frames, bitrate, gop))
+        _idle_packets[id(avatar)] = entry
+    return entry[1]
+
+def release_idle_packets(avatar):
+    entry = _idle_packets.get(id(avatar))
+    if entry is not None and entry[0] is avatar:
+        del _idle_packets[id(avatar)]
+
+class ThreadEncoder:
+    """encodes in the calling render thread, off the asyncio loop"""
+    def __init__(self, bitrate, gop):
+        self.bitrate = bitrate
+        self.gop = gop
+        self.codec = None
+        self.pts = 0
+
+    def encode(self, frame:VideoFrame, keyframe=False):
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        if self.codec is None or self.codec.width != frame.width or self.codec.height != frame.height:
+            self.codec = create_h264_context(frame.width, frame.height, self.bitrate, self.gop)
+            keyframe = True
+        packets = encode_yuv(self.codec, frame.to_ndarray(), self.pts, keyframe)
+        self.pts += 1
+        return [av.Packet(data) for data, _ in packets]
+
+    def close(self):
+        self.codec = None
+
+def _encode_worker(inqueue, outqueue):
+    codecs = {}
+    while True:
+        msg = inqueue.get()
+        if msg is None:
+            break
+        key, yuv, pts, keyframe, bitrate, gop = msg
+        if yuv is None: #session closed
+            codecs.pop(key, None)
+            continue
+        height, width = yuv.shape[0]*2//3, yuv.shape[1]
+        codec = codecs.get(key)
+        if codec is None or codec.width != width or codec.height != height:
+            codec = create_h264_context(width, height, bitrate, gop)
+            codecs[key] = codec
+            keyframe = True
+        outqueue.put((key, encode_yuv(codec, yuv, pts, keyframe)))
+
+class EncoderPool:
+    """
+    Worker processes encoding for all sessions. Each session sticks to one worker, which keeps
+    its encoder state; results are routed back to the waiting session by a dispatcher thread.
+    The workers are spawned whatever start method the entry point set, a forked copy of a process
+    already running threads and cuda can deadlock. Spawning imports the main module again, app.py
+    creates the pool at startup with get_pool so no session waits for that.
+    """
+    def __init__(self, workers):
+        ctx = mp.get_context('spawn')
+        self.outqueue = ctx.Queue()
+        self.inqueues = []
+        for _ in range(workers):
+            inqueue = ctx.Queue()
+            ctx.Process(target=_encode_worker, args=(inqueue, self.outqueue), daemon=True).start()
+            self.inqueues.append(inqueue)
+        self.results = {} #key:queue.Queue
+        self.lock = threading.Lock()
+        self.next_key = 0
+        threading.Thread(target=self.__dispatch, daemon=True, name="encoder-dispatch").start()
+        logger.info('encoder pool with %d workers', workers)
+
+    def __dispatch(self):
+        while True:
+            key, packets = self.outqueue.get()
+            result = self.results.get(key)
+            if result is not None:
+                result.put(packets)
+
+    def open(self):
+        with self.lock:
+            key = self.next_key
+            self.next_key += 1
+            self.results[key] = queue.Queue()
+        return key, self.inqueues[key % len(self.inqueues)]
+
+    def close(self, key, inqueue):
+        inqueue.put((key, None, 0, False, 0, 0))
+        with self.lock:
+            self.results.pop(key, None)
+
+class PoolEncoder:
+    """a session's encoder running in an EncoderPool worker"""
+    def __init__(self, pool:EncoderPool, bitrate, gop):
+        self.pool = pool
+        self.bitrate = bitrate
+        self.gop = gop
+        self.key, self.inqueue = pool.open()
+        self.result = pool.results[self.key]
+        self.pts = 0
+
+    def encode(self, frame:VideoFrame, keyframe=False):
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        self.inqueue.put((self.key, frame.to_ndarray(), self.pts, keyframe, self.bitrate, self.gop))
+        self.pts += 1
+        return [av.Packet(data) for data, _ in self.result.get()]
+
+    def close(self):
+        self.pool.close(self.key, self.inqueue)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool(opt)->EncoderPool:
+    """the EncoderPool of --video_encoder process, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = EncoderPool(opt.encoder_workers)
+    return _pool
+
+def get_encoder(opt):
+    """the encoder stage selected by opt.video_encoder, None leaves encoding to aiortc"""
+    if opt.video_encoder == 'thread':
+        return ThreadEncoder(opt.video_bitrate, opt.video_gop)
+    if opt.video_encoder == 'process':
+        return PoolEncoder(get_pool(opt), opt.video_bitrate, opt.video_gop)
+    return None
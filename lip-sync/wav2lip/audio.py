@@ -134,3 +134,56 @@ def _denormalize(D):
         return (((D + hp.max_abs_value) * -hp.min_level_db / (2 * hp.max_abs_value)) + hp.min_level_db)
     else:
         return ((D * -hp.min_level_db / hp.max_abs_value) + hp.min_level_db)
+
+class MelStream:
+    """
+    Incremental melspectrogram of one audio stream for the sliding ASR window.
+    STFT columns sit on a fixed hop grid of the stream (zero padded at its start like
+    librosa's centered stft), so each push only computes the columns completed by the new
+    samples. Columns are kept in a ring buffer that chunks are gathered from by index.
+    """
+    def __init__(self, capacity):
+        self.hop = get_hop_size()
+        self.n_fft = hp.n_fft
+        self.capacity = capacity
+        self.window = librosa.util.pad_center(signal.get_window('hann', hp.win_size or hp.n_fft, fftbins=True), size=hp.n_fft)
+        self.buf = np.zeros(hp.n_fft // 2) # preemphasized samples from the next column on
+        self.last = 0. # last raw sample, preemphasis state
+        self.cols = 0 # columns computed so far
+        self.samples = 0 # samples pushed so far
+        self.mel = np.zeros((hp.num_mels, capacity), dtype=np.float32)
+
+    def push(self, wav):
+        wav = np.asarray(wav, dtype=np.float64)
+        if hp.preemphasize:
+            y = np.empty_like(wav)
+            y[0] = wav[0] - hp.preemphasis * self.last
+            y[1:] = wav[1:] - hp.preemphasis * wav[:-1]
+            self.last = wav[-1]
+        else:
+            y = wav
+        self.samples += len(wav)
+        self.buf = np.concatenate((self.buf, y))
+        if len(self.buf) < self.n_fft:
+            return
+        n = (len(self.buf) - self.n_fft) // self.hop + 1
+        frames = np.lib.stride_tricks.sliding_window_view(self.buf, self.n_fft)[::self.hop][:n]
+        D = np.fft.rfft(frames * self.window, axis=1).T
+        S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+        if hp.signal_normalization:
+            S = _normalize(S)
+        self.mel[:, np.arange(self.cols, self.cols + n) % self.capacity] = S
+        self.cols += n
+        self.buf = self.buf[n * self.hop:]
+
+    def chunks(self, start_sample, offsets, step_size):
+        """
+        :param start_sample: stream position the offsets are relative to
+        :param offsets: chunk starts in columns after start_sample, truncated like the window
+            relative offsets of melspectrogram; start_sample is rounded to the nearest column
+        :return: [len(offsets), num_mels, step_size], clamped to the computed columns
+        """
+        start = int(round(start_sample / self.hop)) + np.asarray(offsets).astype(np.int64)
+        start = np.clip(start, self.cols - self.capacity, self.cols - step_size)
+        idx = (start[:, np.newaxis] + np.arange(step_size)) % self.capacity
+        return self.mel[:, idx].transpose(1, 0, 2)
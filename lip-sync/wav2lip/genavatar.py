@@ -124,3 +124,7 @@ if __name__ == "__main__":
 	
     with open(coords_path, 'wb') as f:
         pickle.dump(coord_list, f)
+
+    sys.path.append(path.join(path.dirname(path.abspath(__file__)), '..'))
+    from avatarpack import pack_avatar
+    pack_avatar(avatar_path, 'wav2lip')
@@ -16,6 +16,7 @@
 ###############################################################################
 
 import asyncio
+import concurrent.futures
 import json
 import logging
 import threading
@@ -43,6 +44,7 @@ from aiortc import (
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 from logger import logger as mylogger
+import metrics
 
 
 class PlayerStreamTrack(MediaStreamTrack):
@@ -50,11 +52,19 @@ class PlayerStreamTrack(MediaStreamTrack):
     A video track that returns an animated flag.
     """
 
-    def __init__(self, player, kind):
+    def __init__(self, player, kind, maxsize=0, lag_policy='block'):
         super().__init__()  # don't forget this!
         self.kind = kind
         self._player = player
-        self._queue = asyncio.Queue()
+        #bounded: a full queue blocks the render thread (block) or drops its oldest frame (drop)
+        self._queue = asyncio.Queue(maxsize)
+        self.lag_policy = lag_policy
+        self.dropped = 0
+        sessionid = player.sessionid if player is not None else ''
+        self.sessionid = sessionid
+        self.send_jitter = metrics.send_jitter.labels(sessionid, kind)
+        self.frames_sent = metrics.frames_sent.labels(sessionid, kind)
+        self.frames_dropped = metrics.frames_dropped.labels(sessionid, kind)
         self.timelist = [] #记录最近包的时间戳
         self.current_frame_count = 0
         if self.kind == 'video':
@@ -78,6 +88,8 @@ class PlayerStreamTrack(MediaStreamTrack):
                 # wait = self.timelist[0] + len(self.timelist)*VIDEO_PTIME - time.time()               
                 if wait>0:
                     await asyncio.sleep(wait)
+                    wait = self._start + self.current_frame_count * VIDEO_PTIME - time.time()
+                self.send_jitter.observe(max(0., -wait))
                 # if len(self.timelist)>=100:
                 #     self.timelist.pop(0)
                 # self.timelist.append(time.time())
@@ -96,6 +108,8 @@ class PlayerStreamTrack(MediaStreamTrack):
                 # wait = self.timelist[0] + len(self.timelist)*AUDIO_PTIME - time.time()
                 if wait>0:
                     await asyncio.sleep(wait)
+                    wait = self._start + self.current_frame_count * AUDIO_PTIME - time.time()
+                self.send_jitter.observe(max(0., -wait))
                 # if len(self.timelist)>=200:
                 #     self.timelist.pop(0)
                 #     self.timelist.pop(0)
@@ -107,6 +121,39 @@ class PlayerStreamTrack(MediaStreamTrack):
                 mylogger.info('audio start:%f',self._start)
             return self._timestamp, AUDIO_TIME_BASE
 
+    async def put_frame(self, item):
+        if self.lag_policy == 'drop' and self._queue.full():
+            _, eventpoint = self._queue.get_nowait()
+            self.dropped += 1
+            self.frames_dropped.inc()
+            if self.dropped % 100 == 1:
+                mylogger.warning('%s track behind, dropped %d frames', self.kind, self.dropped)
+            if eventpoint and self._player is not None:
+                self._player.notify(eventpoint)
+        await self._queue.put(item)
+
+    def flush(self):
+        """drop the queued frames of a talk cut short by flush_talk, on the event loop"""
+        while not self._queue.empty():
+            _, eventpoint = self._queue.get_nowait()
+            if eventpoint and self._player is not None:
+                self._player.notify(eventpoint)
+
+    def put_frame_threadsafe(self, item, loop, quit_event) -> bool:
+        """
+        Queue (frame,eventpoint) from a render thread. Waits while the queue is full, which
+        is the backpressure that paces inference and asr, until quit_event is set.
+        """
+        future = asyncio.run_coroutine_threadsafe(self.put_frame(item), loop)
+        while True:
+            try:
+                future.result(timeout=1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if quit_event.is_set():
+                    future.cancel()
+                    return False
+
     async def recv(self) -> Union[Frame, Packet]:
         # frame = self.frames[self.counter % 30]            
         self._player._start(self)
@@ -135,12 +182,16 @@ class PlayerStreamTrack(MediaStreamTrack):
         if frame is None:
             self.stop()
             raise Exception
+        self.frames_sent.inc()
         if self.kind == 'video':
             self.totaltime += (time.perf_counter() - self.lasttime)
             self.framecount += 1
             self.lasttime = time.perf_counter()
+            if self._player is not None:
+                self._player.update_drift()
             if self.framecount==100:
                 mylogger.info(f"------actual avg final fps:{self.framecount/self.totaltime:.4f}")
+                metrics.video_fps.labels(self.sessionid).set(self.framecount/self.totaltime)
                 self.framecount = 0
                 self.totaltime=0
         return frame
@@ -173,14 +224,25 @@ class HumanPlayer:
         self.__audio: Optional[PlayerStreamTrack] = None
         self.__video: Optional[PlayerStreamTrack] = None
 
-        self.__audio = PlayerStreamTrack(self, kind="audio")
-        self.__video = PlayerStreamTrack(self, kind="video")
+        opt = nerfreal.opt
+        self.sessionid = nerfreal.sessionid
+        self.__drift = metrics.av_drift.labels(self.sessionid)
+        #one video frame per 40ms, two audio frames of 20ms each
+        self.__audio = PlayerStreamTrack(self, kind="audio", maxsize=opt.track_queue_size*2, lag_policy=opt.track_lag_policy)
+        self.__video = PlayerStreamTrack(self, kind="video", maxsize=opt.track_queue_size, lag_policy=opt.track_lag_policy)
 
         self.__container = nerfreal
 
     def notify(self,eventpoint):
         self.__container.notify(eventpoint)
 
+    def update_drift(self):
+        """wall clock time of the last video frame sent minus that of the last audio frame"""
+        audio, video = self.__audio, self.__video
+        if hasattr(audio, '_timestamp') and hasattr(video, '_timestamp'):
+            self.__drift.set((video._start + video._timestamp / VIDEO_CLOCK_RATE)
+                             - (audio._start + audio._timestamp / SAMPLE_RATE))
+
     @property
     def audio(self) -> MediaStreamTrack:
         """